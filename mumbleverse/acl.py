@@ -0,0 +1,119 @@
+"""
+In memory access rules, for working out access for lots of users at once.
+
+Loads every server's access m2m's once as id lookups, then any number of
+users can be checked against them with a handful of queries per batch
+instead of per user. Gives the same answers as
+`MumbleverseServerQuerySet.visible_to`.
+"""
+
+# Standard Library
+from collections import defaultdict
+
+# Django
+from django.contrib.auth.models import User
+
+# AA Mumbleverse
+from mumbleverse.manager import _users_with_perm
+
+# users loaded per query, keeps `id IN (...)` under the db's param limits
+USER_BATCH_SIZE = 2000
+
+
+class AccessRules:
+    """Every server's access rules as `{related id: {server ids}}` lookups
+
+    Corporations, alliances and factions are keyed by their eve id to match
+    a main character's `corporation_id` etc.
+    """
+
+    def __init__(self, server_ids, state, group, character, corporation, alliance, faction):
+        self.server_ids = frozenset(server_ids)
+        self.state = state
+        self.group = group
+        self.character = character
+        self.corporation = corporation
+        self.alliance = alliance
+        self.faction = faction
+
+    @classmethod
+    def load(cls, servers):
+        """Load the rules for a queryset of servers, 7 queries"""
+        model = servers.model
+        server_ids = list(servers.values_list("id", flat=True))
+
+        def _lookup(field, related):
+            through = getattr(model, field).through
+            lookup = defaultdict(set)
+            for server_id, related_id in through.objects.filter(
+                mumbleverseserver_id__in=server_ids
+            ).values_list("mumbleverseserver_id", related):
+                lookup[related_id].add(server_id)
+            return dict(lookup)
+
+        return cls(
+            server_ids,
+            state=_lookup("state_access", "state_id"),
+            group=_lookup("group_access", "group_id"),
+            character=_lookup("character_access", "evecharacter_id"),
+            corporation=_lookup("corporation_access", "evecorporationinfo__corporation_id"),
+            alliance=_lookup("alliance_access", "eveallianceinfo__alliance_id"),
+            faction=_lookup("faction_access", "evefactioninfo__faction_id"),
+        )
+
+    def servers_for(self, state_id, group_ids, character_id, corporation_id, alliance_id, faction_id):
+        """Server ids a user with these attributes gets through the access rules"""
+        servers = set(self.state.get(state_id, ()))
+        for group_id in group_ids:
+            servers.update(self.group.get(group_id, ()))
+        servers.update(self.character.get(character_id, ()))
+        servers.update(self.corporation.get(corporation_id, ()))
+        servers.update(self.alliance.get(alliance_id, ()))
+        servers.update(self.faction.get(faction_id, ()))
+        return servers
+
+    def visible_to_users(self, user_ids):
+        """Servers each user can access
+
+        Params:
+        - user_ids: iterable of user ids
+
+        Returns:
+        - dict of user_id to a set of server ids, every user is included
+        """
+        user_ids = list(user_ids)
+        visible = {}
+        for i in range(0, len(user_ids), USER_BATCH_SIZE):
+            visible.update(self._visible_to_batch(user_ids[i:i + USER_BATCH_SIZE]))
+        return visible
+
+    def _visible_to_batch(self, user_ids):
+        users = User.objects.filter(id__in=user_ids, is_active=True)
+        # has_perm is always False for inactive users
+        basic = set(users.filter(_users_with_perm("basic_access")).values_list("id", flat=True))
+        everything = set(users.filter(_users_with_perm("global_access")).values_list("id", flat=True))
+        groups = defaultdict(list)
+        for user_id, group_id in User.groups.through.objects.filter(
+            user_id__in=basic
+        ).values_list("user_id", "group_id"):
+            groups[user_id].append(group_id)
+
+        visible = {user_id: set() for user_id in user_ids}
+        for user_id, state_id, char_id, corp_id, alliance_id, faction_id in users.filter(
+            id__in=basic,
+            profile__main_character__isnull=False,
+        ).values_list(
+            "id",
+            "profile__state_id",
+            "profile__main_character_id",
+            "profile__main_character__corporation_id",
+            "profile__main_character__alliance_id",
+            "profile__main_character__faction_id",
+        ):
+            if user_id in everything:
+                visible[user_id] = set(self.server_ids)
+            else:
+                visible[user_id] = self.servers_for(
+                    state_id, groups[user_id], char_id, corp_id, alliance_id, faction_id
+                )
+        return visible
@@ -1,19 +1,25 @@
 """Admin models"""
 
 # Django
-from django.contrib import admin
+from django.contrib import admin, messages
 
+from .breaker import describe
+from .deadletter import replay
 from .models import (
+    MumbleverseDeadLetter,
+    MumbleverseOutbox,
     MumbleverseServer,
     MumbleverseServerActiveFilter,
     MumbleverseServerUser,
 )
+from .ratelimit import get_rate_limit_stats
+from .tasks import get_group_sync_stats
 
 
 # Register your models here.
 @admin.register(MumbleverseServer)
 class MumbleverseServerAdmin(admin.ModelAdmin):
-    list_display = ['name', 'mumble_url', 'api_url']
+    list_display = ['name', 'mumble_url', 'api_url', 'api_status']
     filter_horizontal = [
         "faction_access",
         "alliance_access",
@@ -22,6 +28,35 @@ class MumbleverseServerAdmin(admin.ModelAdmin):
         "group_access",
         "state_access",
     ]
+    readonly_fields = ["api_status", "group_sync_stats", "rate_limit_stats"]
+
+    @admin.display(description="API Status")
+    def api_status(self, obj):
+        if not obj.pk:
+            return "-"
+        return describe(obj.pk)
+
+    @admin.display(description="Group Sync Stats")
+    def group_sync_stats(self, obj):
+        if not obj.pk:
+            return "-"
+        stats = get_group_sync_stats(obj.pk)
+        pushes = stats["group_push_sent"] + stats["group_push_skipped"]
+        skip_rate = f"{stats['group_push_skipped'] / pushes:.0%}" if pushes else "-"
+        return ", ".join(
+            [f"{name}: {value}" for name, value in stats.items()] + [f"push skip rate: {skip_rate}"]
+        )
+
+    @admin.display(description="Rate Limit Stats")
+    def rate_limit_stats(self, obj):
+        if not obj.pk:
+            return "-"
+        stats = get_rate_limit_stats(obj.pk)
+        waits = stats["rate_limit_waits"]
+        avg_wait = f"{stats['rate_limit_wait_ms'] / waits:.0f}ms" if waits else "-"
+        return ", ".join(
+            [f"{name}: {value}" for name, value in stats.items()] + [f"average wait: {avg_wait}"]
+        )
 
 
 @admin.register(MumbleverseServerUser)
@@ -35,3 +70,35 @@ class MumbleverseServerUserAdmin(admin.ModelAdmin):
 class MumbleverseServerFilterAdmin(admin.ModelAdmin):
     list_display = ['server', 'reversed_logic']
     raw_id_fields = ['server']
+
+
+@admin.register(MumbleverseOutbox)
+class MumbleverseOutboxAdmin(admin.ModelAdmin):
+    list_display = ['operation', 'server', 'created', 'attempts', 'last_error']
+    list_filter = ['server', 'operation']
+    readonly_fields = ['server', 'operation', 'payload', 'created', 'attempts', 'last_error']
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(MumbleverseDeadLetter)
+class MumbleverseDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ['operation', 'server', 'attempts', 'error', 'last_failure']
+    list_filter = ['server', 'operation']
+    readonly_fields = ['server', 'operation', 'payload', 'error', 'attempts', 'created', 'last_failure']
+    actions = ['replay_selected']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Replay selected dead letters")
+    def replay_selected(self, request, queryset):
+        server_ids, skipped = replay(queryset)
+        self.message_user(request, f"Replaying on {len(server_ids)} servers")
+        if skipped:
+            self.message_user(
+                request,
+                f"{skipped} registrations can't be replayed, the users have to activate again",
+                level=messages.WARNING
+            )
@@ -1,9 +1,89 @@
 """App Settings"""
 
 # Django
-# from django.conf import settings
+from django.conf import settings
 
-# put your app settings here
+# HTTP client pool used to talk to the mumble-auth-rest api's
+# Max open connections per api host
+MUMBLEVERSE_HTTP_MAX_CONNECTIONS = getattr(settings, "MUMBLEVERSE_HTTP_MAX_CONNECTIONS", 10)
+# Max idle connections kept alive per api host
+MUMBLEVERSE_HTTP_MAX_KEEPALIVE = getattr(settings, "MUMBLEVERSE_HTTP_MAX_KEEPALIVE", 5)
+# Seconds an idle connection is kept alive for
+MUMBLEVERSE_HTTP_KEEPALIVE_EXPIRY = getattr(settings, "MUMBLEVERSE_HTTP_KEEPALIVE_EXPIRY", 30)
+# Use HTTP/2 where the api supports it, requires the `h2` package
+MUMBLEVERSE_HTTP2 = getattr(settings, "MUMBLEVERSE_HTTP2", False)
 
+# Timeouts and retries for api calls, servers can override the timeouts and
+# retries in the admin
+# Seconds to wait to connect to an api
+MUMBLEVERSE_API_CONNECT_TIMEOUT = getattr(settings, "MUMBLEVERSE_API_CONNECT_TIMEOUT", 5)
+# Seconds to wait for an api to answer
+MUMBLEVERSE_API_READ_TIMEOUT = getattr(settings, "MUMBLEVERSE_API_READ_TIMEOUT", 30)
+# Times a call that failed to connect, timed out or got a busy response is retried in place
+MUMBLEVERSE_API_MAX_RETRIES = getattr(settings, "MUMBLEVERSE_API_MAX_RETRIES", 2)
+# Base seconds of the jittered exponential backoff between retries
+MUMBLEVERSE_API_BACKOFF = getattr(settings, "MUMBLEVERSE_API_BACKOFF", 0.5)
+# Longest wait between retries
+MUMBLEVERSE_API_MAX_BACKOFF = getattr(settings, "MUMBLEVERSE_API_MAX_BACKOFF", 30)
+# Times a task is retried once the in place retries ran out
+MUMBLEVERSE_API_TASK_RETRIES = getattr(settings, "MUMBLEVERSE_API_TASK_RETRIES", 3)
+# Per operation overrides of the above, eg `{"set_groups": {"read_timeout": 120}}`
+# operations are get_groups, set_groups, register_user, deregister_user and kick_username
+MUMBLEVERSE_API_POLICIES = getattr(settings, "MUMBLEVERSE_API_POLICIES", {})
 
-# EXAMPLE_SETTING_ONE = getattr(settings, "EXAMPLE_SETTING_ONE", None)
+# Api calls per second to each server, shared by every worker, 0 for no limit
+MUMBLEVERSE_API_RATE_LIMIT = getattr(settings, "MUMBLEVERSE_API_RATE_LIMIT", 20)
+# Calls that can be made at once before the rate limit applies
+MUMBLEVERSE_API_RATE_BURST = getattr(settings, "MUMBLEVERSE_API_RATE_BURST", 20)
+# Longest a call waits for the rate limit before it fails and is retried later
+MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT = getattr(settings, "MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT", 30)
+# Longest a call made while a user waits on a web request waits for the rate limit
+MUMBLEVERSE_API_RATE_LIMIT_REQUEST_WAIT = getattr(settings, "MUMBLEVERSE_API_RATE_LIMIT_REQUEST_WAIT", 1)
+
+# Max servers talked to at once by the all-server sweeps
+MUMBLEVERSE_ASYNC_CONCURRENCY = getattr(settings, "MUMBLEVERSE_ASYNC_CONCURRENCY", 10)
+
+# Accounts removed from a server per removal task
+MUMBLEVERSE_REMOVAL_BATCH_SIZE = getattr(settings, "MUMBLEVERSE_REMOVAL_BATCH_SIZE", 500)
+# Max kick/deregister calls in flight to one server at once
+MUMBLEVERSE_REMOVAL_CONCURRENCY = getattr(settings, "MUMBLEVERSE_REMOVAL_CONCURRENCY", 5)
+
+# Outbox entries sent to a server per batch
+MUMBLEVERSE_OUTBOX_BATCH_SIZE = getattr(settings, "MUMBLEVERSE_OUTBOX_BATCH_SIZE", 500)
+
+# Only send groups that changed when syncing a server's groups
+MUMBLEVERSE_GROUP_SYNC_DIFF = getattr(settings, "MUMBLEVERSE_GROUP_SYNC_DIFF", True)
+# Send every group instead when more than this fraction of groups changed
+MUMBLEVERSE_GROUP_SYNC_DIFF_THRESHOLD = getattr(settings, "MUMBLEVERSE_GROUP_SYNC_DIFF_THRESHOLD", 0.5)
+
+# Group changes for a server are merged into one sync that runs once the
+# server has had no changes for this many seconds
+MUMBLEVERSE_GROUP_SYNC_WINDOW = getattr(settings, "MUMBLEVERSE_GROUP_SYNC_WINDOW", 15)
+# but never later than this many seconds after the first change
+MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY = getattr(settings, "MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY", 60)
+
+# Seconds to remember the last group payload pushed to a server, identical
+# payloads are not sent again until this expires
+MUMBLEVERSE_GROUP_FINGERPRINT_TTL = getattr(settings, "MUMBLEVERSE_GROUP_FINGERPRINT_TTL", 6 * 60 * 60)
+
+# Keep a table of which users can access which servers and check access
+# against it instead of the access rules, build it with
+# `python manage.py mumbleverse_access_index` before turning this on
+MUMBLEVERSE_ACCESS_INDEX = getattr(settings, "MUMBLEVERSE_ACCESS_INDEX", False)
+
+# Seconds between each process checking the shared cache for server changes
+# made by other processes
+MUMBLEVERSE_REGISTRY_CHECK_INTERVAL = getattr(settings, "MUMBLEVERSE_REGISTRY_CHECK_INTERVAL", 1)
+
+# Run account activate/reset/set password/deactivate on a celery worker while
+# the user waits on a status page, instead of in the web request
+MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS = getattr(settings, "MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS", True)
+# Seconds an account operation's result is kept for the status page
+MUMBLEVERSE_ACCOUNT_OPERATION_TTL = getattr(settings, "MUMBLEVERSE_ACCOUNT_OPERATION_TTL", 5 * 60)
+
+# Stop calling a server's api after this many connection failures in a row
+MUMBLEVERSE_BREAKER_THRESHOLD = getattr(settings, "MUMBLEVERSE_BREAKER_THRESHOLD", 5)
+# Seconds to wait before letting a trial call through to a failing api
+MUMBLEVERSE_BREAKER_COOLDOWN = getattr(settings, "MUMBLEVERSE_BREAKER_COOLDOWN", 60)
+# Timeout for the health check that closes the breaker again
+MUMBLEVERSE_BREAKER_PROBE_TIMEOUT = getattr(settings, "MUMBLEVERSE_BREAKER_PROBE_TIMEOUT", 5)
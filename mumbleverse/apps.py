@@ -20,12 +20,5 @@ class ExampleConfig(AppConfig):
     verbose_name = f"Mumbleverse v{__version__}"
 
     def ready(self):
-        # run on startup to sync services!
-        from .auth_hooks import add_del_callback  # NOPEP8
-        try:
-            add_del_callback()
-        except Exception as e:
-            logger.error("DMV: Failed to Init DMV Server Hook")
-            logger.error(e, stack_info=True)
-
-        from . import signals  # noqa: F401
+        from . import auth_hooks  # noqa: F401
+        from . import registry, signals  # noqa: F401
@@ -0,0 +1,284 @@
+"""
+Async twin of `provider`, for talking to many mumble servers at once.
+
+Only use this from sync code via `run()`, eg inside a celery task, build
+any DB payloads first and hand them in so the event loop never blocks on
+the ORM.
+"""
+
+# Standard Library
+import asyncio
+import logging
+import weakref
+from functools import wraps
+
+# Third Party
+from asgiref.sync import sync_to_async
+from httpx import (
+    AsyncClient,
+    ConnectError,
+    Limits,
+    TimeoutException,
+    TransportError,
+)
+
+# AA Mumbleverse
+from mumbleverse import app_settings, breaker, ratelimit
+from mumbleverse.policy import RETRY_STATUS, backoff_delay, get_policy
+from mumbleverse.provider import (
+    ServerError,
+    _use_http2,
+    build_group_payload,
+    check_response,
+)
+from mumbleverse.ratelimit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+# AsyncClients are bound to the loop that opened them, so pool per loop.
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client(server):
+    """Get the pooled async client for a server's api on the running loop"""
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (server.api_url, server.api_key)
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        client = clients[key] = AsyncClient(
+            headers={
+                "key": server.api_key
+            },
+            limits=Limits(
+                max_connections=app_settings.MUMBLEVERSE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=app_settings.MUMBLEVERSE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=app_settings.MUMBLEVERSE_HTTP_KEEPALIVE_EXPIRY,
+            ),
+            http2=_use_http2(),
+        )
+    return client
+
+
+async def close_clients():
+    """Close every client opened on the running loop"""
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+
+def api_error_wrapper(func):
+    """Async twin of `provider.api_error_wrapper`"""
+    @wraps(func)
+    async def _api_wrapper(server, *args, **kwargs):
+        if not await sync_to_async(breaker.allow_request)(server.id):
+            logger.warning(f"Skipping {func.__name__} on {server}, its api is failing")
+            return False
+        try:
+            result = await func(server, *args, **kwargs)
+        except ConnectError as error:
+            await sync_to_async(breaker.record_failure)(server.id)
+            logger.error("Failed to connect to mumble server api")
+            logger.error(f"{error.request} - {error.args}")
+            return False
+        except RateLimited as error:
+            logger.warning(f"Skipping {func.__name__}, {error}")
+            return False
+        except ServerError as error:
+            await sync_to_async(breaker.record_failure)(server.id)
+            logger.error(error)
+            return False
+        except TimeoutException:
+            await sync_to_async(breaker.record_failure)(server.id)
+            raise
+        await sync_to_async(breaker.record_success)(server.id)
+        return result
+    return _api_wrapper
+
+
+async def _request(server, operation, method, path, **kwargs):
+    """Async twin of `provider._request`"""
+    policy = get_policy(server, operation)
+    attempt = 0
+    while True:
+        try:
+            wait = await sync_to_async(ratelimit.reserve)(server)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            out = await get_client(server).request(
+                method,
+                server.api_url + path,
+                timeout=policy.timeout,
+                **kwargs
+            )
+        except TransportError as error:
+            if attempt >= policy.max_retries:
+                raise
+            logger.warning(f"{operation} on {server} failed, retrying: {error!r}")
+        else:
+            if out.status_code not in RETRY_STATUS or attempt >= policy.max_retries:
+                return check_response(server, operation, out)
+            logger.warning(f"{operation} on {server} returned {out.status_code}, retrying")
+        await asyncio.sleep(backoff_delay(policy, attempt))
+        attempt += 1
+
+
+@api_error_wrapper
+async def get_groups(server):
+    out = await _request(
+        server,
+        "get_groups",
+        "GET",
+        "/api/auth/groups",
+        params={
+            "server_id": server.mumble_virtual_server_id,
+        }
+    )
+    if out.status_code == 200:
+        return out.json()
+    return False
+
+
+@api_error_wrapper
+async def set_groups(server, payload=None):
+    if payload is None:
+        payload = await sync_to_async(build_group_payload)(server)
+    out = await _request(
+        server,
+        "set_groups",
+        "POST",
+        "/api/auth/groups",
+        params={
+            "server_id": server.mumble_virtual_server_id,
+        },
+        json=payload
+    )
+    if out.status_code == 200:
+        return out.json()
+    return False
+
+
+@api_error_wrapper
+async def register_user(server, username, password):
+    out = await _request(
+        server,
+        "register_user",
+        "POST",
+        "/api/auth/user",
+        data={
+            "user_name": username,
+            "user_pass": password
+        },
+        params={
+            "server_id": server.mumble_virtual_server_id,
+        }
+    )
+    if out.status_code == 200:
+        return out.json()
+    return False
+
+
+@api_error_wrapper
+async def deregister_user(server, user_id: int):
+    out = await _request(
+        server,
+        "deregister_user",
+        "DELETE",
+        "/api/auth/users/delete",
+        params={
+            "server_id": server.mumble_virtual_server_id,
+            "user_id": user_id,
+        }
+    )
+    if out.status_code == 200:
+        return out.json()
+    return False
+
+
+@api_error_wrapper
+async def kick_username(server, user_name, reason="Auth Revoked Access"):
+    out = await _request(
+        server,
+        "kick_username",
+        "DELETE",
+        "/api/auth/users/kick",
+        params={
+            "server_id": server.mumble_virtual_server_id,
+            "user_name": user_name,
+            "reason": reason,
+        }
+    )
+    if out.status_code == 200:
+        return out.json()
+    return False
+
+
+async def remove_accounts(server, accounts, reason="Deactivated by Auth", concurrency=None, on_done=None):
+    """Kick and deregister accounts from a server
+
+    Accounts are removed concurrently over the server's pooled client.
+
+    An error removing one account is logged against it and does not stop
+    the others.
+
+    Params:
+    - on_done: sync `on_done(account)` called as soon as each account is
+      done with, whether or not it worked
+
+    Returns:
+    - dict of account.id to `{"kicked": bool, "deregistered": bool}`, with
+      the `error` for an account that errored
+    """
+    semaphore = asyncio.Semaphore(concurrency or app_settings.MUMBLEVERSE_REMOVAL_CONCURRENCY)
+
+    async def _remove(account):
+        async with semaphore:
+            try:
+                try:
+                    kicked = await kick_username(server, account.username, reason)
+                    deregistered = await deregister_user(server, account.uid)
+                finally:
+                    if on_done is not None:
+                        await sync_to_async(on_done)(account)
+            except Exception as e:
+                logger.error(f"Failed to remove {account.username} from {server}", exc_info=True)
+                return {"kicked": False, "deregistered": False, "error": repr(e)}
+        return {
+            "kicked": kicked is not False,
+            "deregistered": deregistered is not False,
+        }
+
+    results = await asyncio.gather(*[_remove(a) for a in accounts])
+    return {a.id: r for a, r in zip(accounts, results)}
+
+
+async def gather_servers(servers, func, concurrency=None):
+    """Run `func(server)` against every server concurrently
+
+    A failure on one server is logged and does not stop the others.
+
+    Returns:
+    - dict of server.id to result, False for a server that errored
+    """
+    semaphore = asyncio.Semaphore(concurrency or app_settings.MUMBLEVERSE_ASYNC_CONCURRENCY)
+
+    async def _run(server):
+        async with semaphore:
+            try:
+                return await func(server)
+            except Exception as e:
+                logger.error(f"Failed mumble api call for {server}")
+                logger.error(e, exc_info=1)
+                return False
+
+    results = await asyncio.gather(*[_run(s) for s in servers])
+    return {s.id: r for s, r in zip(servers, results)}
+
+
+def run(coro):
+    """Run a coroutine from sync code, closing any clients it opened"""
+    async def _main():
+        try:
+            return await coro
+        finally:
+            await close_clients()
+    return asyncio.run(_main())
@@ -3,20 +3,23 @@ import logging
 import urllib
 
 # Django
-from django.db.models.signals import post_delete, post_save
 from django.template.loader import render_to_string
 
 # Alliance Auth
 from allianceauth import hooks
 from allianceauth.services.hooks import ServicesHook, UrlHook
 
-from . import urls
+from . import registry, urls
 from .models import (
     MumbleverseServer,
     MumbleverseServerActiveFilter,
     MumbleverseServerUser,
 )
-from .tasks import disable_server_user, update_server_groups
+from .tasks import (
+    disable_server_user,
+    update_all_server_groups,
+    update_server_user_groups,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -44,40 +47,36 @@ class MumbleverseService(ServicesHook):
 
     def update_groups(self, user):
         # logger.debug(f"Updating {self.name} groups for {user}")
-        update_server_groups.delay(self.sid)
+        update_server_user_groups.delay(self.sid, user.id)
 
     def sync_nickname(self, user):
         # this requires a new password be provided or can i update it?
         pass
 
     def validate_user(self, user):
-        if MumbleverseServerUser.user_has_account(self.sid, user.id) and not self.service_active_for_user(user):
+        # fresh lookups, this runs right after the user's access changed
+        if MumbleverseServerUser.user_has_account(self.sid, user.id) and \
+                not MumbleverseServer.user_can_access_server(user, self.sid):
             self.delete_user(user, notify_user=True)
 
     def update_all_groups(self):
         logger.debug("Updating all %s groups" % self.name)
-        update_server_groups.delay(self.sid)
+        # one task syncs every server, QueueOnce drops the other hooks' calls
+        update_all_server_groups.delay()
 
     def service_active_for_user(self, user):
-        return MumbleverseServer.objects.visible_to(
-            user
-        ).filter(id=self.sid).exists()
+        return self.sid in MumbleverseServer.objects.visible_ids_for(user)
 
     def render_services_ctrl(self, request):
         if self.service_active_for_user(request.user):
             username = ''
             service_url = ''
             connect_url = ''
-            try:
-                _u = MumbleverseServerUser.objects.get(
-                    server_id=self.sid,
-                    user=request.user
-                )
+            _u = MumbleverseServerUser.objects.accounts_for(request.user).get(self.sid)
+            if _u:
                 username = _u.username
                 service_url = _u.server.mumble_url
                 connect_url = urllib.parse.quote(username, safe="") + '@' + service_url if username else service_url
-            except MumbleverseServerUser.DoesNotExist:
-                pass
             return render_to_string(
                 self.service_ctrl_template,
                 {
@@ -93,44 +92,33 @@ class MumbleverseService(ServicesHook):
             return ""
 
 
-def add_del_callback(*args, **kwargs):
+@registry.on_reload
+def sync_server_hooks(servers):
     """
-        This works great at startup of auth, however has a bug where changes
-        made during operation are only captured on a single thread.
-        TLDR restart auth after adding a new server
+        Make our services hooks match the servers, runs every time the
+        server registry reloads so every process picks up new, renamed and
+        deleted servers without a restart.
     """
-    # Get a list of all guild ID's to check in our hook list
-    server_add = list(
-        MumbleverseServer.objects.all(
-        ).values_list(
-            "id",
-            flat=True
-        )
-    )
-    # Spit out the ID's for troubleshooting
-    logger.info(f"Processing Servers {server_add}")
-
-    # Loop all services and look for our specific hook classes
-    for h in hooks._hooks.get("services_hook", []):
-        if isinstance(h(), MumbleverseService):
-            # This is our hook
-            # h is an instanced MultiDiscordService hook with a guild_id
-            if h.sid in server_add:
-                # this is a known discord ID so remove it from our list of knowns
-                server_add.remove(h.sid)
-            else:
+    servers = {s.id: s for s in servers}
+    services = hooks._hooks.setdefault("services_hook", [])
+    for h in list(services):
+        # only look at our hook classes, other apps register functions
+        if isinstance(h, type) and issubclass(h, MumbleverseService):
+            server = servers.pop(h.sid, None)
+            if server is None:
                 # This one was deleted remove the hook.
-                del (h)
+                logger.info(f"Removing Server ID {h.sid}")
+                services.remove(h)
+            else:
+                h.server_name = server.name
 
     # Loop to setup what is mising ( or everyhting on first boot )
-    for sid in server_add:
-        # What guild_id
-        logger.info(f"Adding Server ID {sid}")
-        server = MumbleverseServer.objects.get(id=sid)
+    for server in servers.values():
+        logger.info(f"Adding Server ID {server.id}")
         # This is the magic to instance the hook class with a new Class Name
         # this way there are no conflicts at runtime
         Server_class = type(
-            f"MumbleverseService{sid}",  # New class name
+            f"MumbleverseService{server.id}",  # New class name
             (MumbleverseService,), {},  # Super class
             sid=server.id,  # set the guild_id
             server_name=server.name  # and server name
@@ -139,10 +127,6 @@ def add_del_callback(*args, **kwargs):
         hooks.register("services_hook", Server_class)
 
 
-post_save.connect(add_del_callback, sender=MumbleverseServer)
-post_delete.connect(add_del_callback, sender=MumbleverseServer)
-
-
 # @hooks.register('services_hook')
 # def register_mumble_service():
 #     return MumbleService()
@@ -0,0 +1,102 @@
+"""
+Per server circuit breaker, kept in the shared cache so every worker sees it.
+
+- closed: calls go through, connection failures are counted
+- open: `MUMBLEVERSE_BREAKER_THRESHOLD` failures in a row, calls fail fast
+  for `MUMBLEVERSE_BREAKER_COOLDOWN` seconds
+- half-open: cooldown is over, one call at a time is let through as a trial,
+  it closes the breaker if it works and re-opens it if not
+
+The `probe_server_health` task closes it as soon as the api answers again.
+"""
+
+# Standard Library
+import logging
+import time
+
+# Django
+from django.core.cache import cache
+
+# AA Mumbleverse
+from mumbleverse import app_settings
+from mumbleverse.metrics import get_metrics, increment
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# a trial that never reported back frees its slot after this many seconds
+TRIAL_TIMEOUT = 60
+
+
+def _keys(server_id):
+    return (
+        f"mumbleverse:breaker:{server_id}:failures",
+        f"mumbleverse:breaker:{server_id}:opened",
+        f"mumbleverse:breaker:{server_id}:trial",
+    )
+
+
+def _state(opened):
+    if opened is None:
+        return CLOSED
+    if time.time() - opened < app_settings.MUMBLEVERSE_BREAKER_COOLDOWN:
+        return OPEN
+    return HALF_OPEN
+
+
+def get_state(server_id):
+    _, opened_key, _ = _keys(server_id)
+    return _state(cache.get(opened_key))
+
+
+def allow_request(server_id):
+    """Check if a call to the server should be made"""
+    state = get_state(server_id)
+    if state == CLOSED:
+        return True
+    if state == HALF_OPEN:
+        # only one trial call at a time across every worker
+        _, _, trial_key = _keys(server_id)
+        return cache.add(trial_key, 1, timeout=TRIAL_TIMEOUT)
+    return False
+
+
+def record_success(server_id):
+    keys = _keys(server_id)
+    # nothing to write on the happy path
+    if any(v is not None for v in cache.get_many(keys[:2]).values()):
+        logger.info(f"Mumble server api {server_id} is back, closing breaker")
+        cache.delete_many(keys)
+
+
+def record_failure(server_id):
+    failures_key, opened_key, trial_key = _keys(server_id)
+    cache.add(failures_key, 0, timeout=None)
+    try:
+        failures = cache.incr(failures_key)
+    except ValueError:
+        # evicted between the add and the incr
+        cache.set(failures_key, 1, timeout=None)
+        failures = 1
+    if failures >= app_settings.MUMBLEVERSE_BREAKER_THRESHOLD:
+        if get_state(server_id) == CLOSED:
+            logger.error(f"Mumble server api {server_id} failed {failures} times, opening breaker")
+            increment(server_id, "breaker_opened")
+        cache.set(opened_key, time.time(), timeout=None)
+        cache.delete(trial_key)
+
+
+def describe(server_id):
+    """Breaker state for humans"""
+    failures_key, opened_key, _ = _keys(server_id)
+    values = cache.get_many([failures_key, opened_key])
+    opened = values.get(opened_key)
+    state = _state(opened)
+    if state == CLOSED:
+        status = f"{state}, {values.get(failures_key) or 0} failures"
+    else:
+        status = f"{state} since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(opened))}"
+    return f"{status}, opened {get_metrics(server_id, ['breaker_opened'])['breaker_opened']} times"
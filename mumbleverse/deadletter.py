@@ -0,0 +1,76 @@
+"""
+Dead letters, api operations that kept failing.
+
+Outbox entries that ran out of retries are moved here so the rest of the
+server's outbox can carry on, and failed registrations are recorded.
+Replaying puts them back in the outbox to be sent in order, from the admin
+or `python manage.py mumbleverse_replay_dead_letters`.
+
+Registrations are recorded but can't be replayed, the user has to activate
+again to get a new password.
+"""
+
+# Standard Library
+import logging
+from collections import defaultdict
+
+# Django
+from django.db import transaction
+from django.db.models import F
+
+# AA Mumbleverse
+from mumbleverse import outbox
+from mumbleverse.models import MumbleverseDeadLetter, MumbleverseOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def record(server_id, operation, payload, error, attempts=1):
+    """Record a failed operation, a server only ever has one failed full group sync"""
+    if operation == MumbleverseOutbox.SYNC_GROUPS and MumbleverseDeadLetter.objects.filter(
+        server_id=server_id, operation=operation
+    ).update(attempts=F("attempts") + attempts, error=error):
+        return
+    MumbleverseDeadLetter.objects.create(
+        server_id=server_id,
+        operation=operation,
+        payload=payload,
+        error=error,
+        attempts=attempts
+    )
+
+
+def bury(entry):
+    """Move an outbox entry that ran out of retries to the dead letters"""
+    logger.error(f"Giving up on {entry} after {entry.attempts} attempts: {entry.last_error}")
+    with transaction.atomic():
+        record(entry.server_id, entry.operation, entry.payload, entry.last_error, entry.attempts)
+        entry.delete()
+
+
+def replay(letters, schedule=True):
+    """Put dead letters back in their servers' outboxes
+
+    Params:
+    - schedule: drain the outboxes on workers once committed, otherwise the
+      caller drains them
+
+    Returns:
+    - the ids of the servers with entries to send
+    - the number of letters that can't be replayed
+    """
+    by_server = defaultdict(lambda: defaultdict(list))
+    replayed = []
+    skipped = 0
+    for letter in letters:
+        if not letter.replayable:
+            skipped += 1
+            continue
+        by_server[letter.server_id][letter.operation].append(letter.payload)
+        replayed.append(letter.id)
+    with transaction.atomic():
+        for server_id, operations in by_server.items():
+            for operation, payloads in operations.items():
+                outbox.enqueue(server_id, operation, payloads, schedule=schedule)
+        MumbleverseDeadLetter.objects.filter(id__in=replayed).delete()
+    return list(by_server), skipped
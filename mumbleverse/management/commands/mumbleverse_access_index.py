@@ -0,0 +1,45 @@
+# Standard Library
+from collections import defaultdict
+
+# Django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+# AA Mumbleverse
+from mumbleverse.models import MumbleverseServer, MumbleverseServerAccess
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Mumbleverse server access index and/or check it against the access rules"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only compare the index with `visible_to` for every user, don't change it",
+        )
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            added, removed = MumbleverseServerAccess.objects.rebuild()
+            self.stdout.write(f"Rebuilt access index, added {added} removed {removed}")
+
+        index = defaultdict(set)
+        for user_id, server_id in MumbleverseServerAccess.objects.values_list("user_id", "server_id"):
+            index[user_id].add(server_id)
+        mismatches = 0
+        users = User.objects.filter(id__in=index) | User.objects.filter(profile__main_character__isnull=False)
+        for user in users.distinct().iterator():
+            live = set(MumbleverseServer.objects.visible_to(user).values_list("id", flat=True))
+            indexed = index[user.id]
+            if live != indexed:
+                mismatches += 1
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"{user}: index {sorted(indexed)} != live {sorted(live)}"
+                    )
+                )
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f"{mismatches} users do not match the live access rules"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Access index matches the live access rules"))
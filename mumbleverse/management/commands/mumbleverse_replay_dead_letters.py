@@ -0,0 +1,71 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# AA Mumbleverse
+from mumbleverse import app_settings
+from mumbleverse.deadletter import replay
+from mumbleverse.models import (
+    MumbleverseDeadLetter,
+    MumbleverseOutbox,
+    MumbleverseServer,
+)
+from mumbleverse.outbox import drain
+from mumbleverse.registry import get_server
+
+
+class Command(BaseCommand):
+    help = "Replay failed Mumbleverse api operations once the servers are back"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--server",
+            type=int,
+            action="append",
+            help="Only replay this server's dead letters, can be given more than once",
+        )
+        parser.add_argument(
+            "--operation",
+            choices=[c[0] for c in MumbleverseOutbox.OPERATION_CHOICES],
+            help="Only replay this operation",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=app_settings.MUMBLEVERSE_REMOVAL_CONCURRENCY,
+            help="Max calls in flight to a server at once",
+        )
+        parser.add_argument(
+            "--queue",
+            action="store_true",
+            help="Hand the replay to the celery workers instead of sending it from here",
+        )
+
+    def handle(self, *args, **options):
+        letters = MumbleverseDeadLetter.objects.order_by("id")
+        if options["server"]:
+            letters = letters.filter(server_id__in=options["server"])
+        if options["operation"]:
+            letters = letters.filter(operation=options["operation"])
+        count = letters.count()
+        server_ids, skipped = replay(letters, schedule=options["queue"])
+        if skipped:
+            self.stdout.write(
+                self.style.WARNING(f"{skipped} registrations can't be replayed, the users have to activate again")
+            )
+        self.stdout.write(f"Replaying {count - skipped} dead letters on {len(server_ids)} servers")
+        if options["queue"]:
+            return
+
+        for server_id in server_ids:
+            try:
+                server = get_server(server_id)
+            except MumbleverseServer.DoesNotExist:
+                continue
+            drain(server, options["concurrency"])
+            left = MumbleverseOutbox.objects.filter(server=server).count()
+            if left:
+                self.stdout.write(
+                    self.style.WARNING(f"{server}: {left} entries still waiting, the workers will keep retrying")
+                )
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{server}: done"))
@@ -3,105 +3,86 @@ import logging
 
 # Django
 from django.conf import settings
+from django.contrib.auth.models import Permission, User
 from django.db import models
 
 # Alliance Auth
-from allianceauth.eveonline.models import (
-    EveAllianceInfo,
-    EveCorporationInfo,
-    EveFactionInfo,
-)
+from allianceauth.eveonline.models import EveCharacter
+
+# AA Mumbleverse
+from mumbleverse import app_settings
 
 logger = logging.getLogger(__name__)
 
 
 class MumbleverseServerQuerySet(models.QuerySet):
     def visible_to(self, user):
+        """Servers a user can access
+
+        Everything past the perm checks is one SQL statement, each access
+        rule is an id subquery against the user's profile and main
+        character so nothing is fetched up front and no rows duplicate.
+        """
         if not user.has_perm('mumbleverse.basic_access'):
             logger.debug(f'Returning No Servers for No Access Perm {user}')
             return self.none()
 
-        try:
-            main_character = user.profile.main_character
-            assert main_character
+        # ONLY users with a main character see anything
+        main_character = EveCharacter.objects.filter(
+            userprofile__user_id=user.id
+        )
+        has_main = models.Exists(main_character)
 
-            # superusers/global get all visible
-            if user.is_superuser or user.has_perm('mumbleverse.global_access'):
-                logger.debug(f'Returning all Servers for Global Perm {user}')
-                return self
+        # superusers/global get all visible
+        if user.is_superuser or user.has_perm('mumbleverse.global_access'):
+            logger.debug(f'Returning all Servers for Global Perm {user}')
+            return self.filter(has_main)
 
-            # build all accepted queries and then OR them
-            queries = []
+        servers = self.model.objects.all()
+        # build all accepted queries and then OR them
+        queries = [
             # States access everyone has a state
-            queries.append(
-                models.Q(
-                    state_access=user.profile.state
-                )
-            )
+            servers.filter(state_access__userprofile__user_id=user.id),
             # Groups access, is ok if no groups.
-            queries.append(
-                models.Q(
-                    group_access__in=user.groups.all()
-                )
-            )
+            servers.filter(group_access__user__id=user.id),
             # ONLY on main char from here down
             # Character access
-            queries.append(
-                models.Q(
-                    character_access=main_character
-                )
-            )
+            servers.filter(character_access__userprofile__user_id=user.id),
             # Corp access
-            try:
-                queries.append(
-                    models.Q(
-                        corporation_access=EveCorporationInfo.objects.get(
-                            corporation_id=main_character.corporation_id
-                        )
-                    )
-                )
-            except EveCorporationInfo.DoesNotExist:
-                pass
+            servers.filter(corporation_access__corporation_id__in=main_character.values("corporation_id")),
             # Alliance access if part of an alliance
-            try:
-                if main_character.alliance_id:
-                    queries.append(
-                        models.Q(
-                            alliance_access=EveAllianceInfo.objects.get(
-                                alliance_id=main_character.alliance_id
-                            )
-                        )
-                    )
-            except EveAllianceInfo.DoesNotExist:
-                pass
+            servers.filter(alliance_access__alliance_id__in=main_character.values("alliance_id")),
             # Faction access if part of a faction
-            try:
-                if main_character.faction_id:
-                    queries.append(
-                        models.Q(
-                            faction_access=EveFactionInfo.objects.get(
-                                faction_id=main_character.faction_id
-                            )
-                        )
-                    )
-            except EveFactionInfo.DoesNotExist:
-                pass
-
-            logger.debug(
-                f"{len(queries)} queries for {main_character}'s visible characters.")
-
-            if settings.DEBUG:
-                logger.debug(queries)
-
-            # filter based on "OR" all queries
-            query = queries.pop()
-            for q in queries:
-                query |= q
-            return self.filter(query)
-        except AssertionError:
-            logger.debug(
-                'User %s has no main character. Nothing visible.' % user)
-            return self.none()
+            servers.filter(faction_access__faction_id__in=main_character.values("faction_id")),
+        ]
+
+        # filter based on "OR" all queries
+        query = models.Q()
+        for q in queries:
+            query |= models.Q(id__in=q.values("id"))
+
+        if settings.DEBUG:
+            logger.debug(query)
+
+        return self.filter(has_main).filter(query)
+
+
+def _users_with_perm(codename):
+    """Q for users that `has_perm('mumbleverse.<codename>')`, the same way
+    Auth's backends resolve it: superuser, user, group or state perms"""
+    perms = Permission.objects.filter(
+        content_type__app_label="mumbleverse",
+        codename=codename
+    )
+    return models.Q(
+        is_superuser=True
+    ) | models.Q(
+        id__in=User.user_permissions.through.objects.filter(permission__in=perms).values("user_id")
+    ) | models.Q(
+        id__in=User.groups.through.objects.filter(group__permissions__in=perms).values("user_id")
+    ) | models.Q(
+        profile__state__permissions__in=perms
+    )
 
 
 class MumbleverseServerManager(models.Manager):
@@ -112,3 +93,62 @@ class MumbleverseServerManager(models.Manager):
 
     def visible_to(self, user):
         return self.get_queryset().visible_to(user)
+
+    def visible_ids_for(self, user):
+        """Ids of the servers a user can access
+
+        Cached on the user object, so every services hook checking the same
+        request's user shares one query.
+        """
+        server_ids = getattr(user, "_mumbleverse_visible_ids", None)
+        if server_ids is None:
+            if app_settings.MUMBLEVERSE_ACCESS_INDEX:
+                servers = self.filter(mumbleverseserveraccess__user_id=user.id)
+            else:
+                servers = self.visible_to(user)
+            server_ids = user._mumbleverse_visible_ids = frozenset(servers.values_list("id", flat=True))
+        return server_ids
+
+    def visible_to_users(self, users):
+        """Servers each of a batch of users can access, see `acl.AccessRules`
+
+        Params:
+        - users: iterable of users or user ids
+
+        Returns:
+        - dict of user_id to a set of server ids
+        """
+        # AA Mumbleverse
+        from mumbleverse.acl import AccessRules
+        user_ids = [getattr(u, "id", u) for u in users]
+        return AccessRules.load(self.all()).visible_to_users(user_ids)
+
+    def users_with_access(self, server):
+        """All users a server is `visible_to`, as one set based query
+
+        Params:
+        - server: server_id or Server model
+        """
+        if isinstance(server, int):
+            server = self.get(id=server)
+        access = models.Q(
+            profile__state__in=server.state_access.all()
+        ) | models.Q(
+            id__in=User.groups.through.objects.filter(group__in=server.group_access.all()).values("user_id")
+        ) | models.Q(
+            profile__main_character__in=server.character_access.all()
+        ) | models.Q(
+            profile__main_character__corporation_id__in=server.corporation_access.values("corporation_id")
+        ) | models.Q(
+            profile__main_character__alliance_id__in=server.alliance_access.values("alliance_id")
+        ) | models.Q(
+            profile__main_character__faction_id__in=server.faction_access.values("faction_id")
+        )
+        return User.objects.filter(
+            is_active=True,
+            profile__main_character__isnull=False,
+        ).filter(
+            _users_with_perm("basic_access")
+        ).filter(
+            _users_with_perm("global_access") | access
+        ).distinct()
@@ -0,0 +1,24 @@
+"""Per server counters, kept in the shared cache so every worker adds to them"""
+
+# Django
+from django.core.cache import cache
+
+
+def _key(server_id, name):
+    return f"mumbleverse:metrics:{server_id}:{name}"
+
+
+def increment(server_id, name, amount=1):
+    key = _key(server_id, name)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # evicted between the add and the incr
+        cache.set(key, amount, timeout=None)
+
+
+def get_metrics(server_id, names):
+    """Get counters for a server as `{name: value}`, missing counters are 0"""
+    values = cache.get_many([_key(server_id, n) for n in names])
+    return {n: values.get(_key(server_id, n), 0) for n in names}
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:04
+
+# Django
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mumbleverse", "0006_mumbleverseserveraccess"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mumbleverseserver",
+            name="api_connect_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds to wait to connect to the api, leave blank for the default.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="mumbleverseserver",
+            name="api_max_retries",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Times a failed api call is retried, leave blank for the default.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="mumbleverseserver",
+            name="api_read_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds to wait for the api to answer, leave blank for the default.",
+                null=True,
+            ),
+        ),
+    ]
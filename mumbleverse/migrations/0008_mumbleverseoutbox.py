@@ -0,0 +1,55 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:08
+
+# Django
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mumbleverse", "0007_mumbleverseserver_api_policy"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MumbleverseOutbox",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("remove_user", "Remove user"),
+                            ("sync_groups", "Sync groups"),
+                            ("sync_user_groups", "Sync user groups"),
+                        ],
+                        max_length=32,
+                    ),
+                ),
+                ("payload", models.JSONField(default=dict)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True, default="")),
+                (
+                    "server",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="mumbleverse.mumbleverseserver",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Outbox Entry",
+                "verbose_name_plural": "Outbox",
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:11
+
+# Django
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mumbleverse", "0008_mumbleverseoutbox"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MumbleverseDeadLetter",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("remove_user", "Remove user"),
+                            ("sync_groups", "Sync groups"),
+                            ("sync_user_groups", "Sync user groups"),
+                            ("register_user", "Register user"),
+                        ],
+                        max_length=32,
+                    ),
+                ),
+                ("payload", models.JSONField(default=dict)),
+                ("error", models.TextField(blank=True, default="")),
+                ("attempts", models.PositiveIntegerField(default=1)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("last_failure", models.DateTimeField(auto_now=True)),
+                (
+                    "server",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="mumbleverse.mumbleverseserver",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Dead Letter",
+                "verbose_name_plural": "Dead Letters",
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:13
+
+# Django
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mumbleverse", "0009_mumbleversedeadletter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mumbleverseserver",
+            name="api_rate_burst",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Api calls that can be made at once before the rate limit applies, leave blank for the default.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="mumbleverseserver",
+            name="api_rate_limit",
+            field=models.FloatField(
+                blank=True,
+                help_text="Api calls per second shared by every worker, 0 for no limit, leave blank for the default.",
+                null=True,
+            ),
+        ),
+    ]
@@ -28,8 +28,14 @@ from allianceauth.eveonline.models import (
 from allianceauth.services.hooks import NameFormatter
 
 # AA Mumbleverse
+from mumbleverse import app_settings
 from mumbleverse.manager import MumbleverseServerManager
-from mumbleverse.provider import deregister_user, kick_username, register_user
+from mumbleverse.provider import (
+    deregister_user,
+    kick_username,
+    register_user,
+    update_user,
+)
 
 
 class General(models.Model):
@@ -76,6 +82,19 @@ class MumbleverseManager(models.Manager):
     def user_exists(self, username):
         return self.filter(username=username).exists()
 
+    def accounts_for(self, user):
+        """A user's accounts as `{server_id: account}`
+
+        Cached on the user object, so every services hook rendering for a
+        request shares one query.
+        """
+        accounts = getattr(user, "_mumbleverse_accounts", None)
+        if accounts is None:
+            accounts = user._mumbleverse_accounts = {
+                a.server_id: a for a in self.filter(user=user).select_related("server")
+            }
+        return accounts
+
 
 class MumbleverseServer(models.Model):
 
@@ -97,6 +116,33 @@ class MumbleverseServer(models.Model):
         max_length=255
     )
 
+    # API call policy, blank uses the app settings
+    api_connect_timeout = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Seconds to wait to connect to the api, leave blank for the default."
+    )
+    api_read_timeout = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Seconds to wait for the api to answer, leave blank for the default."
+    )
+    api_max_retries = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        help_text="Times a failed api call is retried, leave blank for the default."
+    )
+    api_rate_limit = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Api calls per second shared by every worker, 0 for no limit, leave blank for the default."
+    )
+    api_rate_burst = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Api calls that can be made at once before the rate limit applies, leave blank for the default."
+    )
+
     # Permisions
     state_access = models.ManyToManyField(
         State,
@@ -152,6 +198,11 @@ class MumbleverseServer(models.Model):
         guild_id = server
         if isinstance(server, MumbleverseServer):
             guild_id = server.id
+        if app_settings.MUMBLEVERSE_ACCESS_INDEX:
+            return MumbleverseServerAccess.objects.filter(
+                server_id=int(guild_id),
+                user_id=user.id
+            ).exists()
         return cls.objects.get_queryset(
         ).visible_to(
             user
@@ -167,7 +218,7 @@ class MumbleverseServerUser(models.Model):
 
     @classmethod
     def user_has_account(cls, server_id, user_id):
-        cls.objects.filter(server_id=server_id, user_id=user_id).exists()
+        return cls.objects.filter(server_id=server_id, user_id=user_id).exists()
 
     server = models.ForeignKey(
         MumbleverseServer,
@@ -218,6 +269,37 @@ class MumbleverseServerUser(models.Model):
         self.username = self.build_username()
         self.save()
 
+    def update_credentials(self, password: str):
+        """Set a new password on the server, and the username if it has changed
+
+        Updated in place when the username is unchanged so the uid and groups
+        are kept, otherwise, or if that fails, the user is re-registered and
+        gets a new uid.
+
+        Only makes the api calls, the new `username` and `uid` are left on the
+        instance for the caller to save.
+
+        Returns:
+        - True if the account was updated
+        """
+        username = self.build_username()
+        if username == self.username:
+            data = update_user(self.server, self.username, password)
+            if data:
+                self.uid = data["user_id"]
+                return True
+            logger.warning(
+                f"Failed to update mumbleverse user {self.server_id} - {self.user_id} in place, re-registering"
+            )
+        self.kick_user(f"{self.username} deactivated by Auth")
+        self.deregister_user()
+        self.username = username
+        data = register_user(self.server, self.username, password)
+        if not data:
+            return False
+        self.uid = data["user_id"]
+        return True
+
     def register_user(self, password: str):
         data = register_user(
             self.server,
@@ -237,6 +319,168 @@ class MumbleverseServerUser(models.Model):
         )
 
 
+class MumbleverseServerAccessManager(models.Manager):
+
+    def _apply(self, rows, wanted, key):
+        """Make `rows` match the `wanted` set of keys"""
+        current = {key(r): r for r in rows}
+        to_add = wanted - set(current)
+        to_remove = [current[k].id for k in set(current) - wanted]
+        if to_remove:
+            self.filter(id__in=to_remove).delete()
+        if to_add:
+            self.bulk_create(
+                [self.model(server_id=sid, user_id=uid) for sid, uid in to_add],
+                ignore_conflicts=True
+            )
+        return len(to_add), len(to_remove)
+
+    def refresh_server(self, server):
+        """Rebuild the index for one server from the set based access query"""
+        user_ids = MumbleverseServer.objects.users_with_access(server).values_list("id", flat=True)
+        added, removed = self._apply(
+            self.filter(server=server),
+            {(server.id, uid) for uid in user_ids},
+            lambda r: (r.server_id, r.user_id)
+        )
+        logger.debug(f"Access index for {server}: +{added} -{removed}")
+        return added, removed
+
+    def refresh_user(self, user):
+        """Rebuild the index for one user from `visible_to`"""
+        server_ids = MumbleverseServer.objects.visible_to(user).values_list("id", flat=True)
+        added, removed = self._apply(
+            self.filter(user=user),
+            {(sid, user.id) for sid in server_ids},
+            lambda r: (r.server_id, r.user_id)
+        )
+        logger.debug(f"Access index for {user}: +{added} -{removed}")
+        return added, removed
+
+    def rebuild(self):
+        """Rebuild the whole index"""
+        added = removed = 0
+        for server in MumbleverseServer.objects.all():
+            a, r = self.refresh_server(server)
+            added += a
+            removed += r
+        return added, removed
+
+
+class MumbleverseServerAccess(models.Model):
+    """Materialized `visible_to`, one row for every user that can access a server.
+
+    Only kept up to date when MUMBLEVERSE_ACCESS_INDEX is set.
+    """
+
+    server = models.ForeignKey(
+        MumbleverseServer,
+        on_delete=models.CASCADE
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE
+    )
+
+    objects = MumbleverseServerAccessManager()
+
+    class Meta:
+        default_permissions = ()
+        unique_together = (("user", "server"),)
+
+    def __str__(self):
+        return f"{self.user} - {self.server}"
+
+
+class MumbleverseOutbox(models.Model):
+    """A change waiting to be sent to a server's api, see `mumbleverse.outbox`"""
+
+    REMOVE_USER = "remove_user"
+    SYNC_GROUPS = "sync_groups"
+    SYNC_USER_GROUPS = "sync_user_groups"
+    OPERATION_CHOICES = (
+        (REMOVE_USER, "Remove user"),
+        (SYNC_GROUPS, "Sync groups"),
+        (SYNC_USER_GROUPS, "Sync user groups"),
+    )
+
+    server = models.ForeignKey(
+        MumbleverseServer,
+        on_delete=models.CASCADE
+    )
+    operation = models.CharField(
+        max_length=32,
+        choices=OPERATION_CHOICES
+    )
+    payload = models.JSONField(
+        default=dict
+    )
+    created = models.DateTimeField(
+        auto_now_add=True
+    )
+    attempts = models.PositiveIntegerField(
+        default=0
+    )
+    last_error = models.TextField(
+        blank=True,
+        default=""
+    )
+
+    class Meta:
+        verbose_name = "Outbox Entry"
+        verbose_name_plural = "Outbox"
+
+    def __str__(self):
+        return f"{self.operation} on {self.server_id} - {self.payload}"
+
+
+class MumbleverseDeadLetter(models.Model):
+    """An api operation that ran out of retries, see `mumbleverse.deadletter`"""
+
+    REGISTER_USER = "register_user"
+    OPERATION_CHOICES = MumbleverseOutbox.OPERATION_CHOICES + (
+        (REGISTER_USER, "Register user"),
+    )
+
+    server = models.ForeignKey(
+        MumbleverseServer,
+        on_delete=models.CASCADE
+    )
+    operation = models.CharField(
+        max_length=32,
+        choices=OPERATION_CHOICES
+    )
+    payload = models.JSONField(
+        default=dict
+    )
+    error = models.TextField(
+        blank=True,
+        default=""
+    )
+    attempts = models.PositiveIntegerField(
+        default=1
+    )
+    created = models.DateTimeField(
+        auto_now_add=True
+    )
+    last_failure = models.DateTimeField(
+        auto_now=True
+    )
+
+    class Meta:
+        verbose_name = "Dead Letter"
+        verbose_name_plural = "Dead Letters"
+
+    def __str__(self):
+        return f"{self.operation} on {self.server_id} - {self.payload}"
+
+    @property
+    def replayable(self):
+        # registering needs the password, which is never stored
+        return self.operation != self.REGISTER_USER
+
+
 class FilterBase(models.Model):
 
     name = models.CharField(max_length=500)
@@ -0,0 +1,272 @@
+"""
+Transactional outbox for changes to the mumble servers.
+
+Account changes write what has to happen on the server to
+`MumbleverseOutbox` in the same transaction as the account rows, then
+`drain_outbox` sends it once that commits. A crash on either side leaves
+the entry in place to be sent by the next drain, so Auth and the servers
+can't drift apart and nothing needs a full sweep to repair.
+
+Each server's entries are sent in order, in batches. Runs of removals go
+out concurrently and runs of group updates are merged into one, every
+operation is safe to send twice.
+
+Registering is not done through here, the entry would have to hold the
+user's password. A removal takes its account's lock before checking the
+uid isn't back in use and lets go once that account is done with, and
+activating holds the same lock from registering until the account is
+committed, so a user activating again can't be deregistered by a removal
+of their old account. A removal that finds the lock taken fails and is
+retried, it never waits.
+"""
+
+# Standard Library
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from types import SimpleNamespace
+
+# Django
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+# AA Mumbleverse
+from mumbleverse import app_settings, async_provider, breaker
+from mumbleverse.models import MumbleverseOutbox, MumbleverseServerUser
+from mumbleverse.provider import sync_groups, sync_user_groups
+
+logger = logging.getLogger(__name__)
+
+# a drain that died holding the lock frees it after this many seconds
+LOCK_TIMEOUT = 10 * 60
+
+# seconds an activation waits for a removal of the same account to finish
+ACCOUNT_LOCK_WAIT = 30
+
+# outbox operation -> api operation whose retry policy it follows
+POLICY_OPERATIONS = {
+    MumbleverseOutbox.REMOVE_USER: "deregister_user",
+    MumbleverseOutbox.SYNC_GROUPS: "set_groups",
+    MumbleverseOutbox.SYNC_USER_GROUPS: "set_groups",
+}
+
+
+def _schedule_drain(server_id):
+    # AA Mumbleverse
+    from mumbleverse.tasks import drain_outbox
+    drain_outbox.delay(server_id)
+
+
+def enqueue(server_id, operation, payloads, schedule=True):
+    """Add entries for a server, they're sent once the transaction commits
+
+    Params:
+    - schedule: False to leave draining to the caller
+    """
+    MumbleverseOutbox.objects.bulk_create([
+        MumbleverseOutbox(server_id=server_id, operation=operation, payload=payload)
+        for payload in payloads
+    ])
+    if schedule:
+        transaction.on_commit(lambda: _schedule_drain(server_id))
+
+
+def remove_accounts(accounts, reason="Deactivated by Auth", schedule=True):
+    """Delete accounts and queue their removal from their servers
+
+    Params:
+    - schedule: False to leave draining to the caller
+    """
+    by_server = defaultdict(list)
+    for account in accounts:
+        by_server[account.server_id].append(account)
+    with transaction.atomic():
+        for server_id, server_accounts in by_server.items():
+            enqueue(
+                server_id,
+                MumbleverseOutbox.REMOVE_USER,
+                [{"username": a.username, "uid": a.uid, "reason": reason} for a in server_accounts],
+                schedule=schedule
+            )
+        MumbleverseServerUser.objects.filter(id__in=[a.id for a in accounts]).delete()
+
+
+def sync_account_groups(server_id, user_id, schedule=True):
+    """Queue an update of one user's groups on a server
+
+    Params:
+    - schedule: False to leave draining to the caller
+    """
+    enqueue(server_id, MumbleverseOutbox.SYNC_USER_GROUPS, [{"user_id": user_id}], schedule=schedule)
+
+
+class AccountLocked(Exception):
+    """Someone else is registering or removing this account"""
+
+
+def _account_lock_key(server_id, username):
+    return f"mumbleverse:outbox:{server_id}:account_lock:{username}"
+
+
+@contextmanager
+def account_lock(server_id, username, wait=None):
+    """Keep a removal and a registration of the same account from overlapping
+
+    Params:
+    - wait: seconds to wait for the lock, defaults to ACCOUNT_LOCK_WAIT
+
+    Raises:
+    - AccountLocked if it's still held by someone else after that
+    """
+    key = _account_lock_key(server_id, username)
+    deadline = time.monotonic() + (ACCOUNT_LOCK_WAIT if wait is None else wait)
+    while not cache.add(key, 1, timeout=LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise AccountLocked(f"{username} on server {server_id} is busy")
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def _send_removals(server, entries, concurrency=None):
+    """Kick and deregister a run of removals at once
+
+    Each account's lock is taken before checking its uid isn't back in use
+    and let go as soon as that account is done with.
+
+    Returns:
+    - dict of entry.id to an error, for the entries that failed
+    """
+    failed = {}
+    held = {}
+    for entry in entries:
+        key = _account_lock_key(server.id, entry.payload["username"])
+        if cache.add(key, 1, timeout=LOCK_TIMEOUT):
+            held[entry.id] = key
+        else:
+            failed[entry.id] = "Waiting on a registration"
+
+    def _release(entry_id):
+        key = held.pop(entry_id, None)
+        if key is not None:
+            cache.delete(key)
+
+    try:
+        claimed = [e for e in entries if e.id in held]
+        # the user activated again since, their uid is back in use
+        active = set(
+            server.mumbleverseserveruser_set.filter(
+                uid__in=[e.payload["uid"] for e in claimed]
+            ).values_list("uid", flat=True)
+        )
+        by_reason = defaultdict(list)
+        for entry in claimed:
+            if entry.payload["uid"] in active:
+                _release(entry.id)
+                continue
+            by_reason[entry.payload["reason"]].append(
+                SimpleNamespace(id=entry.id, username=entry.payload["username"], uid=entry.payload["uid"])
+            )
+        for reason, accounts in by_reason.items():
+            results = async_provider.run(
+                async_provider.remove_accounts(
+                    server, accounts, reason, concurrency, on_done=lambda a: _release(a.id)
+                )
+            )
+            failed.update({
+                _id: r.get("error", "Failed to deregister") for _id, r in results.items() if not r["deregistered"]
+            })
+    finally:
+        for entry_id in list(held):
+            _release(entry_id)
+    return failed
+
+
+def _send_group_updates(server, entries):
+    """Send a run of group updates as one call where possible
+
+    Returns:
+    - dict of entry.id to an error, for the entries that failed
+    """
+    user_ids = {e.payload["user_id"] for e in entries if e.operation == MumbleverseOutbox.SYNC_USER_GROUPS}
+    full = len(user_ids) > 1 or any(e.operation == MumbleverseOutbox.SYNC_GROUPS for e in entries)
+    if not full:
+        account = server.mumbleverseserveruser_set.select_related("user").filter(user_id=user_ids.pop()).first()
+        if account is None:
+            # removed since, nothing to update
+            return {}
+        if sync_user_groups(server, account) is not False:
+            return {}
+        # couldn't read the server's groups, send them all
+    if sync_groups(server) is False:
+        return {e.id: "Failed to sync groups" for e in entries}
+    return {}
+
+
+def _send(server, entries, concurrency=None):
+    if entries[0].operation == MumbleverseOutbox.REMOVE_USER:
+        return _send_removals(server, entries, concurrency)
+    return _send_group_updates(server, entries)
+
+
+def _drain(server, concurrency):
+    size = app_settings.MUMBLEVERSE_OUTBOX_BATCH_SIZE
+    while True:
+        entries = list(MumbleverseOutbox.objects.filter(server=server).order_by("id")[:size])
+        if not entries:
+            return None
+        for _removal, run in groupby(entries, key=lambda e: e.operation == MumbleverseOutbox.REMOVE_USER):
+            run = list(run)
+            try:
+                failed = _send(server, run, concurrency)
+            except Exception as e:
+                logger.error(f"Failed to send outbox entries to {server}", exc_info=True)
+                failed = {entry.id: repr(e) for entry in run}
+            MumbleverseOutbox.objects.filter(id__in=[e.id for e in run if e.id not in failed]).delete()
+            if failed:
+                by_error = defaultdict(list)
+                for _id, error in failed.items():
+                    by_error[error].append(_id)
+                for error, ids in by_error.items():
+                    MumbleverseOutbox.objects.filter(id__in=ids).update(attempts=F("attempts") + 1, last_error=error)
+                # stop here so nothing after it is sent out of order
+                return MumbleverseOutbox.objects.get(id=min(failed))
+        if len(entries) < size:
+            # that was the last of them
+            return None
+
+
+def drain(server, concurrency=None):
+    """Send a server's entries in order until none are left or one fails
+
+    Only one worker drains a server at a time, entries added while another
+    worker holds the lock are picked up by that worker before it lets go.
+
+    Params:
+    - concurrency: max removals in flight at once, defaults to
+      MUMBLEVERSE_REMOVAL_CONCURRENCY
+
+    Returns:
+    - the first entry that failed, None if there was nothing left to send
+    """
+    if breaker.get_state(server.id) == breaker.OPEN:
+        logger.debug(f"Not draining outbox for {server}, its api is failing")
+        return None
+    lock_key = f"mumbleverse:outbox:{server.id}:lock"
+    dirty_key = f"mumbleverse:outbox:{server.id}:dirty"
+    if not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        cache.set(dirty_key, 1, timeout=LOCK_TIMEOUT)
+        return None
+    try:
+        while True:
+            cache.delete(dirty_key)
+            failed = _drain(server, concurrency)
+            if failed is not None or not cache.get(dirty_key):
+                return failed
+    finally:
+        cache.delete(lock_key)
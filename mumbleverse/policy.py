@@ -0,0 +1,75 @@
+"""
+Timeouts and retries for calls to a server's api.
+
+Each operation's policy is the `MUMBLEVERSE_API_*` defaults, then the
+operation's entry in `MUMBLEVERSE_API_POLICIES`, then anything set on the
+server itself. Failed calls are retried in place with jittered exponential
+backoff, task retries carry on along the same curve.
+"""
+
+# Standard Library
+import random
+from typing import NamedTuple
+
+# Third Party
+from httpx import Timeout
+
+# AA Mumbleverse
+from mumbleverse import app_settings
+
+# responses worth another go, anything else is returned as is
+RETRY_STATUS = {429, 502, 503, 504}
+
+# group payloads can be big, give the api longer to apply them
+OPERATION_DEFAULTS = {
+    "set_groups": {"read_timeout": 60},
+}
+
+# server field -> policy field
+SERVER_FIELDS = {
+    "api_connect_timeout": "connect_timeout",
+    "api_read_timeout": "read_timeout",
+    "api_max_retries": "max_retries",
+}
+
+
+class ApiPolicy(NamedTuple):
+    connect_timeout: float
+    read_timeout: float
+    max_retries: int
+    backoff: float
+    max_backoff: float
+    task_retries: int
+
+    @property
+    def timeout(self):
+        return Timeout(self.read_timeout, connect=self.connect_timeout)
+
+
+def get_policy(server, operation):
+    """Get the policy for an operation on a server"""
+    policy = {
+        "connect_timeout": app_settings.MUMBLEVERSE_API_CONNECT_TIMEOUT,
+        "read_timeout": app_settings.MUMBLEVERSE_API_READ_TIMEOUT,
+        "max_retries": app_settings.MUMBLEVERSE_API_MAX_RETRIES,
+        "backoff": app_settings.MUMBLEVERSE_API_BACKOFF,
+        "max_backoff": app_settings.MUMBLEVERSE_API_MAX_BACKOFF,
+        "task_retries": app_settings.MUMBLEVERSE_API_TASK_RETRIES,
+    }
+    policy.update(OPERATION_DEFAULTS.get(operation, {}))
+    policy.update(app_settings.MUMBLEVERSE_API_POLICIES.get(operation, {}))
+    for field, name in SERVER_FIELDS.items():
+        value = getattr(server, field, None)
+        if value is not None:
+            policy[name] = value
+    return ApiPolicy(**policy)
+
+
+def backoff_delay(policy, attempt):
+    """Seconds to wait before retry number `attempt` (from 0), full jitter"""
+    return random.uniform(0, min(policy.max_backoff, policy.backoff * 2 ** attempt))
+
+
+def retry_countdown(policy, retries):
+    """Countdown for a task retry, after the in place retries ran out"""
+    return backoff_delay(policy, policy.max_retries + 1 + retries)
@@ -1,36 +1,214 @@
 # Standard Library
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 from functools import wraps
 
 # Third Party
-from httpx import ConnectError, delete, get, post
+from httpx import (
+    Client,
+    ConnectError,
+    HTTPError,
+    Limits,
+    TimeoutException,
+    TransportError,
+)
+
+# Django
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+
+# AA Mumbleverse
+from mumbleverse import app_settings, breaker, ratelimit
+from mumbleverse.metrics import increment
+from mumbleverse.policy import RETRY_STATUS, backoff_delay, get_policy
+from mumbleverse.ratelimit import RateLimited
 
 logger = logging.getLogger(__name__)
 
 
+class ServerError(Exception):
+    """The api still answered with a server error after every retry"""
+
+
+# One pooled keep-alive client per api host/key, shared by every server on it.
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def _use_http2():
+    if not app_settings.MUMBLEVERSE_HTTP2:
+        return False
+    try:
+        # Third Party
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("MUMBLEVERSE_HTTP2 is set but the `h2` package is not installed, using HTTP/1.1")
+        return False
+
+
+def _build_client(server):
+    return Client(
+        headers={
+            "key": server.api_key
+        },
+        limits=Limits(
+            max_connections=app_settings.MUMBLEVERSE_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=app_settings.MUMBLEVERSE_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=app_settings.MUMBLEVERSE_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=_use_http2(),
+    )
+
+
+def get_client(server):
+    """Get the pooled client for a server's api, building it if needed.
+
+    Clients are keyed by `api_url` + `api_key` so servers sharing an api
+    share a connection pool, and an edited server gets a fresh client.
+    """
+    global _clients_pid
+    key = (server.api_url, server.api_key)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # forked worker, never reuse the parent's sockets
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None or client.is_closed:
+            client = _clients[key] = _build_client(server)
+    return client
+
+
+def _close_clients(clients):
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"Failed to close mumble api client {e}")
+
+
+def reset_clients(*args, **kwargs):
+    """Close and forget every pooled client, they are rebuilt on next use"""
+    with _clients_lock:
+        clients = list(_clients.values()) if _clients_pid == os.getpid() else []
+        _clients.clear()
+    _close_clients(clients)
+
+
+def prune_clients(servers):
+    """Close the pooled clients that none of `servers` use any more
+
+    An edited server gets a client for its new details on next use, this
+    closes the old one once no other server shares it.
+    """
+    keys = {(s.api_url, s.api_key) for s in servers}
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            return
+        clients = [_clients.pop(key) for key in list(_clients) if key not in keys]
+    _close_clients(clients)
+
+
 def api_error_wrapper(func):
+    """Handle connection errors and feed the server's circuit breaker
+
+    Calls to a server whose breaker is open return False straight away.
+    """
     @wraps(func)
-    def _api_wrapper(*args, **kwargs):
+    def _api_wrapper(server, *args, **kwargs):
+        if not breaker.allow_request(server.id):
+            logger.warning(f"Skipping {func.__name__} on {server}, its api is failing")
+            return False
         try:
-            return func(*args, **kwargs)
+            result = func(server, *args, **kwargs)
         except ConnectError as error:
+            breaker.record_failure(server.id)
             logger.error("Failed to connect to mumble server api")
             logger.error(f"{error.request} - {error.args}")
             return False
+        except RateLimited as error:
+            logger.warning(f"Skipping {func.__name__}, {error}")
+            return False
+        except ServerError as error:
+            breaker.record_failure(server.id)
+            logger.error(error)
+            return False
+        except TimeoutException:
+            breaker.record_failure(server.id)
+            raise
+        breaker.record_success(server.id)
+        return result
     return _api_wrapper
 
 
+def check_response(server, operation, out):
+    """Raise ServerError for a 5xx response, otherwise hand it back"""
+    if out.status_code >= 500:
+        raise ServerError(f"{operation} on {server} returned {out.status_code}")
+    return out
+
+
+def _request(server, operation, method, path, **kwargs):
+    """Make a call to a server's api under the operation's policy
+
+    Transport errors and busy responses are retried with backoff, the
+    error or response of the last try is raised or returned.
+
+    Raises:
+    - ServerError if the last try was still a 5xx, so the breaker counts it
+    """
+    policy = get_policy(server, operation)
+    attempt = 0
+    while True:
+        try:
+            ratelimit.acquire(server)
+            out = get_client(server).request(
+                method,
+                server.api_url + path,
+                timeout=policy.timeout,
+                **kwargs
+            )
+        except TransportError as error:
+            if attempt >= policy.max_retries:
+                raise
+            logger.warning(f"{operation} on {server} failed, retrying: {error!r}")
+        else:
+            if out.status_code not in RETRY_STATUS or attempt >= policy.max_retries:
+                return check_response(server, operation, out)
+            logger.warning(f"{operation} on {server} returned {out.status_code}, retrying")
+        time.sleep(backoff_delay(policy, attempt))
+        attempt += 1
+
+
+def health_check(server):
+    """Check if a server's api is up, goes around the breaker"""
+    try:
+        out = get_client(server).get(
+            server.api_url + "/api/health-check",
+            timeout=app_settings.MUMBLEVERSE_BREAKER_PROBE_TIMEOUT
+        )
+    except HTTPError as error:
+        logger.debug(f"Health check failed for {server} {error}")
+        return False
+    return out.status_code == 200
+
+
 @api_error_wrapper
 def get_groups(server):
-    out = get(
-        server.api_url + "/api/auth/groups",
+    out = _request(
+        server,
+        "get_groups",
+        "GET",
+        "/api/auth/groups",
         params={
             "server_id": server.mumble_virtual_server_id,
-        },
-        headers={
-            "key": server.api_key
-        },
-        timeout=60
+        }
     )
     if out.status_code == 200:
         return out.json()
@@ -39,29 +217,51 @@ def get_groups(server):
         return False
 
 
-@api_error_wrapper
-def set_groups(server):
-    all_users = server.mumbleverseserveruser_set.all()
+def build_group_payload(server, group_names=None):
+    """Build the group membership payload for every account on a server
+
+    One query no matter how many accounts, the account -> user -> group
+    join runs through `User.groups.through` in the DB.
+
+    Params:
+    - group_names: only build these groups
+    """
+    filters = {"user__groups__isnull": False}
+    if group_names is not None:
+        filters["user__groups__name__in"] = group_names
+    memberships = server.mumbleverseserveruser_set.filter(
+        **filters
+    ).values_list(
+        "user__groups__name",
+        "uid"
+    ).order_by(
+        "user__groups__name",
+        "uid"
+    )
     output = {}
-    for u in all_users:
-        all_groups = u.user.groups.all()
-        for g in all_groups:
-            if g.name not in output:
-                output[g.name] = {
-                    "name": g.name,
-                    "users": []
-                }
-            output[g.name]["users"].append(u.uid)
-    out = post(
-        server.api_url + "/api/auth/groups",
+    for group_name, uid in memberships:
+        if group_name not in output:
+            output[group_name] = {
+                "name": group_name,
+                "users": []
+            }
+        output[group_name]["users"].append(uid)
+    return list(output.values())
+
+
+@api_error_wrapper
+def set_groups(server, payload=None):
+    if payload is None:
+        payload = build_group_payload(server)
+    out = _request(
+        server,
+        "set_groups",
+        "POST",
+        "/api/auth/groups",
         params={
             "server_id": server.mumble_virtual_server_id,
         },
-        headers={
-            "key": server.api_key
-        },
-        json=list(output.values()),
-        timeout=60
+        json=payload
     )
     if out.status_code == 200:
         return out.json()
@@ -70,21 +270,161 @@ def set_groups(server):
         return False
 
 
+def normalise_groups(groups):
+    """Turn a group payload or api response into `{name: {uid, ...}}`
+
+    Returns None if the response is not something we understand.
+    """
+    if isinstance(groups, dict):
+        groups = groups.get("groups", [
+            {"name": name, "users": users} for name, users in groups.items()
+        ])
+    if not isinstance(groups, list):
+        return None
+    try:
+        return {
+            g["name"]: {str(uid) for uid in g["users"]} for g in groups
+        }
+    except (KeyError, TypeError):
+        return None
+
+
+def diff_groups(current, payload):
+    """Get the part of a group payload that differs from the server's groups
+
+    Groups Auth knows about that are on the server but no longer have any
+    members are sent empty so they get cleared.
+    """
+    desired = normalise_groups(payload)
+    changes = [
+        g for g in payload if desired[g["name"]] != current.get(g["name"], set())
+    ]
+    stale = [name for name, users in current.items() if name not in desired and users]
+    if stale:
+        for name in Group.objects.filter(name__in=stale).values_list("name", flat=True):
+            changes.append({"name": name, "users": []})
+    return changes
+
+
+def group_fingerprint(payload):
+    """Stable hash of a group payload, ignoring group and member order"""
+    groups = sorted(
+        (name, sorted(users)) for name, users in normalise_groups(payload).items()
+    )
+    return hashlib.sha256(json.dumps(groups).encode()).hexdigest()
+
+
+def _fingerprint_key(server):
+    return f"mumbleverse:groups:fingerprint:{server.id}"
+
+
+def groups_unchanged(server, fingerprint):
+    """Check if this payload is what we last pushed to the server"""
+    if cache.get(_fingerprint_key(server)) == fingerprint:
+        increment(server.id, "group_push_skipped")
+        return True
+    return False
+
+
+def remember_groups(server, fingerprint):
+    """Record a payload as pushed to the server"""
+    increment(server.id, "group_push_sent")
+    cache.set(
+        _fingerprint_key(server),
+        fingerprint,
+        timeout=app_settings.MUMBLEVERSE_GROUP_FINGERPRINT_TTL
+    )
+
+
+def forget_groups(server):
+    """The server's groups were changed outside a full sync, push next time"""
+    cache.delete(_fingerprint_key(server))
+
+
+def sync_groups(server):
+    """Update a server's groups, sending only the groups that changed
+
+    Nothing is sent if the payload is the same as the last one pushed.
+    """
+    payload = build_group_payload(server)
+    fingerprint = group_fingerprint(payload)
+    if groups_unchanged(server, fingerprint):
+        logger.debug(f"Groups on {server} unchanged since last sync")
+        return True
+    result = _push_groups(server, payload)
+    if result is not False:
+        remember_groups(server, fingerprint)
+    return result
+
+
+def _push_groups(server, payload):
+    """Send a full group payload, as a diff if we can
+
+    Falls back to a full push when the server's groups can't be read or
+    too many groups changed for a diff to be worth it.
+    """
+    if not app_settings.MUMBLEVERSE_GROUP_SYNC_DIFF:
+        return set_groups(server, payload)
+
+    current = normalise_groups(get_groups(server))
+    if current is None:
+        logger.warning(f"Unable to read groups from {server}, sending all groups")
+        return set_groups(server, payload)
+
+    changes = diff_groups(current, payload)
+    if not changes:
+        logger.debug(f"Groups on {server} are up to date")
+        return True
+    if len(changes) > len(payload) * app_settings.MUMBLEVERSE_GROUP_SYNC_DIFF_THRESHOLD:
+        logger.debug(f"{len(changes)}/{len(payload)} groups changed on {server}, sending all groups")
+        return set_groups(server, payload)
+    logger.debug(f"Sending {len(changes)}/{len(payload)} changed groups to {server}")
+    return set_groups(server, changes)
+
+
+def sync_user_groups(server, account):
+    """Update only the groups one account joined or left on a server
+
+    Returns False if the server's groups can't be read, the caller should
+    fall back to a full sync.
+    """
+    current = normalise_groups(get_groups(server))
+    if current is None:
+        logger.warning(f"Unable to read groups from {server} to update {account}")
+        return False
+
+    uid = str(account.uid)
+    in_auth = set(account.user.groups.values_list("name", flat=True))
+    on_server = {name for name, users in current.items() if uid in users}
+    # only take them out of groups Auth manages
+    left = set(Group.objects.filter(name__in=on_server - in_auth).values_list("name", flat=True))
+    changed = (in_auth - on_server) | left
+    if not changed:
+        logger.debug(f"Groups for {account} on {server} are up to date")
+        return True
+
+    payload = build_group_payload(server, group_names=changed)
+    emptied = changed - {g["name"] for g in payload}
+    payload += [{"name": name, "users": []} for name in sorted(emptied)]
+    logger.debug(f"Sending {len(payload)} groups to {server} for {account}")
+    forget_groups(server)
+    return set_groups(server, payload)
+
+
 @api_error_wrapper
 def register_user(server, username, password):
-    out = post(
-        server.api_url + "/api/auth/user",
+    out = _request(
+        server,
+        "register_user",
+        "POST",
+        "/api/auth/user",
         data={
             "user_name": username,
             "user_pass": password
         },
         params={
             "server_id": server.mumble_virtual_server_id,
-        },
-        headers={
-            "key": server.api_key
-        },
-        timeout=60
+        }
     )
     if out.status_code == 200:
         return out.json()
@@ -93,18 +433,29 @@ def register_user(server, username, password):
         return False
 
 
+def update_user(server, username, password):
+    """Change an existing user's password in place
+
+    The api's register is a register-or-update keyed on the username, so an
+    existing user keeps their uid and groups.
+
+    Returns:
+    - the api response with the `user_id`, or False
+    """
+    return register_user(server, username, password)
+
+
 @api_error_wrapper
 def deregister_user(server, user_id: int):
-    out = delete(
-        server.api_url + "/api/auth/users/delete",
+    out = _request(
+        server,
+        "deregister_user",
+        "DELETE",
+        "/api/auth/users/delete",
         params={
             "server_id": server.mumble_virtual_server_id,
             "user_id": user_id,
-        },
-        headers={
-            "key": server.api_key
-        },
-        timeout=60
+        }
     )
     if out.status_code == 200:
         return out.json()
@@ -115,17 +466,16 @@ def deregister_user(server, user_id: int):
 
 @api_error_wrapper
 def kick_username(server, user_name, reason="Auth Revoked Access"):
-    out = delete(
-        server.api_url + "/api/auth/users/kick",
+    out = _request(
+        server,
+        "kick_username",
+        "DELETE",
+        "/api/auth/users/kick",
         params={
             "server_id": server.mumble_virtual_server_id,
             "user_name": user_name,
             "reason": reason,
-        },
-        headers={
-            "key": server.api_key
-        },
-        timeout=60
+        }
     )
     if out.status_code == 200:
         return out.json()
@@ -0,0 +1,163 @@
+"""
+Token bucket per server, shared by every worker through redis.
+
+Each server's api gets `MUMBLEVERSE_API_RATE_LIMIT` calls a second with
+bursts of up to `MUMBLEVERSE_API_RATE_BURST`, both can be set per server.
+A call that finds the bucket empty waits for its token instead of failing,
+calls that would have to wait longer than `MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT`
+give up and are retried like any other failed call. Calls made while a
+user waits on a web request use the much shorter `max_wait` set around them.
+
+The bucket is taken in one Lua script using the redis clock, so workers on
+different hosts agree on it. Without redis, or if the script fails, each
+process falls back to a bucket of its own.
+"""
+
+# Standard Library
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Third Party
+from redis.exceptions import RedisError
+
+# Alliance Auth
+from allianceauth.utils.cache import get_redis_client
+
+# AA Mumbleverse
+from mumbleverse import app_settings
+from mumbleverse.metrics import get_metrics, increment
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_METRICS = [
+    "rate_limit_waits",
+    "rate_limit_wait_ms",
+    "rate_limit_rejected",
+]
+
+# KEYS[1] bucket, ARGV rate, burst, max wait
+# returns {taken, seconds to wait}, numbers go back as strings so redis
+# doesn't round them
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local t = redis.call("TIME")
+local now = t[1] + t[2] / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+    if wait > max_wait then
+        return {0, tostring(wait)}
+    end
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens - 1), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate + max_wait) + 1)
+return {1, tostring(wait)}
+"""
+
+
+class RateLimited(Exception):
+    """The server's bucket is empty for longer than we're willing to wait"""
+
+
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+# overrides MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT inside `max_wait`
+_max_wait = ContextVar("mumbleverse_rate_limit_max_wait", default=None)
+
+
+@contextmanager
+def max_wait(seconds):
+    """Wait at most this long for a token, for calls made inside the block"""
+    token = _max_wait.set(seconds)
+    try:
+        yield
+    finally:
+        _max_wait.reset(token)
+
+
+def get_limits(server):
+    """Get `(rate, burst)` for a server, a rate of 0 means no limit"""
+    rate = server.api_rate_limit
+    if rate is None:
+        rate = app_settings.MUMBLEVERSE_API_RATE_LIMIT
+    burst = server.api_rate_burst
+    if burst is None:
+        burst = app_settings.MUMBLEVERSE_API_RATE_BURST
+    return rate, max(burst, 1)
+
+
+def _take_redis(server_id, rate, burst, max_wait):
+    script = get_redis_client().register_script(TAKE_SCRIPT)
+    taken, wait = script(
+        keys=[f"mumbleverse:ratelimit:{server_id}"],
+        args=[rate, burst, max_wait]
+    )
+    return bool(taken), float(wait)
+
+
+def _take_local(server_id, rate, burst, max_wait):
+    now = time.monotonic()
+    with _local_lock:
+        tokens, ts = _local_buckets.get(server_id, (burst, now))
+        tokens = min(burst, tokens + max(0, now - ts) * rate)
+        wait = 0
+        if tokens < 1:
+            wait = (1 - tokens) / rate
+            if wait > max_wait:
+                return False, wait
+        _local_buckets[server_id] = (tokens - 1, now)
+    return True, wait
+
+
+def _take(server_id, rate, burst, max_wait):
+    try:
+        return _take_redis(server_id, rate, burst, max_wait)
+    except (NotImplementedError, AttributeError, RedisError) as e:
+        logger.debug(f"Shared rate limit unavailable, using this process's own: {e!r}")
+        return _take_local(server_id, rate, burst, max_wait)
+
+
+def reserve(server):
+    """Take a token from the server's bucket
+
+    Returns:
+    - seconds to wait before making the call, 0 if it can go now
+
+    Raises:
+    - RateLimited
+    """
+    rate, burst = get_limits(server)
+    if not rate:
+        return 0
+    limit = _max_wait.get()
+    if limit is None:
+        limit = app_settings.MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT
+    taken, wait = _take(server.id, rate, burst, limit)
+    if not taken:
+        increment(server.id, "rate_limit_rejected")
+        raise RateLimited(f"{server} is rate limited, next call in {wait:.1f}s")
+    if wait > 0:
+        increment(server.id, "rate_limit_waits")
+        increment(server.id, "rate_limit_wait_ms", int(wait * 1000))
+    return wait
+
+
+def acquire(server):
+    """Wait for a token from the server's bucket"""
+    wait = reserve(server)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def get_rate_limit_stats(server_id):
+    return get_metrics(server_id, RATE_LIMIT_METRICS)
@@ -0,0 +1,144 @@
+"""
+Per process snapshot of every MumbleverseServer.
+
+Saving or deleting a server bumps a generation number in the shared cache,
+every process compares it with the generation of its own snapshot at most
+once per `MUMBLEVERSE_REGISTRY_CHECK_INTERVAL` and reloads when it moved.
+New, edited and deleted servers reach every web and celery worker without
+a restart, and looking up a server is a dict lookup.
+
+Nothing is loaded at import or when the app is ready, so starting up and
+migrating never touch the DB. The first request, task or server lookup in
+a process loads the snapshot and registers the services hooks.
+"""
+
+# Standard Library
+import logging
+import threading
+import time
+
+# Third Party
+from celery.signals import task_prerun
+
+# Django
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_delete, post_save
+
+# AA Mumbleverse
+from mumbleverse import app_settings
+from mumbleverse.models import MumbleverseServer
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "mumbleverse:registry:generation"
+
+_servers = {}
+_generation = None
+_checked = 0
+_lock = threading.RLock()
+_listeners = []
+
+
+def on_reload(func):
+    """Call `func(servers)` with every server each time the snapshot reloads"""
+    _listeners.append(func)
+    return func
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, timeout=None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def bump_generation():
+    cache.add(GENERATION_KEY, 1, timeout=None)
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # evicted between the add and the incr
+        cache.set(GENERATION_KEY, 2, timeout=None)
+
+
+def reload():
+    """Load every server, then hand them to the reload listeners"""
+    global _servers, _generation, _checked
+    with _lock:
+        # read the generation first, a change landing mid load is picked up next check
+        generation = get_generation()
+        _servers = {s.id: s for s in MumbleverseServer.objects.all()}
+        _generation = generation
+        _checked = time.monotonic()
+        servers = list(_servers.values())
+    logger.debug(f"Loaded {len(servers)} servers at generation {generation}")
+    for listener in _listeners:
+        listener(servers)
+
+
+def check_generation(*args, force=False, **kwargs):
+    """Reload if another process changed the servers since our snapshot"""
+    global _checked
+    now = time.monotonic()
+    if not force and _generation is not None and \
+            now - _checked < app_settings.MUMBLEVERSE_REGISTRY_CHECK_INTERVAL:
+        return
+    with _lock:
+        _checked = now
+        if _generation != get_generation():
+            reload()
+
+
+def refresh(*args, **kwargs):
+    """Check for changes at the start of every request and task
+
+    Does the initial load the first time. A DB that isn't up yet is logged
+    and tried again next time.
+    """
+    try:
+        check_generation()
+    except DatabaseError as e:
+        logger.error(f"Failed to load Mumbleverse servers, retrying next request: {e}")
+
+
+def get_servers():
+    check_generation()
+    return list(_servers.values())
+
+
+def get_server(server_id):
+    """Get a server from the snapshot
+
+    Raises:
+    - MumbleverseServer.DoesNotExist
+    """
+    check_generation()
+    server = _servers.get(server_id)
+    if server is None:
+        # may have just been created
+        check_generation(force=True)
+        server = _servers.get(server_id)
+    if server is None:
+        raise MumbleverseServer.DoesNotExist(f"No MumbleverseServer with id {server_id}")
+    return server
+
+
+def invalidate(*args, **kwargs):
+    """A server changed, make every process reload
+
+    Bumped straight away so nobody keeps using the old config and again on
+    commit so nobody keeps a snapshot read before the change was committed.
+    """
+    global _generation
+    bump_generation()
+    _generation = None
+    transaction.on_commit(bump_generation)
+
+
+post_save.connect(invalidate, sender=MumbleverseServer)
+post_delete.connect(invalidate, sender=MumbleverseServer)
+request_started.connect(refresh)
+task_prerun.connect(refresh)
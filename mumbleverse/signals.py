@@ -1,31 +1,293 @@
 # Django
-from django.db.models.signals import m2m_changed
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_save,
+    pre_save,
+)
 
 # Alliance Auth
+from allianceauth.authentication.models import State, UserProfile
+from allianceauth.eveonline.models import (
+    EveAllianceInfo,
+    EveCharacter,
+    EveCorporationInfo,
+    EveFactionInfo,
+)
 from allianceauth.services.hooks import get_extension_logger
 
 # AA Mumbleverse
-from mumbleverse.tasks import check_all_users_in_server
+from mumbleverse import app_settings, registry
+from mumbleverse.tasks import (
+    check_user_all_servers,
+    check_users_in_server,
+    rebuild_access_index,
+)
 
-from .models import MumbleverseServer
+from .models import (
+    MumbleverseServer,
+    MumbleverseServerAccess,
+    MumbleverseServerUser,
+)
+from .provider import prune_clients
 
 logger = get_extension_logger(__name__)
 
 
+def _state_users(ids):
+    return UserProfile.objects.filter(state_id__in=ids).values("user_id")
+
+
+def _group_users(ids):
+    return User.groups.through.objects.filter(group_id__in=ids).values("user_id")
+
+
+def _character_users(ids):
+    return UserProfile.objects.filter(main_character_id__in=ids).values("user_id")
+
+
+def _corporation_users(ids):
+    return UserProfile.objects.filter(
+        main_character__corporation_id__in=EveCorporationInfo.objects.filter(id__in=ids).values("corporation_id")
+    ).values("user_id")
+
+
+def _alliance_users(ids):
+    return UserProfile.objects.filter(
+        main_character__alliance_id__in=EveAllianceInfo.objects.filter(id__in=ids).values("alliance_id")
+    ).values("user_id")
+
+
+def _faction_users(ids):
+    return UserProfile.objects.filter(
+        main_character__faction_id__in=EveFactionInfo.objects.filter(id__in=ids).values("faction_id")
+    ).values("user_id")
+
+
+# access m2m: (field on the server, users the related objects cover)
+ACCESS_FIELDS = {
+    MumbleverseServer.state_access.through: ("state_access", _state_users),
+    MumbleverseServer.group_access.through: ("group_access", _group_users),
+    MumbleverseServer.character_access.through: ("character_access", _character_users),
+    MumbleverseServer.corporation_access.through: ("corporation_access", _corporation_users),
+    MumbleverseServer.alliance_access.through: ("alliance_access", _alliance_users),
+    MumbleverseServer.faction_access.through: ("faction_access", _faction_users),
+}
+
+
 def perms_change(sender, instance, action, reverse, model, pk_set, **kwargs):
     """
-        Perms have chagned CHECK EVERYONE!
+        Perms have changed, re-check the accounts of only the users that
+        could have lost access through what was removed.
+
+        Clears are handled before they happen while we can still see what
+        is being cleared.
     """
-    if action in ["post_remove"]:
-        check_all_users_in_server.delay(
-            instance.id
-        )
+    if action not in ["post_remove", "pre_clear"]:
+        return
+    field, users_for = ACCESS_FIELDS[sender]
+    if not reverse:
+        server_ids = [instance.pk]
+        if action == "pre_clear":
+            pk_set = getattr(instance, field).values("pk")
+        users = users_for(pk_set)
+    else:
+        if action == "pre_clear":
+            pk_set = MumbleverseServer.objects.filter(**{field: instance}).values("pk")
+        server_ids = pk_set
+        users = users_for([instance.pk])
+
+    affected = {}
+    for server_id, user_id in MumbleverseServerUser.objects.filter(
+        server_id__in=server_ids,
+        user_id__in=users
+    ).values_list("server_id", "user_id"):
+        affected.setdefault(server_id, []).append(user_id)
+
+    def _check():
+        for server_id, user_ids in affected.items():
+            check_users_in_server.delay(server_id, user_ids)
+    if affected:
+        transaction.on_commit(_check)
 
 
 # all the m2m's
-m2m_changed.connect(perms_change, sender=MumbleverseServer.state_access.through)
-m2m_changed.connect(perms_change, sender=MumbleverseServer.group_access.through)
-m2m_changed.connect(perms_change, sender=MumbleverseServer.character_access.through)
-m2m_changed.connect(perms_change, sender=MumbleverseServer.corporation_access.through)
-m2m_changed.connect(perms_change, sender=MumbleverseServer.alliance_access.through)
-m2m_changed.connect(perms_change, sender=MumbleverseServer.faction_access.through)
+for through in ACCESS_FIELDS:
+    m2m_changed.connect(perms_change, sender=through)
+
+
+def _check_users(user_ids):
+    """Re-check every server for these users once the change is committed
+
+    Only users with accounts get a task, QueueOnce folds repeat triggers for
+    a user into the task already waiting.
+    """
+    user_ids = list(
+        MumbleverseServerUser.objects.filter(user_id__in=user_ids).values_list("user_id", flat=True).distinct()
+    )
+
+    def _check():
+        for user_id in user_ids:
+            check_user_all_servers.delay(user_id)
+    if user_ids:
+        transaction.on_commit(_check)
+
+
+def user_groups_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """A user left a group"""
+    if action not in ["post_remove", "post_clear", "pre_clear"]:
+        return
+    if not reverse:
+        if action != "pre_clear":
+            _check_users([instance.pk])
+    elif action == "post_remove":
+        _check_users(pk_set)
+    elif action == "pre_clear":
+        # the group is being emptied, get its members while we still can
+        _check_users(instance.user_set.values("id"))
+
+
+# fields that decide access, a change to any of them re-checks the user. Auth
+# validates services itself once a state change is saved, its main character
+# checks run before the save so they still see the old rows
+USER_ACCESS_FIELDS = {
+    UserProfile: ["main_character_id"],
+    EveCharacter: ["corporation_id", "alliance_id", "faction_id"],
+}
+
+
+def _saves_access_fields(sender, update_fields):
+    if update_fields is None:
+        return True
+    fields = (sender._meta.get_field(f) for f in USER_ACCESS_FIELDS[sender])
+    return any(f.name in update_fields or f.attname in update_fields for f in fields)
+
+
+def stash_access_fields(sender, instance, update_fields=None, **kwargs):
+    """Remember what the access fields were before the save
+
+    Nothing is looked up for saves that leave the access fields alone, or
+    for characters that aren't anyone's main.
+    """
+    instance._mumbleverse_access_fields = None
+    if not instance.pk or not _saves_access_fields(sender, update_fields):
+        return
+    rows = sender.objects.filter(pk=instance.pk)
+    if sender is EveCharacter:
+        rows = rows.filter(userprofile__isnull=False)
+    instance._mumbleverse_access_fields = rows.values_list(*USER_ACCESS_FIELDS[sender]).first()
+
+
+def access_fields_change(sender, instance, created=False, **kwargs):
+    """A user's main changed, or a main character moved corp"""
+    before = vars(instance).pop("_mumbleverse_access_fields", None)
+    if created or before is None:
+        return
+    after = tuple(getattr(instance, f) for f in USER_ACCESS_FIELDS[sender])
+    if before == after:
+        return
+    if sender is UserProfile:
+        _check_users([instance.user_id])
+    else:
+        _check_users(UserProfile.objects.filter(main_character=instance).values("user_id"))
+
+
+# re-check users as soon as something about them changes
+m2m_changed.connect(user_groups_change, sender=User.groups.through)
+pre_save.connect(stash_access_fields, sender=UserProfile)
+pre_save.connect(stash_access_fields, sender=EveCharacter)
+post_save.connect(access_fields_change, sender=UserProfile)
+post_save.connect(access_fields_change, sender=EveCharacter)
+
+
+def _refresh_users_access(user_ids):
+    # fresh users so we don't use stale cached perms
+    for user in User.objects.filter(id__in=user_ids):
+        MumbleverseServerAccess.objects.refresh_user(user)
+
+
+def index_server_access_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """A server's access rules changed, rebuild it in the access index"""
+    if not app_settings.MUMBLEVERSE_ACCESS_INDEX:
+        return
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    if not reverse:
+        servers = [instance]
+    elif pk_set:
+        servers = list(MumbleverseServer.objects.filter(id__in=pk_set))
+    else:
+        # cleared from the other side, no idea which servers had it
+        servers = list(MumbleverseServer.objects.all())
+
+    def _refresh():
+        for server in servers:
+            MumbleverseServerAccess.objects.refresh_server(server)
+    transaction.on_commit(_refresh)
+
+
+def index_server_created(sender, instance, created=False, **kwargs):
+    """A new server, index whoever can see it before any access is set"""
+    if not app_settings.MUMBLEVERSE_ACCESS_INDEX or not created:
+        return
+    transaction.on_commit(lambda: MumbleverseServerAccess.objects.refresh_server(instance))
+
+
+def index_user_m2m_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """A user's groups or perms changed, refresh them in the access index"""
+    if not app_settings.MUMBLEVERSE_ACCESS_INDEX:
+        return
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif pk_set:
+        user_ids = list(pk_set)
+    else:
+        transaction.on_commit(rebuild_access_index.delay)
+        return
+    transaction.on_commit(lambda: _refresh_users_access(user_ids))
+
+
+def index_perms_change(sender, instance, action, **kwargs):
+    """A group or state's perms changed, could be anyone so rebuild"""
+    if not app_settings.MUMBLEVERSE_ACCESS_INDEX:
+        return
+    if action in ["post_add", "post_remove", "post_clear"]:
+        transaction.on_commit(rebuild_access_index.delay)
+
+
+def index_user_change(sender, instance, created=False, **kwargs):
+    """A user, their profile or their main character changed"""
+    if not app_settings.MUMBLEVERSE_ACCESS_INDEX:
+        return
+    if sender is User:
+        user_ids = [instance.pk]
+    elif sender is UserProfile:
+        user_ids = [instance.user_id]
+    else:
+        user_ids = list(UserProfile.objects.filter(main_character=instance).values_list("user_id", flat=True))
+    if user_ids:
+        transaction.on_commit(lambda: _refresh_users_access(user_ids))
+
+
+# keep the access index up to date
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.state_access.through)
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.group_access.through)
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.character_access.through)
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.corporation_access.through)
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.alliance_access.through)
+m2m_changed.connect(index_server_access_change, sender=MumbleverseServer.faction_access.through)
+post_save.connect(index_server_created, sender=MumbleverseServer)
+m2m_changed.connect(index_user_m2m_change, sender=User.groups.through)
+m2m_changed.connect(index_user_m2m_change, sender=User.user_permissions.through)
+m2m_changed.connect(index_perms_change, sender=Group.permissions.through)
+m2m_changed.connect(index_perms_change, sender=State.permissions.through)
+post_save.connect(index_user_change, sender=User)
+post_save.connect(index_user_change, sender=UserProfile)
+post_save.connect(index_user_change, sender=EveCharacter)
+
+# close pooled api clients once no server uses their connection details,
+# in every process as it picks up the change
+registry.on_reload(prune_clients)
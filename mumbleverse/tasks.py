@@ -2,25 +2,129 @@
 
 # Standard Library
 import logging
+import time
+from contextlib import ExitStack
+from uuid import uuid4
 
 # Third Party
 from celery import shared_task
 from httpx import HTTPError
 
+# Django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
 # Alliance Auth
 from allianceauth.services.tasks import QueueOnce
 
 # AA Mumbleverse
-from mumbleverse.models import MumbleverseServer, MumbleverseServerUser
+from mumbleverse import app_settings, breaker, deadletter, outbox
+from mumbleverse.metrics import get_metrics, increment
+from mumbleverse.models import (
+    MumbleverseDeadLetter,
+    MumbleverseOutbox,
+    MumbleverseServer,
+    MumbleverseServerAccess,
+    MumbleverseServerUser,
+)
+from mumbleverse.policy import get_policy, retry_countdown
+from mumbleverse.registry import get_server, get_servers
 
-from .provider import set_groups
+from . import async_provider
+from .provider import (
+    build_group_payload,
+    group_fingerprint,
+    health_check,
+    register_user,
+    remember_groups,
+)
 
 logger = logging.getLogger(__name__)
 
 
+GROUP_SYNC_METRICS = [
+    "group_sync_triggers",
+    "group_sync_merged",
+    "group_sync_runs",
+    "group_push_sent",
+    "group_push_skipped",
+]
+
+
 @shared_task(bind=True, base=QueueOnce)
 def update_server_groups(self, server_id):
-    set_groups(MumbleverseServer.objects.get(id=server_id))
+    """Push a server's groups through its outbox, behind anything already waiting"""
+    outbox.enqueue(server_id, MumbleverseOutbox.SYNC_GROUPS, [{}], schedule=False)
+    drain_outbox(server_id)
+
+
+@shared_task(bind=True, base=QueueOnce)
+def update_server_user_groups(self, server_id, user_id):
+    """Queue an update of just one user's groups on a server"""
+    if not MumbleverseServerUser.user_has_account(server_id, user_id):
+        # no account, nothing to update
+        return
+    # sent with every other group change in the window, a burst of them is one push
+    outbox.sync_account_groups(server_id, user_id, schedule=False)
+    queue_server_group_sync(server_id)
+
+
+def _group_sync_keys(server_id):
+    return (
+        f"mumbleverse:groupsync:{server_id}:first",
+        f"mumbleverse:groupsync:{server_id}:last",
+    )
+
+
+def queue_server_group_sync(server_id):
+    """Ask for a server's queued group updates to be sent, merging them with any already waiting
+
+    The first request opens a window and schedules one drain of the outbox,
+    every request after that until it runs is folded into it.
+    """
+    first_key, last_key = _group_sync_keys(server_id)
+    now = time.time()
+    increment(server_id, "group_sync_triggers")
+    cache.set(last_key, now, timeout=app_settings.MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY * 2)
+    # expires on its own in case the scheduled sync is lost
+    if cache.add(first_key, now, timeout=app_settings.MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY * 2):
+        coalesced_update_server_groups.apply_async(
+            args=[server_id],
+            countdown=app_settings.MUMBLEVERSE_GROUP_SYNC_WINDOW
+        )
+    else:
+        increment(server_id, "group_sync_merged")
+
+
+@shared_task(bind=True)
+def coalesced_update_server_groups(self, server_id):
+    """Send the queued group updates once the server has been quiet for a window
+
+    Keeps waiting while requests keep coming in, but never for longer
+    than MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY after the first one.
+    """
+    first_key, last_key = _group_sync_keys(server_id)
+    window = app_settings.MUMBLEVERSE_GROUP_SYNC_WINDOW
+    max_latency = app_settings.MUMBLEVERSE_GROUP_SYNC_MAX_LATENCY
+    now = time.time()
+    first = cache.get(first_key)
+    last = cache.get(last_key)
+    if first is not None and last is not None:
+        wait = min(window - (now - last), max_latency - (now - first))
+        if wait > 0:
+            coalesced_update_server_groups.apply_async(args=[server_id], countdown=wait)
+            return
+
+    # anything after this point opens a new window
+    cache.delete_many([first_key, last_key])
+    increment(server_id, "group_sync_runs")
+    logger.debug(f"Running coalesced group sync for {server_id} {get_group_sync_stats(server_id)}")
+    drain_outbox(server_id)
+
+
+def get_group_sync_stats(server_id):
+    return get_metrics(server_id, GROUP_SYNC_METRICS)
 
 
 @shared_task(bind=True, base=QueueOnce)
@@ -30,31 +134,416 @@ def disable_server_user(self, server_id: int, user_id: int):
             server_id=server_id,
             user_id=user_id
         )
-        _u.kick_user("Deactivated by Auth")
-        req = _u.deregister_user()
-        if req:
-            _u.delete()
     except MumbleverseServerUser.DoesNotExist:
         logger.error("Unable to delete user? none exists?")
-    except HTTPError as error:
-        logger.error(f"Failed to delete user from mumble server api - {server_id} - {user_id}")
-        logger.error(f"{error.request} - {error.args}")
-        self.retry(countdown=60)
+        return
+    outbox.remove_accounts([_u])
+
+
+def accounts_without_access(server):
+    """Get all accounts on a server whose user can no longer access it
+
+    One anti-join, every account on the server minus the users that pass
+    the server's access rules.
+    """
+    return server.mumbleverseserveruser_set.exclude(
+        user__in=MumbleverseServer.objects.users_with_access(server)
+    )
+
+
+@shared_task(bind=True, base=QueueOnce)
+def remove_server_users(self, server_id, user_ids):
+    """Remove a batch of users' accounts from a server
+
+    The accounts are deleted and the server's outbox drained straight away,
+    a removal that fails is left in the outbox and retried from there.
+
+    Returns:
+    - dict of user_id to `{"deregistered": bool, "error": str}`, an account
+      not deregistered yet has the outbox entry's last error, if any
+    """
+    server = get_server(server_id)
+    accounts = list(server.mumbleverseserveruser_set.filter(user_id__in=user_ids))
+    if not accounts:
+        return {}
+    outbox.remove_accounts(accounts, schedule=False)
+    drain_outbox(server_id)
+    pending = {
+        payload["uid"]: error for payload, error in MumbleverseOutbox.objects.filter(
+            server_id=server_id,
+            operation=MumbleverseOutbox.REMOVE_USER,
+            payload__uid__in=[a.uid for a in accounts]
+        ).values_list("payload", "last_error")
+    }
+    report = {
+        a.user_id: {"deregistered": a.uid not in pending, "error": pending.get(a.uid)}
+        for a in accounts
+    }
+    failed = [user_id for user_id, r in report.items() if not r["deregistered"]]
+    if failed:
+        logger.warning(f"Users {failed} not removed from mumble server {server_id} yet, left in the outbox")
+    return report
+
+
+def queue_removals(server_id, user_ids):
+    """Split users to remove from a server into batched removal tasks"""
+    size = app_settings.MUMBLEVERSE_REMOVAL_BATCH_SIZE
+    for i in range(0, len(user_ids), size):
+        remove_server_users.delay(server_id, user_ids[i:i + size])
 
 
 @shared_task(bind=True, base=QueueOnce)
 def check_all_users_in_server(self, server_id):
-    server = MumbleverseServer.objects.get(id=server_id)
-    users = server.mumbleverseserveruser_set.all()
-    for u in users:
-        if not MumbleverseServer.user_can_access_server(u.user, server):
-            disable_server_user.delay(server.id, u.user.id)
-        # else:
-        #     print(f"pass {u}")
+    server = get_server(server_id)
+    queue_removals(
+        server.id,
+        list(accounts_without_access(server).values_list("user_id", flat=True))
+    )
+
+
+@shared_task(bind=True, base=QueueOnce)
+def check_users_in_server(self, server_id, user_ids):
+    """Audit just these users' accounts on a server"""
+    server = get_server(server_id)
+    queue_removals(
+        server.id,
+        list(accounts_without_access(server).filter(user_id__in=user_ids).values_list("user_id", flat=True))
+    )
+
+
+@shared_task(bind=True, base=QueueOnce)
+def check_user_all_servers(self, user_id):
+    """Audit one user's accounts on every server"""
+    try:
+        user = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        return
+    revoked = MumbleverseServerUser.objects.filter(
+        user=user
+    ).exclude(
+        server__in=MumbleverseServer.objects.visible_to(user)
+    ).values_list("server_id", flat=True)
+    for server_id in revoked:
+        remove_server_users.delay(server_id, [user_id])
 
 
 @shared_task(bind=True, base=QueueOnce)
 def check_users_in_all_server(self):
-    servers = MumbleverseServer.objects.all()
-    for server in servers:
-        check_all_users_in_server.delay(server.id)
+    """Audit every server, then remove revoked accounts from all servers at once"""
+    accounts = list(MumbleverseServerUser.objects.all())
+    visible = MumbleverseServer.objects.visible_to_users({a.user_id for a in accounts})
+    revoked = [a for a in accounts if a.server_id not in visible[a.user_id]]
+    if not revoked:
+        return
+    # each server's outbox drains on its own worker
+    outbox.remove_accounts(revoked)
+    logger.info(f"Removing {len(revoked)} accounts from {len({a.server_id for a in revoked})} servers")
+
+
+@shared_task(bind=True, base=QueueOnce)
+def update_all_server_groups(self):
+    """Push group membership to every server at once
+
+    This is the reconcile for anything missed or changed on the server, so
+    it is always sent, even when it matches the last push.
+    """
+    payloads = {}
+    fingerprints = {}
+    for server in get_servers():
+        payloads[server] = build_group_payload(server)
+        fingerprints[server] = group_fingerprint(payloads[server])
+    if not payloads:
+        return
+
+    results = async_provider.run(
+        async_provider.gather_servers(
+            list(payloads),
+            lambda s: async_provider.set_groups(s, payloads[s])
+        )
+    )
+    failed = []
+    for server, fingerprint in fingerprints.items():
+        if results[server.id] is not False:
+            remember_groups(server, fingerprint)
+        else:
+            failed.append(server.id)
+            # retried from the outbox like any other group update
+            outbox.enqueue(server.id, MumbleverseOutbox.SYNC_GROUPS, [{}])
+    if failed:
+        logger.error(f"Failed to update groups on servers {failed}")
+
+
+@shared_task(bind=True, base=QueueOnce)
+def probe_server_health(self):
+    """Health check every server whose breaker isn't closed"""
+    for server in get_servers():
+        if breaker.get_state(server.id) == breaker.CLOSED:
+            continue
+        if health_check(server):
+            breaker.record_success(server.id)
+        else:
+            breaker.record_failure(server.id)
+
+
+@shared_task(bind=True)
+def drain_outbox(self, server_id):
+    """Send a server's outbox, coming back later if an entry fails"""
+    try:
+        server = get_server(server_id)
+    except MumbleverseServer.DoesNotExist:
+        return
+    failed = outbox.drain(server)
+    if failed is None:
+        return
+    policy = get_policy(server, outbox.POLICY_OPERATIONS[failed.operation])
+    if failed.attempts <= policy.task_retries:
+        logger.warning(f"Failed to send {failed} after {failed.attempts} attempts: {failed.last_error}")
+        drain_outbox.apply_async(
+            args=[server_id],
+            countdown=retry_countdown(policy, failed.attempts - 1)
+        )
+    else:
+        # out of retries, park it and carry on with the rest
+        deadletter.bury(failed)
+        drain_outbox.delay(server_id)
+
+
+@shared_task(bind=True, base=QueueOnce)
+def drain_all_outboxes(self):
+    """Drain every server with something waiting, in case a drain was lost"""
+    for server_id in MumbleverseOutbox.objects.values_list("server_id", flat=True).distinct():
+        drain_outbox.delay(server_id)
+
+
+@shared_task(bind=True, base=QueueOnce)
+def rebuild_access_index(self):
+    added, removed = MumbleverseServerAccess.objects.rebuild()
+    logger.info(f"Rebuilt access index +{added} -{removed}")
+
+
+def activate_account(server_id, user_id, password=None):
+    """Register the user on a server, the account is only saved once that worked"""
+    server = get_server(server_id)
+    user = User.objects.get(id=user_id)
+    username = MumbleverseServerUser.objects.get_display_name(user)
+    password = MumbleverseServerUser.objects.generate_random_pass()
+    try:
+        # a removal of their old account can't run until this one is saved
+        with outbox.account_lock(server_id, username):
+            data = register_user(server, username, password)
+            if not data:
+                deadletter.record(
+                    server_id,
+                    MumbleverseDeadLetter.REGISTER_USER,
+                    {"user_id": user_id, "username": username},
+                    "Failed to register"
+                )
+                return {"status": "failed"}
+            with transaction.atomic():
+                MumbleverseServerUser.objects.update_or_create(
+                    server=server,
+                    user=user,
+                    defaults={"uid": data["user_id"], "username": username}
+                )
+                outbox.sync_account_groups(server_id, user_id)
+    except outbox.AccountLocked:
+        logger.warning(f"{username} is still being removed from {server}, not activating {user}")
+        return {"status": "failed"}
+    return {
+        "status": "done",
+        "service": server.name,
+        "credentials": {"username": username, "password": password},
+    }
+
+
+def _update_credentials(account, password):
+    """Update an account's credentials, syncing its groups only if it got a new uid"""
+    uid = str(account.uid)
+    if not account.update_credentials(password):
+        return False
+    # the api calls are done, only the row writes need the transaction
+    with transaction.atomic():
+        account.save()
+        if str(account.uid) != uid:
+            outbox.sync_account_groups(account.server_id, account.user_id)
+    return True
+
+
+def reset_account(server_id, user_id, password=None):
+    account = MumbleverseServerUser.objects.select_related("server", "user").get(
+        server_id=server_id,
+        user_id=user_id
+    )
+    account.reset_password()
+    if not _update_credentials(account, account.credentials["password"]):
+        return {"status": "failed"}
+    # the username may have changed
+    account.credentials["username"] = account.username
+    return {"status": "done", "service": account.server.name, "credentials": account.credentials}
+
+
+def set_account_password(server_id, user_id, password=None):
+    if not password:
+        return {"status": "failed"}
+    account = MumbleverseServerUser.objects.select_related("server", "user").get(
+        server_id=server_id,
+        user_id=user_id
+    )
+    if not _update_credentials(account, password):
+        return {"status": "failed"}
+    return {"status": "done", "service": account.server.name}
+
+
+def activate_all_accounts(server_id, user_id, password=None):
+    """Activate every server the user can see but has no account on
+
+    Registers on all of them at once with one new password, then queues the
+    user's groups on each of them.
+    """
+    user = User.objects.get(id=user_id)
+    servers = list(
+        MumbleverseServer.objects.visible_to(user).exclude(mumbleverseserveruser__user=user)
+    )
+    if not servers:
+        return {"status": "done"}
+    username = MumbleverseServerUser.objects.get_display_name(user)
+    password = MumbleverseServerUser.objects.generate_random_pass()
+    with ExitStack() as locks:
+        # don't wait on anything, servers still removing this account are reported back
+        locked = []
+        for server in servers:
+            try:
+                locks.enter_context(outbox.account_lock(server.id, username, wait=0))
+                locked.append(server)
+            except outbox.AccountLocked:
+                pass
+        results = async_provider.run(
+            async_provider.gather_servers(
+                locked,
+                lambda s: async_provider.register_user(s, username, password)
+            )
+        )
+        activated = [s for s in locked if results[s.id]]
+        failed = [s for s in servers if s not in activated]
+        for server in locked:
+            if not results[server.id]:
+                deadletter.record(
+                    server.id,
+                    MumbleverseDeadLetter.REGISTER_USER,
+                    {"user_id": user_id, "username": username},
+                    "Failed to register"
+                )
+        if not activated:
+            return {"status": "failed"}
+        with transaction.atomic():
+            MumbleverseServerUser.objects.bulk_create([
+                MumbleverseServerUser(server=s, user=user, uid=results[s.id]["user_id"], username=username)
+                for s in activated
+            ])
+            for server in activated:
+                outbox.sync_account_groups(server.id, user_id)
+    names = ", ".join(s.name for s in activated)
+    return {
+        "status": "done",
+        "service": names,
+        "credentials": {"username": username, "password": password, "servers": names},
+        "failed": [s.name for s in failed],
+    }
+
+
+def deactivate_account(server_id, user_id, password=None):
+    account = MumbleverseServerUser.objects.select_related("server").get(
+        server_id=server_id,
+        user_id=user_id
+    )
+    outbox.remove_accounts([account], f"{account.username} deactivated by Auth")
+    return {"status": "done", "service": account.server.name}
+
+
+ACCOUNT_OPERATIONS = {
+    "activate": activate_account,
+    "activate_all": activate_all_accounts,
+    "reset": reset_account,
+    "set": set_account_password,
+    "deactivate": deactivate_account,
+}
+
+
+def run_account_operation(operation, server_id, user_id, password=None):
+    """Run a user's account operation, the same way inline or in a task
+
+    Returns:
+    - dict with `status` of "done" or "failed", plus the `service` name and
+      any new `credentials` when done
+    """
+    try:
+        result = ACCOUNT_OPERATIONS[operation](server_id, user_id, password)
+    except (MumbleverseServer.DoesNotExist, MumbleverseServerUser.DoesNotExist):
+        result = {"status": "failed"}
+    except HTTPError as error:
+        logger.error(f"Failed to {operation} user on mumble server api - {server_id} - {user_id}")
+        logger.error(f"{error.request} - {error.args}")
+        result = {"status": "failed"}
+    result["operation"] = operation
+    return result
+
+
+def _account_operation_key(operation_id, part="status"):
+    return f"mumbleverse:account_operation:{operation_id}:{part}"
+
+
+def start_account_operation(operation, server_id, user_id, password=None):
+    """Hand an account operation to a worker, poll it with `get_account_operation`
+
+    A password is passed to the worker through the cache rather than the
+    broker, the worker deletes it as soon as it's read.
+
+    Returns:
+    - the operation id
+    """
+    operation_id = uuid4().hex
+    timeout = app_settings.MUMBLEVERSE_ACCOUNT_OPERATION_TTL
+    cache.set(
+        _account_operation_key(operation_id),
+        {"status": "pending", "operation": operation, "user_id": user_id},
+        timeout=timeout
+    )
+    if password:
+        cache.set(_account_operation_key(operation_id, "password"), password, timeout=timeout)
+    account_operation.delay(operation_id, operation, server_id, user_id)
+    return operation_id
+
+
+def get_account_operation(operation_id, user_id):
+    """Get an operation's status, None if it's unknown, expired or not this user's"""
+    result = cache.get(_account_operation_key(operation_id))
+    if result is None or result["user_id"] != user_id:
+        return None
+    return result
+
+
+def forget_account_operation(operation_id):
+    """Drop a finished operation once it's been shown
+
+    Returns:
+    - the credentials it made, if any, they can only be taken once
+    """
+    credentials_key = _account_operation_key(operation_id, "credentials")
+    credentials = cache.get(credentials_key)
+    cache.delete_many([_account_operation_key(operation_id), credentials_key])
+    return credentials
+
+
+@shared_task(bind=True)
+def account_operation(self, operation_id, operation, server_id, user_id):
+    password_key = _account_operation_key(operation_id, "password")
+    password = cache.get(password_key)
+    cache.delete(password_key)
+    result = run_account_operation(operation, server_id, user_id, password)
+    timeout = app_settings.MUMBLEVERSE_ACCOUNT_OPERATION_TTL
+    # the status can be read until it expires, the credentials only once
+    credentials = result.pop("credentials", None)
+    if credentials is not None:
+        cache.set(_account_operation_key(operation_id, "credentials"), credentials, timeout=timeout)
+    result["user_id"] = user_id
+    cache.set(_account_operation_key(operation_id), result, timeout=timeout)
@@ -1,5 +1,10 @@
+# Standard Library
+from io import StringIO
+from unittest.mock import patch
+
 # Django
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission, User
+from django.core.management import call_command
 from django.test import TestCase
 
 # Alliance Auth
@@ -8,10 +13,17 @@ from allianceauth.eveonline.models import (
     EveAllianceInfo,
     EveCharacter,
     EveCorporationInfo,
+    EveFactionInfo,
 )
 from allianceauth.tests.auth_utils import AuthUtils
 
-from ..models import MumbleverseServer
+from .. import app_settings
+from ..models import (
+    MumbleverseServer,
+    MumbleverseServerAccess,
+    MumbleverseServerUser,
+)
+from ..tasks import accounts_without_access
 
 
 def create_char(char_id, char_name, corp=None):
@@ -267,3 +279,208 @@ class TestAccessPerms(TestCase):
         self.assertFalse(
             MumbleverseServer.user_can_access_server(self.user1, self.server_1_no_perms_at_all.id)
         )
+
+    def assertUsersWithAccessMatch(self):
+        users = [self.user1, self.user2, self.user3, self.user4]
+        for server in [self.server_1_no_perms_at_all, self.server_2_with_perms]:
+            expected = {
+                u.id for u in users
+                if MumbleverseServer.objects.visible_to(User.objects.get(id=u.id)).filter(id=server.id).exists()
+            }
+            self.assertEqual(
+                set(MumbleverseServer.objects.users_with_access(server).values_list("id", flat=True)),
+                expected
+            )
+
+    def assertACLMatch(self):
+        users = [self.user1, self.user2, self.user3, self.user4]
+        expected = {
+            u.id: set(MumbleverseServer.objects.visible_to(User.objects.get(id=u.id)).values_list("id", flat=True))
+            for u in users
+        }
+        self.assertEqual(MumbleverseServer.objects.visible_to_users(users), expected)
+
+    def test_acl_parity(self):
+        self.assertACLMatch()
+
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        self.server_2_with_perms.alliance_access.add(self.alli2)
+        self.server_1_no_perms_at_all.corporation_access.add(self.corp1)
+        self.assertACLMatch()
+
+        group = Group.objects.create(name="group")
+        self.user2.groups.add(group)
+        self.server_1_no_perms_at_all.group_access.add(group)
+        self.server_2_with_perms.state_access.add(guest)
+        self.assertACLMatch()
+
+        faction = EveFactionInfo.objects.create(faction_id=500001, faction_name="faction")
+        self.char3.faction_id = faction.faction_id
+        self.char3.save()
+        guest.permissions.remove(self.access_perm)
+        self.user2.user_permissions.add(self.access_perm)
+        self.user1.user_permissions.add(self.access_perm, self.all_servers_perm)
+        self.server_1_no_perms_at_all.faction_access.add(faction)
+        self.server_2_with_perms.character_access.add(self.char3)
+        self.assertACLMatch()
+
+        self.user1.is_active = False
+        self.user1.save()
+        self.assertACLMatch()
+
+    def test_acl_queries(self):
+        State.objects.get(name="Guest").permissions.add(self.access_perm)
+        with self.assertNumQueries(11):
+            MumbleverseServer.objects.visible_to_users([self.user1])
+        user_ids = list(User.objects.values_list("id", flat=True))
+        with self.assertNumQueries(11):
+            MumbleverseServer.objects.visible_to_users(user_ids)
+
+    def test_users_with_access(self):
+        self.assertUsersWithAccessMatch()
+
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        self.server_2_with_perms.alliance_access.add(self.alli1)
+        self.server_2_with_perms.corporation_access.add(self.corp1)
+        self.assertUsersWithAccessMatch()
+
+        group = Group.objects.create(name="group")
+        self.user3.groups.add(group)
+        self.server_1_no_perms_at_all.group_access.add(group)
+        self.assertUsersWithAccessMatch()
+
+        self.server_1_no_perms_at_all.character_access.add(self.char1)
+        self.user2.user_permissions.add(self.all_servers_perm)
+        self.assertUsersWithAccessMatch()
+
+        guest.permissions.remove(self.access_perm)
+        group.permissions.add(self.access_perm)
+        self.assertUsersWithAccessMatch()
+
+    def test_access_index(self):
+        member = State.objects.get(name="Member")
+        member.permissions.add(self.access_perm)
+        member.member_characters.add(self.char1)  # main u1
+
+        with patch.object(app_settings, "MUMBLEVERSE_ACCESS_INDEX", True), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.server_2_with_perms.state_access.add(member)
+
+        self.assertEqual(
+            list(MumbleverseServerAccess.objects.values_list("user_id", "server_id")),
+            [(self.user1.id, self.server_2_with_perms.id)]
+        )
+        with patch.object(app_settings, "MUMBLEVERSE_ACCESS_INDEX", True):
+            with self.assertNumQueries(1):
+                self.assertTrue(
+                    MumbleverseServer.user_can_access_server(self.user1, self.server_2_with_perms)
+                )
+            self.assertFalse(
+                MumbleverseServer.user_can_access_server(self.user1, self.server_1_no_perms_at_all)
+            )
+
+            # user loses their main character
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user1.profile.main_character = None
+                self.user1.profile.save()
+            self.assertFalse(
+                MumbleverseServer.user_can_access_server(self.user1, self.server_2_with_perms)
+            )
+
+    def test_access_index_new_server(self):
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        self.user2.user_permissions.add(self.all_servers_perm)
+
+        with patch.object(app_settings, "MUMBLEVERSE_ACCESS_INDEX", True), \
+                self.captureOnCommitCallbacks(execute=True):
+            server = MumbleverseServer.objects.create(name="server 3 test")
+
+        self.assertEqual(
+            list(MumbleverseServerAccess.objects.values_list("user_id", "server_id")),
+            [(self.user2.id, server.id)]
+        )
+
+    def test_access_index_rebuild(self):
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        self.server_2_with_perms.corporation_access.add(self.corp1)
+        MumbleverseServerAccess.objects.create(user=self.user3, server=self.server_2_with_perms)
+
+        self.assertEqual(MumbleverseServerAccess.objects.rebuild(), (1, 1))
+        self.assertEqual(
+            list(MumbleverseServerAccess.objects.values_list("user_id", "server_id")),
+            [(self.user1.id, self.server_2_with_perms.id)]
+        )
+
+    def test_access_index_command(self):
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        self.server_2_with_perms.corporation_access.add(self.corp1)
+
+        out = StringIO()
+        call_command("mumbleverse_access_index", "--check", stdout=out)
+        self.assertIn("1 users do not match", out.getvalue())
+
+        out = StringIO()
+        call_command("mumbleverse_access_index", stdout=out)
+        self.assertIn("added 1 removed 0", out.getvalue())
+        self.assertIn("matches the live access rules", out.getvalue())
+
+    def test_visible_to_one_query(self):
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        group = Group.objects.create(name="group")
+        self.user1.groups.add(group)
+        self.server_2_with_perms.corporation_access.add(self.corp1)
+        self.server_2_with_perms.group_access.add(group)
+        self.server_2_with_perms.state_access.add(guest)
+
+        for user, expected in [
+            (self.user1, [self.server_2_with_perms]),
+            (self.user4, []),  # no main
+        ]:
+            user = User.objects.get(id=user.id)
+            user.has_perm("mumbleverse.global_access")  # load the perm cache
+            with self.assertNumQueries(1):
+                self.assertEqual(list(MumbleverseServer.objects.visible_to(user)), expected)
+
+        self.user1.user_permissions.add(self.all_servers_perm)
+        user = User.objects.get(id=self.user1.id)
+        user.has_perm("mumbleverse.global_access")
+        with self.assertNumQueries(1):
+            self.assertEqual(MumbleverseServer.objects.visible_to(user).count(), 2)
+
+    def test_accounts_without_access(self):
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(self.access_perm)
+        group = Group.objects.create(name="group")
+        self.user3.groups.add(group)
+        self.server_2_with_perms.corporation_access.add(self.corp1)
+        self.server_2_with_perms.group_access.add(group)
+        for i, user in enumerate([self.user1, self.user2, self.user3, self.user4]):
+            MumbleverseServerUser.objects.create(
+                server=self.server_2_with_perms, user=user, uid=str(i), username=user.username
+            )
+            MumbleverseServerUser.objects.create(
+                server=self.server_1_no_perms_at_all, user=user, uid=str(i), username=user.username
+            )
+
+        with self.assertNumQueries(1):
+            revoked = list(accounts_without_access(self.server_2_with_perms))
+        self.assertCountEqual([a.user_id for a in revoked], [self.user2.id, self.user4.id])
+        self.assertCountEqual(
+            revoked,
+            [
+                a for a in self.server_2_with_perms.mumbleverseserveruser_set.all()
+                if not MumbleverseServer.user_can_access_server(User.objects.get(id=a.user_id), a.server_id)
+            ]
+        )
+
+        self.user2.user_permissions.add(self.all_servers_perm)
+        self.assertCountEqual(
+            accounts_without_access(self.server_1_no_perms_at_all).values_list("user_id", flat=True),
+            [self.user1.id, self.user3.id, self.user4.id]
+        )
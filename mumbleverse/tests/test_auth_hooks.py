@@ -0,0 +1,98 @@
+# Standard Library
+from unittest.mock import patch
+
+# Django
+from django.contrib.auth.models import Permission, User
+from django.test import RequestFactory, TestCase
+
+# Alliance Auth
+from allianceauth.authentication.models import State
+from allianceauth.eveonline.models import EveCorporationInfo
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import auth_hooks
+from ..auth_hooks import MumbleverseService
+from ..models import MumbleverseServer, MumbleverseServerUser
+from .test_access import create_char
+
+
+def make_hook(server):
+    return type(
+        f"MumbleverseServiceTest{server.id}",
+        (MumbleverseService,), {},
+        sid=server.id,
+        server_name=server.name
+    )
+
+
+class TestServicesPage(TestCase):
+
+    def setUp(self):
+        corp = EveCorporationInfo.objects.create(
+            corporation_id=1,
+            corporation_name="corp",
+            corporation_ticker="CORP",
+            member_count=1
+        )
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(
+            Permission.objects.get_by_natural_key("basic_access", "mumbleverse", "general")
+        )
+        user = AuthUtils.create_user("user")
+        user.profile.main_character = create_char(1, "char", corp=corp)
+        user.profile.save()
+        self.user = user
+        self.hooks = []
+        self.add_servers(3)
+
+    def add_servers(self, count):
+        for _ in range(count):
+            server = MumbleverseServer.objects.create(name=f"server {len(self.hooks)}", mumble_url="mumble.test")
+            if len(self.hooks) % 2:
+                server.corporation_access.add(EveCorporationInfo.objects.get(corporation_id=1))
+                MumbleverseServerUser.objects.create(
+                    server=server, user=self.user, uid=str(len(self.hooks)), username="user"
+                )
+            self.hooks.append(make_hook(server))
+
+    def get_request(self):
+        request = RequestFactory().get("/services/")
+        request.user = User.objects.get(id=self.user.id)
+        request.user.has_perm("mumbleverse.basic_access")  # the menu has loaded perms already
+        return request
+
+    def render_page(self, request):
+        """What the services page does with each hook"""
+        rendered = []
+        for hook in self.hooks:
+            svc = hook()
+            if svc.service_active_for_user(request.user):
+                rendered.append(svc.render_services_ctrl(request))
+        return rendered
+
+    def test_queries_constant_per_page(self):
+        request = self.get_request()
+        with self.assertNumQueries(2):
+            rendered = self.render_page(request)
+        self.assertEqual(len(rendered), 1)
+        self.assertIn("mumble://user@mumble.test", rendered[0])
+
+        self.add_servers(20)
+        request = self.get_request()
+        with self.assertNumQueries(2):
+            rendered = self.render_page(request)
+        self.assertEqual(len(rendered), 11)
+
+    def test_validate_user_uses_fresh_access(self):
+        svc = self.hooks[1]()
+        user = User.objects.get(id=self.user.id)
+        self.assertTrue(svc.service_active_for_user(user))
+        MumbleverseServer.objects.get(id=svc.sid).corporation_access.clear()
+        with patch.object(auth_hooks.disable_server_user, "delay") as delay:
+            svc.validate_user(user)
+        delay.assert_called_once_with(svc.sid, user.id)
+
+        # no account, nothing to remove
+        with patch.object(auth_hooks.disable_server_user, "delay") as delay:
+            self.hooks[0]().validate_user(user)
+        delay.assert_not_called()
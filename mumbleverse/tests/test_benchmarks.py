@@ -0,0 +1,141 @@
+"""
+Benchmarks, not run by default.
+
+MUMBLEVERSE_BENCHMARK=1 python runtests.py mumbleverse.tests.test_benchmarks
+
+Sizes can be set with MUMBLEVERSE_BENCHMARK_SERVERS and MUMBLEVERSE_BENCHMARK_USERS.
+"""
+
+# Standard Library
+import os
+import random
+import time
+from unittest import skipUnless
+
+# Django
+from django.apps import apps
+from django.contrib.auth.models import Group, Permission, User
+from django.test import TestCase
+
+# Alliance Auth
+from allianceauth.authentication.models import State, UserProfile
+from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo
+
+from .. import registry
+from ..models import MumbleverseServer, MumbleverseServerUser
+from ..tasks import accounts_without_access
+
+SERVERS = int(os.environ.get("MUMBLEVERSE_BENCHMARK_SERVERS", 100))
+USERS = int(os.environ.get("MUMBLEVERSE_BENCHMARK_USERS", 50000))
+
+
+def timed(label, func, runs=1):
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = func()
+    taken = (time.perf_counter() - start) / runs
+    print(f"\n{label}: {taken * 1000:.2f}ms")
+    return result
+
+
+@skipUnless(os.environ.get("MUMBLEVERSE_BENCHMARK"), "Set MUMBLEVERSE_BENCHMARK=1 to run benchmarks")
+class BenchmarkAccess(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        random.seed(1)
+        perm = Permission.objects.get_by_natural_key("basic_access", "mumbleverse", "general")
+        guest = State.objects.get(name="Guest")
+        guest.permissions.add(perm)
+
+        corps = EveCorporationInfo.objects.bulk_create([
+            EveCorporationInfo(
+                corporation_id=c,
+                corporation_name=f"corp {c}",
+                corporation_ticker=f"C{c}",
+                member_count=1,
+            ) for c in range(1, 201)
+        ])
+        groups = Group.objects.bulk_create([Group(name=f"group {g}") for g in range(50)])
+
+        User.objects.bulk_create([User(username=f"bench{u}") for u in range(USERS)])
+        users = list(User.objects.filter(username__startswith="bench"))
+        EveCharacter.objects.bulk_create([
+            EveCharacter(
+                character_id=1000000 + u.id,
+                character_name=f"bench {u.id}",
+                corporation_id=random.choice(corps).corporation_id,
+                corporation_name="corp",
+                corporation_ticker="C",
+                alliance_id=random.randint(1, 20),
+            ) for u in users
+        ])
+        chars = {c.character_id: c for c in EveCharacter.objects.filter(character_id__gte=1000000)}
+        UserProfile.objects.filter(user__in=users).delete()
+        UserProfile.objects.bulk_create([
+            UserProfile(user=u, main_character=chars[1000000 + u.id], state=guest) for u in users
+        ])
+        User.groups.through.objects.bulk_create([
+            User.groups.through(user_id=u.id, group_id=random.choice(groups).id) for u in users
+        ])
+
+        for s in range(SERVERS):
+            server = MumbleverseServer.objects.create(name=f"server {s}")
+            server.corporation_access.add(*random.sample(corps, 5))
+            server.group_access.add(*random.sample(groups, 2))
+        cls.users = random.sample(users, 100)
+
+    def test_visible_to(self):
+        print(f"\n{SERVERS} servers x {USERS} users")
+
+        def _visible():
+            for u in self.users:
+                user = User.objects.get(id=u.id)
+                list(MumbleverseServer.objects.visible_to(user).values_list("id", flat=True))
+
+        timed("visible_to, 100 users (incl perm lookups)", _visible)
+        timed(
+            "visible_to_users, 100 users",
+            lambda: MumbleverseServer.objects.visible_to_users([u.id for u in self.users])
+        )
+        user_ids = list(User.objects.values_list("id", flat=True))
+        timed(
+            f"visible_to_users, {len(user_ids)} users",
+            lambda: MumbleverseServer.objects.visible_to_users(user_ids)
+        )
+
+        server = MumbleverseServer.objects.first()
+        count = timed(
+            "users_with_access, 1 server",
+            lambda: MumbleverseServer.objects.users_with_access(server).count()
+        )
+        print(f"{count} users on {server}")
+
+    def test_audit(self):
+        server = MumbleverseServer.objects.first()
+        MumbleverseServerUser.objects.bulk_create([
+            MumbleverseServerUser(server=server, user_id=u, uid=str(u), username=str(u))
+            for u in User.objects.filter(username__startswith="bench").values_list("id", flat=True)
+        ])
+        count = timed(
+            f"accounts_without_access, {USERS} accounts",
+            lambda: len(list(accounts_without_access(server)))
+        )
+        print(f"{count} accounts to remove from {server}")
+
+
+@skipUnless(os.environ.get("MUMBLEVERSE_BENCHMARK"), "Set MUMBLEVERSE_BENCHMARK=1 to run benchmarks")
+class BenchmarkStartup(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        MumbleverseServer.objects.bulk_create([MumbleverseServer(name=f"server {s}") for s in range(SERVERS)])
+
+    def tearDown(self):
+        MumbleverseServer.objects.all().delete()
+        registry.reload()
+
+    def test_startup(self):
+        print(f"\n{SERVERS} servers")
+        timed("ready()", apps.get_app_config("mumbleverse").ready, runs=10)
+        timed("first request, load servers and register hooks", registry.reload, runs=10)
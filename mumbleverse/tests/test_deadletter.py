@@ -0,0 +1,118 @@
+# Standard Library
+from io import StringIO
+from unittest.mock import patch
+
+# Django
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+# Alliance Auth
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import deadletter, outbox, tasks
+from ..models import (
+    MumbleverseDeadLetter,
+    MumbleverseOutbox,
+    MumbleverseServer,
+    MumbleverseServerUser,
+)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TestDeadLetters(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble")
+        self.user = AuthUtils.create_user("user")
+        self.account = MumbleverseServerUser.objects.create(
+            server=self.server, user=self.user, uid="5", username="user"
+        )
+
+    @patch.object(tasks.drain_outbox, "delay")
+    def test_buried_after_task_retries(self, delay):
+        outbox.remove_accounts([self.account])
+        MumbleverseOutbox.objects.update(attempts=tasks.app_settings.MUMBLEVERSE_API_TASK_RETRIES)
+        with patch.object(outbox, "_send_removals", return_value={MumbleverseOutbox.objects.get().id: "down"}), \
+                self.assertLogs("mumbleverse.deadletter", level="ERROR"):
+            tasks.drain_outbox(self.server.id)
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+        letter = MumbleverseDeadLetter.objects.get()
+        self.assertEqual(letter.operation, MumbleverseOutbox.REMOVE_USER)
+        self.assertEqual(letter.payload["uid"], "5")
+        self.assertEqual(letter.error, "down")
+        self.assertEqual(letter.attempts, tasks.app_settings.MUMBLEVERSE_API_TASK_RETRIES + 1)
+        # the rest of the outbox carries on
+        delay.assert_called_once_with(self.server.id)
+
+    def test_failed_group_syncs_recorded_once(self):
+        outbox.enqueue(self.server.id, MumbleverseOutbox.SYNC_GROUPS, [{}, {}], schedule=False)
+        MumbleverseOutbox.objects.update(attempts=2, last_error="down")
+        with self.assertLogs("mumbleverse.deadletter", level="ERROR"):
+            for entry in MumbleverseOutbox.objects.order_by("id"):
+                deadletter.bury(entry)
+        letter = MumbleverseDeadLetter.objects.get()
+        self.assertEqual(letter.operation, MumbleverseOutbox.SYNC_GROUPS)
+        self.assertEqual(letter.attempts, 4)
+
+    @patch.object(tasks, "update_server_groups")
+    def test_failed_register_recorded(self, update_server_groups):
+        AuthUtils.add_main_character_2(self.user, "char", 1, corp_id=1, corp_name="corp", corp_ticker="CORP")
+        self.account.delete()
+        with patch.object(tasks, "register_user", return_value=False):
+            self.assertEqual(tasks.activate_account(self.server.id, self.user.id)["status"], "failed")
+        self.assertFalse(MumbleverseServerUser.objects.exists())
+        letter = MumbleverseDeadLetter.objects.get()
+        self.assertEqual(letter.operation, MumbleverseDeadLetter.REGISTER_USER)
+        self.assertEqual(letter.payload["user_id"], self.user.id)
+        self.assertNotIn("password", letter.payload)
+        self.assertFalse(letter.replayable)
+
+    def test_replay(self):
+        deadletter.record(self.server.id, MumbleverseOutbox.SYNC_GROUPS, {}, "down")
+        deadletter.record(self.server.id, MumbleverseOutbox.REMOVE_USER, {"uid": "9"}, "down")
+        deadletter.record(self.server.id, MumbleverseDeadLetter.REGISTER_USER, {"user_id": 1}, "down")
+        with patch.object(tasks.drain_outbox, "delay") as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            server_ids, skipped = deadletter.replay(MumbleverseDeadLetter.objects.order_by("id"))
+        self.assertEqual(server_ids, [self.server.id])
+        self.assertEqual(skipped, 1)
+        delay.assert_called_with(self.server.id)
+        self.assertEqual(
+            list(MumbleverseOutbox.objects.order_by("id").values_list("operation", "payload")),
+            [(MumbleverseOutbox.SYNC_GROUPS, {}), (MumbleverseOutbox.REMOVE_USER, {"uid": "9"})]
+        )
+        self.assertEqual(MumbleverseDeadLetter.objects.get().operation, MumbleverseDeadLetter.REGISTER_USER)
+
+    @patch.object(tasks.drain_outbox, "delay")
+    def test_replay_command(self, delay):
+        deadletter.record(self.server.id, MumbleverseOutbox.SYNC_GROUPS, {}, "down")
+        out = StringIO()
+        with patch.object(outbox, "sync_groups", return_value=True) as sync_groups, \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command("mumbleverse_replay_dead_letters", "--concurrency", "2", stdout=out)
+        sync_groups.assert_called_once_with(self.server)
+        delay.assert_not_called()
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+        self.assertFalse(MumbleverseDeadLetter.objects.exists())
+        self.assertIn("done", out.getvalue())
+
+    @patch.object(tasks.drain_outbox, "delay")
+    def test_admin_action(self, delay):
+        deadletter.record(self.server.id, MumbleverseOutbox.SYNC_GROUPS, {}, "down")
+        admin = AuthUtils.create_user("admin")
+        admin.is_staff = admin.is_superuser = True
+        admin.save()
+        self.client.force_login(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("admin:mumbleverse_mumbleversedeadletter_changelist"),
+                {
+                    "action": "replay_selected",
+                    "_selected_action": list(MumbleverseDeadLetter.objects.values_list("id", flat=True)),
+                }
+            )
+        delay.assert_called_once_with(self.server.id)
+        self.assertEqual(MumbleverseOutbox.objects.get().operation, MumbleverseOutbox.SYNC_GROUPS)
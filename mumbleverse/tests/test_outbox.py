@@ -0,0 +1,171 @@
+# Standard Library
+from contextlib import contextmanager
+from unittest.mock import patch
+
+# Django
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+
+# Alliance Auth
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import outbox, tasks
+from ..models import MumbleverseOutbox, MumbleverseServer, MumbleverseServerUser
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@patch.object(outbox, "sync_user_groups", return_value=True)
+@patch.object(outbox, "sync_groups", return_value=True)
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble")
+        self.users = [AuthUtils.create_user(f"user{i}") for i in range(3)]
+        self.accounts = [
+            MumbleverseServerUser.objects.create(server=self.server, user=u, uid=str(i), username=u.username)
+            for i, u in enumerate(self.users)
+        ]
+        self.removed = []
+
+    @contextmanager
+    def remove(self, failing=()):
+        """Stand in for the async removal, `failing` uids don't deregister"""
+        def _remove(server, accounts, reason, concurrency=None, on_done=None):
+            self.removed += [a.uid for a in accounts]
+            for a in accounts:
+                on_done(a)
+            return {a.id: {"kicked": True, "deregistered": a.uid not in failing} for a in accounts}
+        with patch.object(outbox.async_provider, "remove_accounts", _remove), \
+                patch.object(outbox.async_provider, "run", side_effect=lambda results: results):
+            yield
+
+    def test_removed_with_account(self, sync_groups, sync_user_groups):
+        with patch.object(outbox.MumbleverseServerUser.objects, "filter", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                outbox.remove_accounts([self.accounts[0]])
+        # nothing half done
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+        self.assertEqual(MumbleverseServerUser.objects.count(), 3)
+
+        with patch.object(tasks.drain_outbox, "delay") as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            outbox.remove_accounts([self.accounts[0]])
+        delay.assert_called_once_with(self.server.id)
+        self.assertEqual(MumbleverseServerUser.objects.count(), 2)
+        self.assertEqual(
+            MumbleverseOutbox.objects.get().payload,
+            {"username": "user0", "uid": "0", "reason": "Deactivated by Auth"}
+        )
+
+    def test_sent_in_order(self, sync_groups, sync_user_groups):
+        outbox.remove_accounts(self.accounts[:2])
+        outbox.sync_account_groups(self.server.id, self.users[2].id)
+        outbox.remove_accounts(self.accounts[2:])
+
+        with self.remove(failing={"1"}):
+            failed = outbox.drain(self.server)
+        self.assertEqual(self.removed, ["0", "1"])
+        self.assertEqual(failed.payload["uid"], "1")
+        self.assertEqual(failed.last_error, "Failed to deregister")
+        # nothing after the failure was sent
+        sync_user_groups.assert_not_called()
+        self.assertEqual(MumbleverseOutbox.objects.count(), 3)
+
+        self.removed.clear()
+        with self.remove():
+            self.assertIsNone(outbox.drain(self.server))
+        self.assertEqual(self.removed, ["1", "2"])
+        # their account is already gone, nothing to update
+        sync_user_groups.assert_not_called()
+        sync_groups.assert_not_called()
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+
+    def test_group_updates_merged(self, sync_groups, sync_user_groups):
+        for user in self.users[:2]:
+            outbox.sync_account_groups(self.server.id, user.id)
+        with self.assertNumQueries(2):
+            self.assertIsNone(outbox.drain(self.server))
+        sync_groups.assert_called_once_with(self.server)
+        sync_user_groups.assert_not_called()
+
+        outbox.sync_account_groups(self.server.id, self.users[0].id)
+        outbox.sync_account_groups(self.server.id, self.users[0].id)
+        outbox.drain(self.server)
+        sync_user_groups.assert_called_once_with(self.server, self.accounts[0])
+        self.assertEqual(sync_groups.call_count, 1)
+
+    def test_full_sync_queued(self, sync_groups, sync_user_groups):
+        outbox.sync_account_groups(self.server.id, self.users[0].id)
+        tasks.update_server_groups(self.server.id)
+        # merged with the update already waiting
+        sync_groups.assert_called_once_with(self.server)
+        sync_user_groups.assert_not_called()
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+
+        sync_groups.return_value = False
+        with patch.object(tasks.drain_outbox, "apply_async") as apply_async, \
+                self.assertLogs("mumbleverse.tasks", level="WARNING"):
+            tasks.update_server_groups(self.server.id)
+        apply_async.assert_called_once()
+        self.assertEqual(MumbleverseOutbox.objects.get().operation, MumbleverseOutbox.SYNC_GROUPS)
+
+    def test_reactivated_not_removed(self, sync_groups, sync_user_groups):
+        outbox.remove_accounts([self.accounts[0]])
+        MumbleverseServerUser.objects.create(server=self.server, user=self.users[0], uid="0", username="user0")
+        with self.remove():
+            self.assertIsNone(outbox.drain(self.server))
+        self.assertEqual(self.removed, [])
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+
+    @patch.object(outbox, "ACCOUNT_LOCK_WAIT", 0)
+    def test_removal_waits_for_registration(self, sync_groups, sync_user_groups):
+        outbox.remove_accounts(self.accounts[:2])
+        with outbox.account_lock(self.server.id, "user0"):
+            with self.remove():
+                failed = outbox.drain(self.server)
+            # only the account being registered is held up
+            self.assertEqual(self.removed, ["1"])
+            self.assertEqual(failed.payload["uid"], "0")
+            self.assertEqual(failed.last_error, "Waiting on a registration")
+
+        with self.remove():
+            self.assertIsNone(outbox.drain(self.server))
+        self.assertEqual(self.removed, ["1", "0"])
+        for username in ["user0", "user1"]:
+            self.assertIsNone(cache.get(outbox._account_lock_key(self.server.id, username)))
+
+    @patch.object(outbox, "ACCOUNT_LOCK_WAIT", 0)
+    def test_registration_waits_for_removal(self, sync_groups, sync_user_groups):
+        username = MumbleverseServerUser.objects.get_display_name(self.users[0])
+        with outbox.account_lock(self.server.id, username):
+            with patch.object(tasks, "register_user") as register_user, \
+                    self.assertLogs("mumbleverse.tasks", level="WARNING"):
+                self.assertEqual(tasks.activate_account(self.server.id, self.users[0].id), {"status": "failed"})
+            register_user.assert_not_called()
+
+            # other users carry on
+            with patch.object(tasks, "register_user", return_value={"user_id": 9}):
+                self.assertEqual(tasks.activate_account(self.server.id, self.users[1].id)["status"], "done")
+
+    def test_one_drain_per_server(self, sync_groups, sync_user_groups):
+        outbox.sync_account_groups(self.server.id, self.users[0].id)
+        cache.set(f"mumbleverse:outbox:{self.server.id}:lock", 1)
+        self.assertIsNone(outbox.drain(self.server))
+        sync_user_groups.assert_not_called()
+        self.assertTrue(cache.get(f"mumbleverse:outbox:{self.server.id}:dirty"))
+
+    def test_failed_drain_retried(self, sync_groups, sync_user_groups):
+        sync_user_groups.return_value = False
+        sync_groups.return_value = False
+        outbox.sync_account_groups(self.server.id, self.users[0].id)
+        with patch.object(tasks.drain_outbox, "apply_async") as apply_async, \
+                self.assertLogs("mumbleverse.tasks", level="WARNING"):
+            tasks.drain_outbox(self.server.id)
+        self.assertEqual(apply_async.call_args.kwargs["args"], [self.server.id])
+        self.assertEqual(MumbleverseOutbox.objects.get().attempts, 1)
+
+        with patch.object(tasks.drain_outbox, "delay") as delay:
+            tasks.drain_all_outboxes()
+        delay.assert_called_once_with(self.server.id)
@@ -0,0 +1,504 @@
+# Standard Library
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# Third Party
+from httpx import AsyncClient, Client, ConnectError, MockTransport, Response
+
+# Django
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+# Alliance Auth
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import app_settings, async_provider, breaker, policy, provider, registry
+from ..models import MumbleverseOutbox, MumbleverseServer, MumbleverseServerUser
+from ..tasks import (
+    get_group_sync_stats,
+    probe_server_health,
+    update_all_server_groups,
+)
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def mock_client(handler):
+    def _build(server):
+        return Client(headers={"key": server.api_key}, transport=MockTransport(handler))
+    return _build
+
+
+class TestClientPool(TestCase):
+
+    def setUp(self):
+        provider.reset_clients()
+        self.server_1 = MumbleverseServer.objects.create(
+            name="server 1", api_url="http://mumble-1", api_key="key1"
+        )
+        self.server_2 = MumbleverseServer.objects.create(
+            name="server 2", api_url="http://mumble-1", api_key="key1", mumble_virtual_server_id=2
+        )
+        self.server_3 = MumbleverseServer.objects.create(
+            name="server 3", api_url="http://mumble-3", api_key="key3"
+        )
+
+    def tearDown(self):
+        provider.reset_clients()
+
+    def test_client_reused_per_api(self):
+        c1 = provider.get_client(self.server_1)
+        self.assertIs(c1, provider.get_client(self.server_1))
+        self.assertIs(c1, provider.get_client(self.server_2))
+        self.assertIsNot(c1, provider.get_client(self.server_3))
+        self.assertEqual(c1.headers["key"], "key1")
+
+    def test_client_rebuilt_on_server_change(self):
+        c1 = provider.get_client(self.server_1)
+        c3 = provider.get_client(self.server_3)
+        self.server_1.api_key = "newkey"
+        self.server_1.save()
+        c2 = provider.get_client(self.server_1)
+        self.assertIsNot(c1, c2)
+        self.assertEqual(c2.headers["key"], "newkey")
+        # the registry reloading closes only the clients nothing uses
+        self.assertIn(provider.prune_clients, registry._listeners)
+        provider.prune_clients(MumbleverseServer.objects.all())
+        self.assertFalse(c1.is_closed)  # server 2 still uses it
+        self.assertFalse(c3.is_closed)
+
+        self.server_2.delete()
+        provider.prune_clients(MumbleverseServer.objects.all())
+        self.assertTrue(c1.is_closed)
+        self.assertFalse(c2.is_closed)
+        self.assertIs(c3, provider.get_client(self.server_3))
+
+    def test_calls_use_pooled_client(self):
+        seen = []
+
+        def handler(request):
+            seen.append(request)
+            return Response(200, json={"user_id": 5})
+
+        with patch.object(provider, "_build_client", mock_client(handler)):
+            self.assertEqual(provider.register_user(self.server_1, "bob", "pass"), {"user_id": 5})
+            self.assertTrue(provider.kick_username(self.server_2, "bob"))
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(seen[0].headers["key"], "key1")
+        self.assertEqual(seen[1].url.params["server_id"], "2")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TestGroupSync(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        provider.reset_clients()
+        self.server = MumbleverseServer.objects.create(
+            name="server", api_url="http://mumble", api_key="key"
+        )
+        self.groups = [Group.objects.create(name=f"group {i}") for i in range(4)]
+        for i in range(4):
+            user = AuthUtils.create_user(f"user{i}")
+            user.groups.add(self.groups[i], self.groups[0])
+            MumbleverseServerUser.objects.create(
+                server=self.server, user=user, uid=str(i + 1), username=f"user{i}"
+            )
+        self.posted = []
+        self.remote = None
+
+    def tearDown(self):
+        provider.reset_clients()
+
+    def handler(self, request):
+        if request.method == "GET":
+            if self.remote is None:
+                return Response(500)
+            return Response(200, json=self.remote)
+        self.posted.append(json.loads(request.content))
+        return Response(200, json={"status": "ok"})
+
+    def sync(self):
+        with patch.object(provider, "_build_client", mock_client(self.handler)):
+            return provider.sync_groups(self.server)
+
+    def test_payload_built_in_one_query(self):
+        with self.assertNumQueries(1):
+            payload = provider.build_group_payload(self.server)
+        self.assertEqual(payload, [
+            {"name": "group 0", "users": ["1", "2", "3", "4"]},
+            {"name": "group 1", "users": ["2"]},
+            {"name": "group 2", "users": ["3"]},
+            {"name": "group 3", "users": ["4"]},
+        ])
+
+        other = MumbleverseServer.objects.create(name="other", api_url="http://other", api_key="key")
+        for i in range(4, 50):
+            user = AuthUtils.create_user(f"user{i}")
+            user.groups.add(self.groups[1])
+            MumbleverseServerUser.objects.create(
+                server=self.server, user=user, uid=str(i + 1), username=f"user{i}"
+            )
+            MumbleverseServerUser.objects.create(
+                server=other, user=user, uid=str(i + 1000), username=f"user{i}"
+            )
+        with self.assertNumQueries(1):
+            payload = provider.build_group_payload(self.server)
+        self.assertEqual(len(payload[1]["users"]), 47)
+        self.assertNotIn("1004", payload[1]["users"])
+
+    def test_full_push_when_groups_unreadable(self):
+        self.assertTrue(self.sync())
+        self.assertEqual(len(self.posted[0]), 4)
+
+    def test_only_changed_groups_sent(self):
+        self.remote = [
+            {"name": "group 0", "users": [1, 2, 3, 4]},
+            {"name": "group 1", "users": [3]},
+            {"name": "group 2", "users": [3]},
+            {"name": "group 3", "users": [4]},
+            {"name": "Not An Auth Group", "users": [1]},
+        ]
+        self.assertTrue(self.sync())
+        self.assertEqual(self.posted[0], [{"name": "group 1", "users": ["2"]}])
+
+    def test_emptied_groups_cleared(self):
+        self.groups[3].user_set.remove(*self.groups[3].user_set.all())
+        self.remote = [
+            {"name": "group 0", "users": [1, 2, 3, 4]},
+            {"name": "group 1", "users": [2]},
+            {"name": "group 2", "users": [3]},
+            {"name": "group 3", "users": [4]},
+        ]
+        self.assertTrue(self.sync())
+        self.assertEqual(self.posted[0], [{"name": "group 3", "users": []}])
+
+    def test_nothing_sent_when_unchanged(self):
+        self.remote = provider.build_group_payload(self.server)
+        self.assertTrue(self.sync())
+        self.assertEqual(self.posted, [])
+
+    def test_unchanged_payload_not_sent(self):
+        self.remote = []
+        self.assertTrue(self.sync())
+        self.assertTrue(self.sync())
+        self.assertEqual(len(self.posted), 1)
+
+        self.groups[1].user_set.add(MumbleverseServerUser.objects.get(uid="1").user)
+        self.remote = self.posted[0]
+        self.assertTrue(self.sync())
+        self.assertEqual(self.posted[1], [{"name": "group 1", "users": ["1", "2"]}])
+        stats = get_group_sync_stats(self.server.id)
+        self.assertEqual(stats["group_push_sent"], 2)
+        self.assertEqual(stats["group_push_skipped"], 1)
+
+    def test_fingerprint_ignores_order(self):
+        self.assertEqual(
+            provider.group_fingerprint([{"name": "a", "users": [1, 2]}, {"name": "b", "users": []}]),
+            provider.group_fingerprint([{"name": "b", "users": []}, {"name": "a", "users": ["2", "1"]}]),
+        )
+        self.assertNotEqual(
+            provider.group_fingerprint([{"name": "a", "users": [1, 2]}]),
+            provider.group_fingerprint([{"name": "a", "users": [1]}]),
+        )
+
+    def test_user_groups_only_changed(self):
+        account = MumbleverseServerUser.objects.get(uid="2")
+        account.user.groups.remove(self.groups[1])
+        account.user.groups.add(self.groups[2])
+        self.remote = [
+            {"name": "group 0", "users": [1, 2, 3, 4]},
+            {"name": "group 1", "users": [2]},
+            {"name": "group 2", "users": [3]},
+            {"name": "group 3", "users": [4]},
+            {"name": "Not An Auth Group", "users": [2]},
+        ]
+        with patch.object(provider, "_build_client", mock_client(self.handler)), \
+                self.assertNumQueries(3):
+            self.assertTrue(provider.sync_user_groups(self.server, account))
+        self.assertEqual(self.posted[0], [
+            {"name": "group 2", "users": ["2", "3"]},
+            {"name": "group 1", "users": []},
+        ])
+
+    def test_user_groups_unreadable(self):
+        account = MumbleverseServerUser.objects.get(uid="2")
+        with patch.object(provider, "_build_client", mock_client(self.handler)):
+            self.assertFalse(provider.sync_user_groups(self.server, account))
+        self.assertEqual(self.posted, [])
+
+    def test_full_push_over_threshold(self):
+        self.remote = []
+        self.assertTrue(self.sync())
+        self.assertEqual(len(self.posted[0]), 4)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TestAsyncFanOut(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = [
+            MumbleverseServer.objects.create(
+                name=f"server {i}", api_url=f"http://mumble-{i}", api_key="key"
+            ) for i in range(3)
+        ]
+
+    def test_update_all_server_groups(self):
+        seen = []
+
+        def handler(request):
+            seen.append(request.url.host)
+            if request.url.host == "mumble-1":
+                return Response(500)
+            return Response(200, json={})
+
+        def _client(**kwargs):
+            return AsyncClient(transport=MockTransport(handler), **kwargs)
+
+        with patch.object(async_provider, "AsyncClient", _client), \
+                self.assertLogs("mumbleverse.tasks", level="ERROR") as logs:
+            update_all_server_groups()
+        self.assertCountEqual(seen, ["mumble-0", "mumble-1", "mumble-2"])
+        self.assertIn(str([self.servers[1].id]), logs.output[0])
+        self.assertEqual(
+            list(MumbleverseOutbox.objects.values_list("server_id", "operation")),
+            [(self.servers[1].id, MumbleverseOutbox.SYNC_GROUPS)]
+        )
+
+        # a full sync is sent even when the groups haven't changed
+        seen.clear()
+        with patch.object(async_provider, "AsyncClient", _client), \
+                self.assertLogs("mumbleverse.tasks", level="ERROR"):
+            update_all_server_groups()
+        self.assertCountEqual(seen, ["mumble-0", "mumble-1", "mumble-2"])
+
+    def test_gather_servers_isolates_errors(self):
+        async def _call(server):
+            if server == self.servers[0]:
+                raise ValueError("boom")
+            return server.name
+
+        with self.assertLogs("mumbleverse.async_provider", level="ERROR"):
+            results = async_provider.run(
+                async_provider.gather_servers(self.servers, _call, concurrency=2)
+            )
+        self.assertEqual(results[self.servers[0].id], False)
+        self.assertEqual(results[self.servers[2].id], "server 2")
+
+    def test_remove_accounts_isolates_errors(self):
+        accounts = [SimpleNamespace(id=i, username=f"user{i}", uid=str(i)) for i in range(3)]
+        done = []
+
+        async def _deregister(server, uid):
+            if uid == "1":
+                raise ValueError("boom")
+            return True
+
+        with patch.object(async_provider, "kick_username", return_value=True), \
+                patch.object(async_provider, "deregister_user", side_effect=_deregister), \
+                self.assertLogs("mumbleverse.async_provider", level="ERROR"):
+            results = async_provider.run(
+                async_provider.remove_accounts(self.servers[0], accounts, on_done=lambda a: done.append(a.id))
+            )
+        self.assertTrue(results[0]["deregistered"])
+        self.assertFalse(results[1]["deregistered"])
+        self.assertEqual(results[1]["error"], "ValueError('boom')")
+        self.assertTrue(results[2]["deregistered"])
+        # errored or not, every account is handed back
+        self.assertCountEqual(done, [0, 1, 2])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@patch.object(app_settings, "MUMBLEVERSE_BREAKER_THRESHOLD", 3)
+@patch.object(app_settings, "MUMBLEVERSE_BREAKER_COOLDOWN", 60)
+@patch.object(app_settings, "MUMBLEVERSE_API_MAX_RETRIES", 0)
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        provider.reset_clients()
+        self.server = MumbleverseServer.objects.create(
+            name="server", api_url="http://mumble", api_key="key"
+        )
+        self.calls = []
+        self.up = False
+
+    def tearDown(self):
+        provider.reset_clients()
+
+    def handler(self, request):
+        self.calls.append(request.url.path)
+        if not self.up:
+            raise ConnectError("down", request=request)
+        return Response(200, json={"user_id": 5})
+
+    def kick(self):
+        with patch.object(provider, "_build_client", mock_client(self.handler)), \
+                self.assertLogs("mumbleverse", level="WARNING"):
+            return provider.kick_username(self.server, "bob")
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.assertFalse(self.kick())
+        self.assertEqual(breaker.get_state(self.server.id), breaker.OPEN)
+
+    def test_opens_and_fails_fast(self):
+        self.open_breaker()
+        self.assertEqual(len(self.calls), 3)
+        self.assertFalse(self.kick())
+        self.assertEqual(len(self.calls), 3)
+        self.assertIn("opened 1 times", breaker.describe(self.server.id))
+
+    def test_success_resets_failures(self):
+        self.assertFalse(self.kick())
+        self.assertFalse(self.kick())
+        self.up = True
+        with patch.object(provider, "_build_client", mock_client(self.handler)):
+            self.assertTrue(provider.kick_username(self.server, "bob"))
+        self.up = False
+        self.assertFalse(self.kick())
+        self.assertEqual(breaker.get_state(self.server.id), breaker.CLOSED)
+
+    def test_half_open_single_trial(self):
+        self.open_breaker()
+        with patch.object(app_settings, "MUMBLEVERSE_BREAKER_COOLDOWN", 0):
+            self.assertEqual(breaker.get_state(self.server.id), breaker.HALF_OPEN)
+            self.assertTrue(breaker.allow_request(self.server.id))
+            # a second caller waits for the trial
+            self.assertFalse(breaker.allow_request(self.server.id))
+            breaker.record_failure(self.server.id)
+        self.assertEqual(breaker.get_state(self.server.id), breaker.OPEN)
+
+        with patch.object(app_settings, "MUMBLEVERSE_BREAKER_COOLDOWN", 0):
+            self.up = True
+            with patch.object(provider, "_build_client", mock_client(self.handler)):
+                self.assertTrue(provider.kick_username(self.server, "bob"))
+        self.assertEqual(breaker.get_state(self.server.id), breaker.CLOSED)
+
+    def test_server_errors_counted(self):
+        def _handler(request):
+            self.calls.append(request.url.path)
+            return Response(500)
+
+        with patch.object(provider, "_build_client", mock_client(_handler)), \
+                self.assertLogs("mumbleverse.provider", level="ERROR"):
+            self.assertFalse(provider.kick_username(self.server, "bob"))
+            self.assertFalse(provider.kick_username(self.server, "bob"))
+
+        def _client(**kwargs):
+            return AsyncClient(transport=MockTransport(_handler), **kwargs)
+
+        with patch.object(async_provider, "AsyncClient", _client), \
+                self.assertLogs("mumbleverse.async_provider", level="ERROR"):
+            self.assertFalse(async_provider.run(async_provider.kick_username(self.server, "bob")))
+        self.assertEqual(breaker.get_state(self.server.id), breaker.OPEN)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_async_calls_fail_fast(self):
+        self.open_breaker()
+
+        def _client(**kwargs):
+            return AsyncClient(transport=MockTransport(self.handler), **kwargs)
+
+        with patch.object(async_provider, "AsyncClient", _client), \
+                self.assertLogs("mumbleverse.async_provider", level="WARNING"):
+            result = async_provider.run(async_provider.kick_username(self.server, "bob"))
+        self.assertFalse(result)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_probe_closes_breaker(self):
+        self.open_breaker()
+        with patch.object(provider, "_build_client", mock_client(self.handler)):
+            probe_server_health()
+            self.assertEqual(breaker.get_state(self.server.id), breaker.OPEN)
+            self.up = True
+            probe_server_health()
+        self.assertEqual(self.calls[-1], "/api/health-check")
+        self.assertEqual(breaker.get_state(self.server.id), breaker.CLOSED)
+        self.assertTrue(breaker.describe(self.server.id).startswith("closed"))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@patch("mumbleverse.provider.time.sleep")
+class TestApiPolicy(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        provider.reset_clients()
+        self.server = MumbleverseServer.objects.create(
+            name="server", api_url="http://mumble", api_key="key"
+        )
+        self.responses = []
+        self.seen = []
+
+    def tearDown(self):
+        provider.reset_clients()
+
+    def handler(self, request):
+        self.seen.append(request)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def test_policy_layers(self, sleep):
+        self.assertEqual(policy.get_policy(self.server, "kick_username").read_timeout, 30)
+        self.assertEqual(policy.get_policy(self.server, "set_groups").read_timeout, 60)
+        with patch.object(app_settings, "MUMBLEVERSE_API_POLICIES", {"set_groups": {"read_timeout": 120}}):
+            self.assertEqual(policy.get_policy(self.server, "set_groups").read_timeout, 120)
+            self.server.api_read_timeout = 10
+            self.server.api_max_retries = 0
+            server_policy = policy.get_policy(self.server, "set_groups")
+        self.assertEqual(server_policy.read_timeout, 10)
+        self.assertEqual(server_policy.max_retries, 0)
+        self.assertEqual(server_policy.timeout.connect, 5)
+
+    def test_backoff_is_capped_and_jittered(self, sleep):
+        _policy = policy.get_policy(self.server, "kick_username")
+        delays = [policy.backoff_delay(_policy, 20) for _ in range(50)]
+        self.assertTrue(all(0 <= d <= _policy.max_backoff for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_retries_busy_and_transport_errors(self, sleep):
+        self.responses = [
+            Response(503),
+            ConnectError("down"),
+            Response(200, json={"user_id": 5}),
+        ]
+        with patch.object(provider, "_build_client", mock_client(self.handler)), \
+                self.assertLogs("mumbleverse.provider", level="WARNING"):
+            self.assertEqual(provider.register_user(self.server, "bob", "pass"), {"user_id": 5})
+        self.assertEqual(len(self.seen), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.seen[0].extensions["timeout"]["read"], 30)
+
+    def test_gives_up_after_max_retries(self, sleep):
+        self.server.api_max_retries = 1
+        self.responses = [Response(503), Response(503)]
+        with patch.object(provider, "_build_client", mock_client(self.handler)), \
+                self.assertLogs("mumbleverse.provider", level="WARNING"):
+            self.assertFalse(provider.kick_username(self.server, "bob"))
+        self.assertEqual(len(self.seen), 2)
+
+    def test_client_errors_not_retried(self, sleep):
+        self.responses = [Response(404)]
+        with patch.object(provider, "_build_client", mock_client(self.handler)):
+            self.assertFalse(provider.deregister_user(self.server, 5))
+        self.assertEqual(len(self.seen), 1)
+        sleep.assert_not_called()
+
+    def test_async_retries(self, sleep):
+        self.responses = [Response(502), Response(200, json={})]
+
+        def _client(**kwargs):
+            return AsyncClient(transport=MockTransport(self.handler), **kwargs)
+
+        with patch.object(async_provider, "AsyncClient", _client), \
+                patch.object(async_provider, "backoff_delay", return_value=0), \
+                self.assertLogs("mumbleverse.async_provider", level="WARNING"):
+            result = async_provider.run(async_provider.kick_username(self.server, "bob"))
+        self.assertEqual(result, {})
+        self.assertEqual(len(self.seen), 2)
@@ -0,0 +1,115 @@
+# Standard Library
+from unittest import skipUnless
+from unittest.mock import patch
+
+# Third Party
+from httpx import Client, MockTransport, Response
+from redis.exceptions import RedisError
+
+# Django
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+# Alliance Auth
+from allianceauth.utils.cache import get_redis_client
+
+from .. import app_settings, provider, ratelimit
+from ..models import MumbleverseServer
+
+
+def redis_scripting():
+    try:
+        return get_redis_client().eval("return 1", 0) == 1
+    except (NotImplementedError, AttributeError, RedisError):
+        return False
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@patch.object(ratelimit.time, "sleep")
+class TestLocalRateLimit(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        ratelimit._local_buckets.clear()
+        provider.reset_clients()
+        self.server = MumbleverseServer.objects.create(
+            name="server", api_url="http://mumble", api_rate_limit=1, api_rate_burst=2
+        )
+
+    def tearDown(self):
+        provider.reset_clients()
+
+    def test_waits_for_token(self, sleep):
+        ratelimit.acquire(self.server)
+        ratelimit.acquire(self.server)
+        sleep.assert_not_called()
+        ratelimit.acquire(self.server)
+        self.assertAlmostEqual(sleep.call_args.args[0], 1, places=1)
+        stats = ratelimit.get_rate_limit_stats(self.server.id)
+        self.assertEqual(stats["rate_limit_waits"], 1)
+        self.assertGreater(stats["rate_limit_wait_ms"], 900)
+
+    @patch.object(app_settings, "MUMBLEVERSE_API_RATE_LIMIT_MAX_WAIT", 0.5)
+    def test_gives_up_after_max_wait(self, sleep):
+        ratelimit.acquire(self.server)
+        ratelimit.acquire(self.server)
+        with self.assertRaises(ratelimit.RateLimited):
+            ratelimit.reserve(self.server)
+        self.assertEqual(ratelimit.get_rate_limit_stats(self.server.id)["rate_limit_rejected"], 1)
+
+        calls = []
+
+        def _build(server):
+            return Client(transport=MockTransport(lambda r: calls.append(r) or Response(200, json={})))
+
+        with patch.object(provider, "_build_client", _build), \
+                self.assertLogs("mumbleverse.provider", level="WARNING"):
+            self.assertFalse(provider.kick_username(self.server, "bob"))
+        self.assertEqual(calls, [])
+
+    def test_max_wait_in_block(self, sleep):
+        ratelimit.acquire(self.server)
+        ratelimit.acquire(self.server)
+        with ratelimit.max_wait(0.5), self.assertRaises(ratelimit.RateLimited):
+            ratelimit.acquire(self.server)
+        sleep.assert_not_called()
+        # back to the normal wait outside it
+        ratelimit.acquire(self.server)
+        sleep.assert_called_once()
+
+    def test_limits(self, sleep):
+        self.server.api_rate_limit = None
+        self.server.api_rate_burst = None
+        self.assertEqual(
+            ratelimit.get_limits(self.server),
+            (app_settings.MUMBLEVERSE_API_RATE_LIMIT, app_settings.MUMBLEVERSE_API_RATE_BURST)
+        )
+        # no limit
+        self.server.api_rate_limit = 0
+        for _ in range(100):
+            self.assertEqual(ratelimit.reserve(self.server), 0)
+
+
+@skipUnless(redis_scripting(), "needs a redis cache that runs Lua scripts")
+class TestSharedRateLimit(TestCase):
+
+    def setUp(self):
+        ratelimit._local_buckets.clear()
+        self.server = MumbleverseServer.objects.create(
+            name="server", api_url="http://mumble", api_rate_limit=10, api_rate_burst=1
+        )
+        self.key = f"mumbleverse:ratelimit:{self.server.id}"
+        get_redis_client().delete(self.key)
+
+    def tearDown(self):
+        get_redis_client().delete(self.key)
+
+    def test_bucket_in_redis(self):
+        self.assertEqual(ratelimit.reserve(self.server), 0)
+        wait = ratelimit.reserve(self.server)
+        self.assertGreater(wait, 0.05)
+        self.assertLessEqual(wait, 0.1)
+        # a second worker queues behind the first
+        self.assertGreater(ratelimit.reserve(self.server), wait)
+        self.assertTrue(get_redis_client().exists(self.key))
+        self.assertEqual(ratelimit._local_buckets, {})
@@ -0,0 +1,113 @@
+# Standard Library
+from unittest.mock import patch
+
+# Django
+from django.apps import apps
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+
+# Alliance Auth
+from allianceauth import hooks
+
+from .. import app_settings, registry
+from ..auth_hooks import MumbleverseService
+from ..models import MumbleverseServer
+
+
+def server_hooks():
+    return {
+        h.sid: h for h in hooks._hooks.get("services_hook", [])
+        if isinstance(h, type) and issubclass(h, MumbleverseService)
+    }
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TestServerRegistry(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble")
+        registry.reload()
+
+    def tearDown(self):
+        # don't leave this test's servers registered
+        MumbleverseServer.objects.all().delete()
+        registry.reload()
+
+    def test_lookups_skip_db(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_server(self.server.id).api_url, "http://mumble")
+            self.assertEqual(registry.get_servers(), [self.server])
+
+    def test_missing_server(self):
+        with self.assertRaises(MumbleverseServer.DoesNotExist):
+            registry.get_server(self.server.id + 1)
+
+    def test_local_change_seen(self):
+        self.server.api_url = "http://other"
+        self.server.save()
+        self.assertEqual(registry.get_server(self.server.id).api_url, "http://other")
+
+    def test_other_process_change_seen(self):
+        # another process saved the server and committed
+        MumbleverseServer.objects.filter(id=self.server.id).update(name="renamed")
+        registry.bump_generation()
+
+        with patch.object(app_settings, "MUMBLEVERSE_REGISTRY_CHECK_INTERVAL", 60):
+            self.assertEqual(registry.get_server(self.server.id).name, "server")
+        with patch.object(app_settings, "MUMBLEVERSE_REGISTRY_CHECK_INTERVAL", 0):
+            self.assertEqual(registry.get_server(self.server.id).name, "renamed")
+        self.assertEqual(server_hooks()[self.server.id].server_name, "renamed")
+
+    def test_hooks_follow_servers(self):
+        self.assertIn(self.server.id, server_hooks())
+        new = MumbleverseServer.objects.create(name="new")
+        registry.check_generation()
+        self.assertIn(new.id, server_hooks())
+
+        new.delete()
+        registry.check_generation()
+        self.assertNotIn(new.id, server_hooks())
+        self.assertIn(self.server.id, server_hooks())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TestLazyStartup(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = [MumbleverseServer.objects.create(name=f"server {i}") for i in range(5)]
+
+    def tearDown(self):
+        MumbleverseServer.objects.all().delete()
+        registry.reload()
+
+    @patch.object(registry, "_generation", None)
+    def test_ready_skips_db(self):
+        with self.assertNumQueries(0):
+            apps.get_app_config("mumbleverse").ready()
+        self.assertNotIn(self.servers[0].id, server_hooks())
+
+        # first request loads every server in one query
+        with self.assertNumQueries(1):
+            registry.refresh()
+        for server in self.servers:
+            self.assertIn(server.id, server_hooks())
+        with self.assertNumQueries(0):
+            registry.refresh()
+
+    @patch.object(registry, "_generation", None)
+    def test_first_lookup_loads(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.get_server(self.servers[0].id), self.servers[0])
+        for server in self.servers:
+            self.assertIn(server.id, server_hooks())
+
+    @patch.object(registry, "_generation", None)
+    def test_db_not_ready(self):
+        with patch.object(MumbleverseServer.objects, "all", side_effect=OperationalError("no db")), \
+                self.assertLogs("mumbleverse.registry", level="ERROR"):
+            registry.refresh()
+        registry.refresh()
+        self.assertEqual(len(registry.get_servers()), 5)
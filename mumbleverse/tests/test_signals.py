@@ -0,0 +1,181 @@
+# Standard Library
+from unittest.mock import patch
+
+# Django
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import m2m_changed
+from django.test import TestCase
+
+# Alliance Auth
+from allianceauth.authentication.models import State, UserProfile
+from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo
+from allianceauth.services import signals as services_signals
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import signals
+from ..models import MumbleverseServer, MumbleverseServerUser
+from .test_access import create_char
+
+
+@patch.object(signals.check_users_in_server, "delay")
+class TestTargetedAudit(TestCase):
+
+    def setUp(self):
+        self.corps = [
+            EveCorporationInfo.objects.create(
+                corporation_id=i,
+                corporation_name=f"corp {i}",
+                corporation_ticker=f"C{i}",
+                member_count=1
+            ) for i in range(1, 3)
+        ]
+        self.groups = [Group.objects.create(name=f"group {i}") for i in range(2)]
+        self.server = MumbleverseServer.objects.create(name="server")
+        self.other = MumbleverseServer.objects.create(name="other")
+        self.users = []
+        for i in range(4):
+            user = AuthUtils.create_user(f"user{i}")
+            user.profile.main_character = create_char(i + 1, f"char {i}", corp=self.corps[i % 2])
+            user.profile.save()
+            user.groups.add(self.groups[i % 2])
+            for server in [self.server, self.other]:
+                MumbleverseServerUser.objects.create(server=server, user=user, uid=str(i), username=user.username)
+            self.users.append(user)
+        # no account, never checked
+        self.no_account = AuthUtils.create_user("no_account")
+        self.no_account.groups.add(self.groups[0])
+        self.server.group_access.add(*self.groups)
+        self.server.corporation_access.add(*self.corps)
+        self.other.group_access.add(self.groups[0])
+
+    def assertChecked(self, delay, expected):
+        self.assertEqual(
+            {call.args[0]: sorted(call.args[1]) for call in delay.call_args_list},
+            {sid: sorted(u.id for u in users) for sid, users in expected.items()}
+        )
+
+    def test_group_removed(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.group_access.remove(self.groups[0])
+        self.assertChecked(delay, {self.server.id: [self.users[0], self.users[2]]})
+
+    def test_corp_removed(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.corporation_access.remove(self.corps[1])
+        self.assertChecked(delay, {self.server.id: [self.users[1], self.users[3]]})
+
+    def test_state_removed(self, delay):
+        guest = State.objects.get(name="Guest")
+        self.server.state_access.add(guest)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.state_access.remove(guest)
+        self.assertChecked(delay, {self.server.id: self.users})
+
+    def test_cleared(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.corporation_access.clear()
+        self.assertChecked(delay, {self.server.id: self.users})
+
+    def test_removed_from_group_side(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.groups[0].mumbleverseserver_set.remove(self.other)
+        self.assertChecked(delay, {self.other.id: [self.users[0], self.users[2]]})
+
+        delay.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.groups[1].mumbleverseserver_set.clear()
+        self.assertChecked(delay, {self.server.id: [self.users[1], self.users[3]]})
+
+    def test_added_not_checked(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.group_access.add(self.groups[1])
+        delay.assert_not_called()
+
+
+# Auth's own group sync for every service
+@patch.object(services_signals.update_groups_for_user, "delay")
+@patch.object(signals.check_user_all_servers, "delay")
+class TestUserTriggers(TestCase):
+
+    def setUp(self):
+        self.corp = EveCorporationInfo.objects.create(
+            corporation_id=1,
+            corporation_name="corp",
+            corporation_ticker="CORP",
+            member_count=1
+        )
+        self.group = Group.objects.create(name="group")
+        self.server = MumbleverseServer.objects.create(name="server")
+        self.user = AuthUtils.create_user("user")
+        self.char = create_char(1, "char", corp=self.corp)
+        self.user.profile.main_character = self.char
+        self.user.profile.save()
+        self.user.groups.add(self.group)
+        MumbleverseServerUser.objects.create(server=self.server, user=self.user, uid="1", username="user")
+        self.no_account = AuthUtils.create_user("no_account")
+        self.no_account.groups.add(self.group)
+
+    def test_group_left(self, delay, update_groups_for_user):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.no_account.groups.remove(self.group)
+        delay.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.remove(self.group)
+        delay.assert_called_once_with(self.user.id)
+
+    def test_group_emptied(self, delay, update_groups_for_user):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.user_set.remove(self.user, self.no_account)
+        delay.assert_called_once_with(self.user.id)
+
+    def test_group_cleared(self, delay, update_groups_for_user):
+        # Auth's own receiver can't handle a clear from the group side
+        receiver = services_signals.m2m_changed_user_groups
+        m2m_changed.disconnect(receiver, sender=User.groups.through)
+        self.addCleanup(m2m_changed.connect, receiver, sender=User.groups.through)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.user_set.clear()
+        delay.assert_called_once_with(self.user.id)
+        self.assertFalse(self.group.user_set.exists())
+
+    def test_state_changed(self, delay, update_groups_for_user):
+        # left to Auth's own state_changed validation
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.state = State.objects.get(name="Member")
+            self.user.profile.save()
+        delay.assert_not_called()
+
+    def test_main_changed(self, delay, update_groups_for_user):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.save()
+        delay.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.main_character = create_char(2, "alt", corp=self.corp)
+            self.user.profile.save()
+        delay.assert_called_once_with(self.user.id)
+
+    def test_unrelated_save_not_looked_up(self, delay, update_groups_for_user):
+        with self.assertNumQueries(0):
+            signals.stash_access_fields(UserProfile, self.user.profile, update_fields=frozenset(["language"]))
+        with self.assertNumQueries(1):
+            signals.stash_access_fields(UserProfile, self.user.profile, update_fields=frozenset(["main_character"]))
+        self.assertEqual(self.user.profile._mumbleverse_access_fields, (self.char.pk,))
+
+    def test_not_a_main(self, delay, update_groups_for_user):
+        alt = create_char(2, "alt", corp=self.corp)
+        signals.stash_access_fields(EveCharacter, alt)
+        self.assertIsNone(alt._mumbleverse_access_fields)
+        with self.captureOnCommitCallbacks(execute=True):
+            alt.corporation_id = 2
+            alt.save()
+        delay.assert_not_called()
+
+    def test_main_moved_corp(self, delay, update_groups_for_user):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.char.character_name = "renamed"
+            self.char.save()
+        delay.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.char.corporation_id = 2
+            self.char.save()
+        delay.assert_called_once_with(self.user.id)
@@ -0,0 +1,186 @@
+# Standard Library
+import time
+from unittest.mock import patch
+
+# Third Party
+from httpx import AsyncClient, MockTransport, Response
+
+# Django
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+# Alliance Auth
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import async_provider, outbox, tasks
+from ..models import MumbleverseOutbox, MumbleverseServer, MumbleverseServerUser
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TestCoalescedGroupSync(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server")
+
+    @patch.object(tasks, "drain_outbox")
+    @patch.object(tasks.coalesced_update_server_groups, "apply_async")
+    def test_triggers_merged(self, apply_async, drain_outbox):
+        with patch.object(tasks.time, "time", return_value=1000):
+            for _ in range(5):
+                tasks.queue_server_group_sync(self.server.id)
+        apply_async.assert_called_once_with(args=[self.server.id], countdown=15)
+
+        # still inside the window, push it back
+        with patch.object(tasks.time, "time", return_value=1010):
+            tasks.coalesced_update_server_groups(self.server.id)
+        self.assertEqual(apply_async.call_args.kwargs["countdown"], 5)
+        drain_outbox.assert_not_called()
+
+        with patch.object(tasks.time, "time", return_value=1015):
+            tasks.coalesced_update_server_groups(self.server.id)
+        drain_outbox.assert_called_once_with(self.server.id)
+        self.assertEqual(
+            tasks.get_group_sync_stats(self.server.id),
+            {
+                "group_sync_triggers": 5,
+                "group_sync_merged": 4,
+                "group_sync_runs": 1,
+                "group_push_sent": 0,
+                "group_push_skipped": 0,
+            }
+        )
+
+        # next trigger opens a new window
+        tasks.queue_server_group_sync(self.server.id)
+        self.assertEqual(apply_async.call_count, 3)
+
+    @patch.object(tasks, "drain_outbox")
+    @patch.object(tasks.coalesced_update_server_groups, "apply_async")
+    def test_max_latency(self, apply_async, drain_outbox):
+        for now in range(1000, 1070, 5):
+            with patch.object(tasks.time, "time", return_value=now):
+                tasks.queue_server_group_sync(self.server.id)
+
+        with patch.object(tasks.time, "time", return_value=1055):
+            tasks.coalesced_update_server_groups(self.server.id)
+        self.assertEqual(apply_async.call_args.kwargs["countdown"], 5)
+
+        with patch.object(tasks.time, "time", return_value=1060):
+            tasks.coalesced_update_server_groups(self.server.id)
+        drain_outbox.assert_called_once_with(self.server.id)
+
+
+class TestUserGroupSync(TestCase):
+
+    def setUp(self):
+        self.server = MumbleverseServer.objects.create(name="server")
+        self.user = AuthUtils.create_user("user")
+
+    def test_no_account(self):
+        tasks.update_server_user_groups(self.server.id, self.user.id)
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch.object(outbox, "sync_groups", return_value=True)
+    @patch.object(outbox, "sync_user_groups", return_value=True)
+    @patch.object(tasks.drain_outbox, "delay")
+    def test_burst_sent_once(self, delay, sync_user_groups, sync_groups):
+        cache.clear()
+        users = [self.user] + [AuthUtils.create_user(f"user{i}") for i in range(2)]
+        for i, user in enumerate(users):
+            MumbleverseServerUser.objects.create(server=self.server, user=user, uid=str(i), username=user.username)
+        with patch.object(tasks.coalesced_update_server_groups, "apply_async") as apply_async, \
+                self.captureOnCommitCallbacks(execute=True):
+            for user in users:
+                tasks.update_server_user_groups(self.server.id, user.id)
+        # one drain for the whole window, not one push per user
+        apply_async.assert_called_once()
+        delay.assert_not_called()
+        self.assertEqual(MumbleverseOutbox.objects.count(), 3)
+
+        with patch.object(tasks.time, "time", return_value=time.time() + 60):
+            tasks.coalesced_update_server_groups(self.server.id)
+        sync_groups.assert_called_once_with(self.server)
+        sync_user_groups.assert_not_called()
+        self.assertFalse(MumbleverseOutbox.objects.exists())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TestRemoveServerUsers(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble", api_key="key")
+        self.users = [AuthUtils.create_user(f"user{i}") for i in range(4)]
+        for i, user in enumerate(self.users):
+            MumbleverseServerUser.objects.create(server=self.server, user=user, uid=str(i), username=user.username)
+        self.requests = []
+
+    def handler(self, request):
+        self.requests.append(request)
+        if request.url.path.endswith("/delete") and request.url.params["user_id"] == "2":
+            return Response(500)
+        return Response(200, json={"status": "ok"})
+
+    def mock_client(self, **kwargs):
+        return AsyncClient(transport=MockTransport(self.handler), **kwargs)
+
+    @patch.object(tasks.drain_outbox, "apply_async")
+    def test_batch_removed(self, apply_async):
+        user_ids = [u.id for u in self.users[1:]]
+        with patch.object(async_provider, "AsyncClient", self.mock_client), \
+                self.assertLogs("mumbleverse.tasks", level="WARNING"):
+            report = tasks.remove_server_users(self.server.id, user_ids)
+        self.assertEqual(len(self.requests), 6)
+        self.assertEqual(report[self.users[1].id], {"deregistered": True, "error": None})
+        self.assertEqual(report[self.users[3].id], {"deregistered": True, "error": None})
+        self.assertFalse(report[self.users[2].id]["deregistered"])
+        self.assertTrue(report[self.users[2].id]["error"])
+        self.assertEqual(
+            list(MumbleverseServerUser.objects.values_list("user_id", flat=True)),
+            [self.users[0].id]
+        )
+        # only the failed removal is left to retry
+        failed = MumbleverseOutbox.objects.get()
+        self.assertEqual(failed.payload["uid"], "2")
+        self.assertEqual(failed.attempts, 1)
+        apply_async.assert_called_once()
+
+    @patch.object(tasks.remove_server_users, "delay")
+    @patch.object(tasks.app_settings, "MUMBLEVERSE_REMOVAL_BATCH_SIZE", 2)
+    def test_audit_batched(self, delay):
+        tasks.check_all_users_in_server(self.server.id)
+        self.assertEqual(delay.call_count, 2)
+        self.assertCountEqual(
+            [_id for call in delay.call_args_list for _id in call.args[1]],
+            [u.id for u in self.users]
+        )
+
+
+class TestUserAudit(TestCase):
+
+    def setUp(self):
+        self.servers = [MumbleverseServer.objects.create(name=f"server {i}") for i in range(2)]
+        self.user = AuthUtils.create_user("user")
+        for server in self.servers:
+            MumbleverseServerUser.objects.create(server=server, user=self.user, uid="1", username="user")
+
+    @patch.object(tasks.remove_server_users, "delay")
+    def test_revoked_servers_removed(self, delay):
+        tasks.check_user_all_servers(self.user.id)
+        self.assertCountEqual(
+            [call.args for call in delay.call_args_list],
+            [(s.id, [self.user.id]) for s in self.servers]
+        )
+
+    @patch.object(tasks.drain_outbox, "delay")
+    def test_all_servers_audit(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.check_users_in_all_server()
+        self.assertFalse(MumbleverseServerUser.objects.exists())
+        self.assertCountEqual(
+            MumbleverseOutbox.objects.values_list("server_id", "operation"),
+            [(s.id, MumbleverseOutbox.REMOVE_USER) for s in self.servers]
+        )
+        self.assertCountEqual([call.args for call in delay.call_args_list], [(s.id,) for s in self.servers])
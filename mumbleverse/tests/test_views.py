@@ -0,0 +1,233 @@
+# Standard Library
+from unittest.mock import patch
+
+# Third Party
+from httpx import AsyncClient, MockTransport, Response
+
+# Django
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+# Alliance Auth
+from allianceauth.tests.auth_utils import AuthUtils
+
+from .. import app_settings, async_provider, models, outbox, ratelimit, tasks, views
+from ..models import MumbleverseOutbox, MumbleverseServer, MumbleverseServerUser
+
+
+def queued_group_updates():
+    return list(
+        MumbleverseOutbox.objects.filter(
+            operation=MumbleverseOutbox.SYNC_USER_GROUPS
+        ).order_by("id").values_list("server_id", "payload__user_id")
+    )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@patch.object(outbox, "sync_account_groups", wraps=outbox.sync_account_groups)
+@patch.object(models, "register_user", return_value={"user_id": 5})
+@patch.object(tasks, "register_user", return_value={"user_id": 5})
+class TestAccountOperations(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble")
+        self.user = AuthUtils.create_user("user")
+        AuthUtils.add_main_character_2(self.user, "char", 1, corp_id=1, corp_name="corp", corp_ticker="CORP")
+        self.client.force_login(self.user)
+
+    def test_activate_on_worker(self, register_account, register_user, sync_account_groups):
+        with patch.object(tasks.account_operation, "delay") as delay:
+            response = self.client.get(reverse("mumbleverse:activate", args=[self.server.id]))
+        operation_id = delay.call_args.args[0]
+        self.assertRedirects(
+            response,
+            reverse("mumbleverse:operation_status", args=[operation_id]),
+            fetch_redirect_response=False
+        )
+        register_account.assert_not_called()
+
+        # still waiting on the worker
+        response = self.client.get(reverse("mumbleverse:operation_status", args=[operation_id]))
+        self.assertTemplateUsed(response, "mumbleverse/operation_status.html")
+
+        tasks.account_operation(*delay.call_args.args)
+        # the status outlives the password it shows
+        self.assertNotIn("credentials", tasks.get_account_operation(operation_id, self.user.id))
+        account = MumbleverseServerUser.objects.get(user=self.user)
+        self.assertEqual(account.uid, "5")
+        sync_account_groups.assert_called_once_with(self.server.id, self.user.id)
+        self.assertEqual(queued_group_updates(), [(self.server.id, self.user.id)])
+
+        response = self.client.get(reverse("mumbleverse:operation_status", args=[operation_id]))
+        self.assertTemplateUsed(response, "services/service_credentials.html")
+        self.assertEqual(response.context["credentials"]["username"], account.username)
+
+        # only shown once
+        response = self.client.get(reverse("mumbleverse:operation_status", args=[operation_id]))
+        self.assertRedirects(response, reverse("services:services"), fetch_redirect_response=False)
+
+    def test_password_kept_off_broker(self, register_account, register_user, sync_account_groups):
+        MumbleverseServerUser.objects.create(server=self.server, user=self.user, uid="5", username="user")
+        with patch.object(tasks.account_operation, "delay") as delay:
+            self.client.post(reverse("mumbleverse:set_password", args=[self.server.id]), {"password": "hunter22"})
+        self.assertNotIn("hunter22", delay.call_args.args)
+
+        with patch.object(tasks, "_update_credentials", return_value=True) as update_credentials:
+            tasks.account_operation(*delay.call_args.args)
+            self.assertEqual(update_credentials.call_args.args[1], "hunter22")
+            # read once
+            tasks.account_operation(*delay.call_args.args)
+            self.assertEqual(update_credentials.call_count, 1)
+
+    def test_status_only_for_owner(self, register_account, register_user, sync_account_groups):
+        with patch.object(tasks.account_operation, "delay"):
+            operation_id = tasks.start_account_operation("reset", self.server.id, self.user.id + 1)
+        response = self.client.get(reverse("mumbleverse:operation_status", args=[operation_id]))
+        self.assertRedirects(response, reverse("services:services"), fetch_redirect_response=False)
+
+    @patch.object(app_settings, "MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS", False)
+    def test_inline(self, register_account, register_user, sync_account_groups):
+        response = self.client.get(reverse("mumbleverse:activate", args=[self.server.id]))
+        self.assertTemplateUsed(response, "services/service_credentials.html")
+        sync_account_groups.assert_called_once_with(self.server.id, self.user.id)
+
+        register_user.return_value = False
+        with patch.object(models, "kick_username"), patch.object(models, "deregister_user"), \
+                patch.object(models, "update_user", return_value=False):
+            response = self.client.post(
+                reverse("mumbleverse:set_password", args=[self.server.id]),
+                {"password": "hunter2"}
+            )
+        self.assertRedirects(response, reverse("services:services"), fetch_redirect_response=False)
+        register_user.assert_called_with(self.server, MumbleverseServerUser.objects.get().username, "hunter2")
+
+    @patch.object(app_settings, "MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS", False)
+    def test_inline_fails_fast_on_rate_limit(self, register_account, register_user, sync_account_groups):
+        waits = []
+
+        def _run(*args):
+            waits.append(ratelimit._max_wait.get())
+            return {"status": "failed", "operation": "activate"}
+
+        with patch.object(views, "run_account_operation", side_effect=_run):
+            self.client.get(reverse("mumbleverse:activate", args=[self.server.id]))
+        self.assertEqual(waits, [app_settings.MUMBLEVERSE_API_RATE_LIMIT_REQUEST_WAIT])
+        self.assertIsNone(ratelimit._max_wait.get())
+
+
+@patch.object(models, "deregister_user")
+@patch.object(models, "kick_username")
+@patch.object(app_settings, "MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS", False)
+class TestCredentialUpdate(TestCase):
+
+    def setUp(self):
+        self.server = MumbleverseServer.objects.create(name="server", api_url="http://mumble")
+        self.user = AuthUtils.create_user("user")
+        AuthUtils.add_main_character_2(self.user, "char", 1, corp_id=1, corp_name="corp", corp_ticker="CORP")
+        self.account = MumbleverseServerUser.objects.create(server=self.server, user=self.user, uid="5")
+        self.account.update_username()
+        self.client.force_login(self.user)
+
+    def reset(self, user_id):
+        with patch.object(models, "update_user", return_value={"user_id": user_id}) as update_user, \
+                patch.object(models, "register_user", return_value={"user_id": 6}) as register_user:
+            response = self.client.get(reverse("mumbleverse:reset_password", args=[self.server.id]))
+        self.account.refresh_from_db()
+        return response, update_user, register_user
+
+    def test_updated_in_place(self, kick, deregister):
+        response, update_user, register_user = self.reset(5)
+        self.assertTemplateUsed(response, "services/service_credentials.html")
+        update_user.assert_called_once_with(
+            self.server, self.account.username, response.context["credentials"]["password"]
+        )
+        register_user.assert_not_called()
+        kick.assert_not_called()
+        deregister.assert_not_called()
+        self.assertEqual(queued_group_updates(), [])
+        self.assertEqual(self.account.uid, "5")
+
+    def test_missing_from_server(self, kick, deregister):
+        self.reset(7)
+        self.assertEqual(self.account.uid, "7")
+        self.assertEqual(queued_group_updates(), [(self.server.id, self.user.id)])
+
+    def test_renamed_reregistered(self, kick, deregister):
+        MumbleverseServerUser.objects.filter(id=self.account.id).update(username="old name")
+        response, update_user, register_user = self.reset(5)
+        update_user.assert_not_called()
+        kick.assert_called_once()
+        deregister.assert_called_once_with(self.server, "5")
+        self.assertEqual(self.account.uid, "6")
+        self.assertNotEqual(self.account.username, "old name")
+        self.assertEqual(response.context["credentials"]["username"], self.account.username)
+        self.assertEqual(queued_group_updates(), [(self.server.id, self.user.id)])
+
+    def test_api_calls_outside_transaction(self, kick, deregister):
+        MumbleverseServerUser.objects.filter(id=self.account.id).update(username="old name")
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def _register(*args):
+            depths.append(len(connection.atomic_blocks))
+            return {"user_id": 6}
+
+        self.account.refresh_from_db()
+        with patch.object(models, "register_user", side_effect=_register):
+            self.assertTrue(tasks._update_credentials(self.account, "hunter2"))
+        self.assertEqual(depths, [depth])
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.uid, "6")
+
+
+@patch.object(app_settings, "MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS", False)
+class TestActivateAll(TestCase):
+
+    def setUp(self):
+        self.servers = [
+            MumbleverseServer.objects.create(name=f"server {i}", api_url=f"http://mumble-{i}") for i in range(4)
+        ]
+        self.user = AuthUtils.create_user("user")
+        AuthUtils.add_main_character_2(self.user, "char", 1, corp_id=1, corp_name="corp", corp_ticker="CORP")
+        self.user.user_permissions.add(
+            Permission.objects.get_by_natural_key("basic_access", "mumbleverse", "general"),
+            Permission.objects.get_by_natural_key("global_access", "mumbleverse", "general"),
+        )
+        MumbleverseServerUser.objects.create(server=self.servers[0], user=self.user, uid="1", username="char")
+        self.client.force_login(self.user)
+        self.registered = []
+
+    def handler(self, request):
+        self.registered.append(request.url.host)
+        if request.url.host == "mumble-3":
+            return Response(500)
+        return Response(200, json={"user_id": 10 + len(self.registered)})
+
+    def mock_client(self, **kwargs):
+        return AsyncClient(transport=MockTransport(self.handler), **kwargs)
+
+    def test_activate_all(self):
+        with patch.object(async_provider, "AsyncClient", self.mock_client):
+            response = self.client.get(reverse("mumbleverse:activate_all"))
+
+        self.assertCountEqual(self.registered, ["mumble-1", "mumble-2", "mumble-3"])
+        self.assertTemplateUsed(response, "services/service_credentials.html")
+        self.assertEqual(response.context["credentials"]["servers"], "server 1, server 2")
+        self.assertIn("server 3", str(list(response.context["messages"])[0]))
+        accounts = MumbleverseServerUser.objects.filter(user=self.user).exclude(server=self.servers[0])
+        self.assertCountEqual([a.server_id for a in accounts], [self.servers[1].id, self.servers[2].id])
+        self.assertEqual(
+            queued_group_updates(),
+            [(self.servers[1].id, self.user.id), (self.servers[2].id, self.user.id)]
+        )
+
+        # nothing left but the failed one
+        self.registered.clear()
+        with patch.object(async_provider, "AsyncClient", self.mock_client):
+            response = self.client.get(reverse("mumbleverse:activate_all"))
+        self.assertEqual(self.registered, ["mumble-3"])
+        self.assertRedirects(response, reverse("services:services"), fetch_redirect_response=False)
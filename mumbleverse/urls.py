@@ -15,8 +15,12 @@ urlpatterns = [
             views.deactivate_mumbleverse, name='deactivate'),
     re_path(r'activate/(?P<server_id>(\d)*)',
             views.activate_mumbleverse, name='activate'),
+    re_path(r'activate-all/',
+            views.activate_all_mumbleverse, name='activate_all'),
     re_path(r'reset/(?P<server_id>(\d)*)',
             views.reset_mumbleverse, name='reset_password'),
     re_path(r'set/(?P<server_id>(\d)*)',
             views.set_mumbleverse, name='set_password'),
+    re_path(r'status/(?P<operation_id>[0-9a-f]{32})',
+            views.operation_status, name='operation_status'),
 ]
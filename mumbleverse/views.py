@@ -10,170 +10,112 @@ from django.utils.translation import gettext_lazy as _
 # Alliance Auth
 from allianceauth.services.forms import ServicePasswordForm
 
-from .models import MumbleverseServer, MumbleverseServerUser
-from .tasks import update_server_groups
+from . import app_settings, ratelimit
+from .tasks import (
+    forget_account_operation,
+    get_account_operation,
+    run_account_operation,
+    start_account_operation,
+)
 
 logger = logging.getLogger(__name__)
 
+SUCCESS_MESSAGES = {
+    "activate_all": _('All your Mumbleverse Accounts are already active.'),
+    "set": _('Set password for Mumbleverse Account.'),
+    "deactivate": _('Deactivated Mumbleverse Account.'),
+}
 
-@login_required
-def deactivate_mumbleverse(request, server_id):
-    logger.debug("deactivate_mumbleverse called by user %s", request.user)
-    try:
-        _u = MumbleverseServerUser.objects.get(
-            server_id=server_id,
-            user=request.user
+ERROR_MESSAGES = {
+    "deactivate": _('An error occurred while deactivating Mumbleverse Account.'),
+}
+DEFAULT_ERROR_MESSAGE = _('An error occurred while processing your Mumbleverse Account.')
+
+
+def _operation_response(request, result):
+    """Show the user how their account operation went"""
+    if result["status"] != "done":
+        messages.error(request, ERROR_MESSAGES.get(result["operation"], DEFAULT_ERROR_MESSAGE))
+        return redirect("services:services")
+    if result.get("failed"):
+        messages.warning(
+            request,
+            _('Could not activate Mumbleverse Accounts on: %(servers)s') % {"servers": ", ".join(result["failed"])}
         )
-        _u.kick_user(f"{_u.username} deactivated by Auth")
-        req = _u.deregister_user()
-        if req:
-            _u.delete()
-            messages.success(request, _('Deactivated Mumbleverse Account.'))
-        else:
-            messages.error(
-                request, _(
-                    'An error occurred while deactivating Mumbleverse Account.'
-                )
-            )
-    except MumbleverseServerUser.DoesNotExist:
-        messages.error(
-            request, _(
-                'An error occurred while deactivating Mumbleverse Account.'
-            )
+    if "credentials" in result:
+        return render(
+            request,
+            'services/service_credentials.html',
+            context={
+                'credentials': result["credentials"],
+                'service': result["service"],
+            }
         )
+    messages.success(request, SUCCESS_MESSAGES[result["operation"]])
     return redirect("services:services")
 
 
+def _account_operation(request, operation, server_id=None, password=None):
+    """Run an account operation, on a worker unless that's turned off"""
+    logger.debug(f"{operation} mumbleverse account {server_id} called by user {request.user}")
+    if server_id is not None:
+        server_id = int(server_id)
+    if app_settings.MUMBLEVERSE_ASYNC_ACCOUNT_OPERATIONS:
+        operation_id = start_account_operation(operation, server_id, request.user.id, password)
+        return redirect("mumbleverse:operation_status", operation_id=operation_id)
+    # the user is waiting, fail rather than queue behind a busy server
+    with ratelimit.max_wait(app_settings.MUMBLEVERSE_API_RATE_LIMIT_REQUEST_WAIT):
+        result = run_account_operation(operation, server_id, request.user.id, password)
+    return _operation_response(request, result)
+
+
 @login_required
-def reset_mumbleverse(request, server_id):
-    try:
-        _u = MumbleverseServerUser.objects.get(
-            server_id=server_id,
-            user=request.user
-        )
-        _u.kick_user(f"{_u.username} deactivated by Auth")
-        _u.deregister_user()
-        _u.update_username()
-        _u.reset_password()
-        data = _u.register_user(_u.credentials["password"])
-        if data:
-            update_server_groups.delay(server_id)
-            return render(
-                request,
-                'services/service_credentials.html',
-                context={
-                    'credentials': _u.credentials,
-                    'service': _u.server.name,
-                }
-            )
-        else:
-            messages.error(
-                request, _(
-                    'An error occurred while processing your Mumbleverse Account.'
-                )
-            )
-            return redirect("services:services")
+def operation_status(request, operation_id):
+    result = get_account_operation(operation_id, request.user.id)
+    if result is None:
+        messages.error(request, DEFAULT_ERROR_MESSAGE)
+        return redirect("services:services")
+    if result["status"] == "pending":
+        return render(request, 'mumbleverse/operation_status.html')
+    credentials = forget_account_operation(operation_id)
+    if credentials is not None:
+        result["credentials"] = credentials
+    return _operation_response(request, result)
 
-    except MumbleverseServerUser.DoesNotExist:
-        messages.error(
-            request, _(
-                'An error occurred while processing your Mumbleverse Account.'
-            )
-        )
-    return redirect("services:services")
+
+@login_required
+def deactivate_mumbleverse(request, server_id):
+    return _account_operation(request, "deactivate", server_id)
+
+
+@login_required
+def reset_mumbleverse(request, server_id):
+    return _account_operation(request, "reset", server_id)
 
 
 @login_required
 def set_mumbleverse(request, server_id):
-    try:
-        if request.method == "POST":
-            _password = request.POST.get("password")
-            if not _password:
-                messages.error(
-                    request, _(
-                        'An error occurred while processing your Mumbleverse Account.'
-                    )
-                )
-                return redirect("services:services")
-
-            # update user by first deleting the user.
-            _u = MumbleverseServerUser.objects.get(
-                server_id=server_id,
-                user=request.user
-            )
-            _u.kick_user(f"{_u.username} deactivated by Auth")
-            _u.deregister_user()
-            _u.update_username()
-            updated = _u.register_user(_password)
-            if updated:
-                update_server_groups.delay(server_id)
-                messages.success(
-                    request, _(
-                        'Set password for Mumbleverse Account.'
-                    )
-                )
-                return redirect("services:services")
-            else:
-                messages.error(
-                    request, _(
-                        'An error occurred while processing your Mumbleverse Account.'
-                    )
-                )
-                return redirect("services:services")
-        else:
-            form = ServicePasswordForm()
-            return render(
-                request,
-                'services/service_password.html',
-                context={
-                    "form": form
-                }
-            )
-    except MumbleverseServerUser.DoesNotExist:
-        messages.error(
-            request, _(
-                'An error occurred while processing your Mumbleverse Account.'
-            )
-        )
-    return redirect("services:services")
+    if request.method == "POST":
+        _password = request.POST.get("password")
+        if not _password:
+            messages.error(request, DEFAULT_ERROR_MESSAGE)
+            return redirect("services:services")
+        return _account_operation(request, "set", server_id, _password)
+    form = ServicePasswordForm()
+    return render(
+        request,
+        'services/service_password.html',
+        context={
+            "form": form
+        }
+    )
 
 
 @login_required
 def activate_mumbleverse(request, server_id):
-    try:
-        _s = MumbleverseServer.objects.get(id=server_id)
-        _u, _created = MumbleverseServerUser.objects.get_or_create(
-            server=_s,
-            user=request.user,
-            defaults={
-                "uid": request.user.id + 1000000,
-                "username": request.user.username
-            }
-        )
-        _u.update_username()
-        _u.reset_password()
-        req = _u.register_user(_u.credentials["password"])
-        if not req:
-            _u.delete()
-            messages.error(
-                request, _(
-                    'An error occurred while processing your Mumbleverse account.'
-                )
-            )
-            return redirect("services:services")
-        update_server_groups.delay(server_id)
-        return render(
-            request,
-            'services/service_credentials.html',
-            context={
-                'credentials': _u.credentials,
-                'service': _u.server.name,
-            }
-        )
-    except MumbleverseServerUser.DoesNotExist:
-        messages.error(
-            request, _(
-                'An error occurred while processing your Mumbleverse account.'
-            )
-        )
-    return redirect("services:services")
+    return _account_operation(request, "activate", server_id)
+
+
+@login_required
+def activate_all_mumbleverse(request):
+    return _account_operation(request, "activate_all")